@@ -3,3 +3,11 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        # シグナルの登録
+        from . import invalidation, listing, lookups, response_cache, snapshot  # noqa: F401
+        # キャッシュに何か入る前にワーカー間の無効化のバスを作り、ここから先のほかのワーカーの書き込みを受け取る
+        invalidation.get_bus()
+        # ウォームアップ(api.warmup)はDBを読むので、ここではなくrest_api/wsgi.pyとasgi.pyから実行する
+        # (ready()はmigrateなどmanage.pyのすべてのコマンドでも呼ばれるため)
@@ -0,0 +1,103 @@
+from django.conf import settings
+from django.db import connections, router, transaction
+
+from . import invalidation, listing, snapshot
+from .models import Vehicle, ArchivedVehicle
+from .response_cache import invalidate as invalidate_response_cache
+
+# 古いrelease_yearのvehicleをコールドテーブル(ArchivedVehicle)へ移す
+#
+# ・CUTOFF_YEARより前のrelease_yearのvehicleを、BATCH_SIZE件ずつ1トランザクションで移動する
+#   (コールドテーブルに同じIDで作成し、Vehicleから削除する)
+# ・Vehicleは1行ずつシグナルを送らずにまとめて削除し、一覧用のテーブル・レスポンスキャッシュ・
+#   スナップショットのバージョン・ほかのワーカーへの通知は、バッチごとに1回だけ更新する
+# ・release_yearにはインデックスがあるので、バッチごとにホットテーブル全体を読むことはない
+# ・/api/vehicles/ はVehicle(ホットテーブル)だけを読む。?archived=includeで両方、?archived=onlyでコールドだけを読む
+#   /api/vehicles/<id>/ は、ホットテーブルになければコールドテーブルから読む(更新・削除はできない)
+#
+# 例: python manage.py archive_vehicles --before 2000
+
+DEFAULTS = {
+    # Noneのときは、コマンドで--beforeを指定する
+    'CUTOFF_YEAR': None,
+    'BATCH_SIZE': 500,
+}
+
+ARCHIVED_INCLUDE = 'include'
+ARCHIVED_ONLY = 'only'
+
+
+def archive_settings():
+    conf = dict(DEFAULTS)
+    conf.update(getattr(settings, 'VEHICLE_ARCHIVE', {}))
+    return conf
+
+
+def archived_from_vehicle(vehicle):
+    return ArchivedVehicle(
+        id=vehicle.id,
+        user_id=vehicle.user_id,
+        vehicle_name=vehicle.vehicle_name,
+        release_year=vehicle.release_year,
+        price=vehicle.price,
+        segment_id=vehicle.segment_id,
+        brand_id=vehicle.brand_id,
+    )
+
+
+def _delete_vehicles(ids):
+    # QuerySet.delete()はシグナルの受け手があると1行ずつpost_deleteを送るので、DELETE文を直接実行する
+    # (Vehicleを参照しているFKはないので、CASCADEで消すものもない)
+    connection = connections[router.db_for_write(Vehicle)]
+    table = connection.ops.quote_name(Vehicle._meta.db_table)
+    column = connection.ops.quote_name(Vehicle._meta.pk.column)
+    # SQLiteはSQLに渡せるパラメータの数に上限がある
+    size = connection.features.max_query_params or len(ids)
+    with connection.cursor() as cursor:
+        for start in range(0, len(ids), size):
+            chunk = ids[start:start + size]
+            cursor.execute('DELETE FROM {0} WHERE {1} IN ({2})'.format(table, column, ', '.join(['%s'] * len(chunk))),
+                           chunk)
+
+
+def archive_batch(before, batch_size):
+    # 1バッチ分を移動して、移動した件数を返す
+    with transaction.atomic():
+        vehicles = list(Vehicle.objects.filter(release_year__lt=before).order_by('id')[:batch_size])
+        if not vehicles:
+            return 0
+        ids = [vehicle.id for vehicle in vehicles]
+        ArchivedVehicle.objects.bulk_create([archived_from_vehicle(vehicle) for vehicle in vehicles])
+        _delete_vehicles(ids)
+        listing.delete_vehicles(ids)
+        invalidate_response_cache()
+        snapshot.schedule_bump()
+        invalidation.publish_on_commit('vehicle')
+        return len(vehicles)
+
+
+def archive(before=None, batch_size=None, on_batch=None):
+    # CUTOFF_YEAR(またはbefore)より前のvehicleをすべて移動して、移動した件数を返す
+    conf = archive_settings()
+    before = conf['CUTOFF_YEAR'] if before is None else before
+    batch_size = batch_size or conf['BATCH_SIZE']
+    if before is None:
+        raise ValueError('No cutoff year: set VEHICLE_ARCHIVE["CUTOFF_YEAR"] or pass before')
+    total = 0
+    while True:
+        count = archive_batch(before, batch_size)
+        if not count:
+            return total
+        total += count
+        if on_batch is not None:
+            on_batch(total)
+
+
+def vehicles_queryset(archived=None):
+    # ?archived=の値に応じて、一覧で読むquerysetを返す
+    if archived == ARCHIVED_ONLY:
+        return ArchivedVehicle.objects.order_by('id')
+    if archived == ARCHIVED_INCLUDE:
+        # 列の順番が同じなので、UNION ALLの結果はVehicleのインスタンスとして読める
+        return Vehicle.objects.all().union(ArchivedVehicle.objects.all(), all=True).order_by('id')
+    return Vehicle.objects.all()
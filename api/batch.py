@@ -0,0 +1,222 @@
+import atexit
+import io
+import json
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpRequest, QueryDict
+from django.urls import Resolver404, resolve
+from rest_framework import permissions, status
+from rest_framework.authentication import BaseAuthentication
+
+# /api/batch/ で受け取った複数のサブリクエストを、HTTPを経由せずにプロセス内で実行する
+#
+# ・URLの解決とViewはいつものものをそのまま使う(ミドルウェアは通らない)
+# ・token認証はバッチのリクエストで1回だけ行い、サブリクエストには認証済みのユーザを渡す
+#   (サブリクエストではBatchAuthenticationがそのユーザを使う。settings.pyのDEFAULT_AUTHENTICATION_CLASSES)
+# ・連続しているGETなどの読み取りだけのサブリクエストは、スレッドで並列に実行する
+#   スレッドはMAX_WORKERS本を常駐させ、スレッドごとのDB接続をサブリクエストのたびに閉じずに使い回す
+# ・書き込みのサブリクエストは順番通りに1件ずつ実行する
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'MAX_REQUESTS': 20,
+    'MAX_WORKERS': 4,
+}
+
+
+def batch_settings():
+    conf = dict(DEFAULTS)
+    conf.update(getattr(settings, 'API_BATCH', {}))
+    return conf
+
+
+class BatchAuthentication(BaseAuthentication):
+    # build_request()で作ったサブリクエストだけを、バッチのリクエストで認証したユーザ・トークンで認証する
+    # (batch_authはプロセス内で作ったHttpRequestにしか付かないので、外から来たリクエストでは何もしない)
+
+    def authenticate(self, request):
+        return getattr(request._request, 'batch_auth', None)
+
+
+def build_request(request, method, path, body=None):
+    # 元のリクエストのヘッダ等を引き継いでサブリクエストを作る
+    url = urlsplit(path)
+    sub_request = HttpRequest()
+    sub_request.method = method
+    sub_request.path = sub_request.path_info = url.path
+    sub_request.META = {
+        key: value for key, value in request.META.items()
+        # Authorizationヘッダは引き継がない(サブリクエストごとにtoken認証をやり直さない)
+        if key not in ('CONTENT_LENGTH', 'CONTENT_TYPE', 'QUERY_STRING', 'PATH_INFO', 'REQUEST_METHOD',
+                       'HTTP_AUTHORIZATION')
+    }
+    sub_request.META.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': url.path,
+        'QUERY_STRING': url.query,
+    })
+    sub_request.GET = QueryDict(url.query)
+    payload = b'' if body is None else json.dumps(body).encode('utf-8')
+    sub_request.META['CONTENT_TYPE'] = 'application/json'
+    sub_request.META['CONTENT_LENGTH'] = str(len(payload))
+    sub_request._stream = io.BytesIO(payload)
+    sub_request._read_started = False
+    sub_request.batch_auth = (request.user, request.auth)
+    return sub_request
+
+
+def error_result(status_code, detail):
+    return {'status': status_code, 'body': {'detail': detail}}
+
+
+def dispatch(request, sub):
+    # サブリクエスト1件を実行して、{'status': ..., 'body': ...}を返す
+    try:
+        match = resolve(urlsplit(sub['path']).path)
+    except Resolver404:
+        return error_result(status.HTTP_404_NOT_FOUND, 'Not found.')
+    # api配下のエンドポイントだけを対象にする(バッチ自身は入れ子にできない)
+    if match.namespace != 'api' or match.url_name == 'batch':
+        return error_result(status.HTTP_400_BAD_REQUEST, 'Path is not allowed in a batch.')
+
+    sub_request = build_request(request, sub['method'], sub['path'], sub.get('body'))
+    sub_request.resolver_match = match
+    try:
+        response = match.func(sub_request, *match.args, **match.kwargs)
+    except Exception:
+        # 1件のエラーでバッチ全体が失敗しないようにする
+        logger.exception('batch sub-request failed: %s %s', sub['method'], sub['path'])
+        return error_result(status.HTTP_500_INTERNAL_SERVER_ERROR, 'Internal server error.')
+
+    # DRFのResponseであれば、レンダリングせずにdataをそのまま使う(まとめて1回でJSONにする)
+    if hasattr(response, 'data'):
+        body = response.data
+    else:
+        if hasattr(response, 'render'):
+            response.render()
+        body = response.content.decode(response.charset)
+        # キャッシュから返されたJSONなどは、ほかのレスポンスと同じ形にそろえる
+        if response.get('Content-Type', '').startswith('application/json'):
+            body = json.loads(body)
+    return {'status': response.status_code, 'body': body}
+
+
+def close_unusable_connections():
+    # エラーのあとで使えなくなった接続だけを閉じる
+    # (close_old_connections()はCONN_MAX_AGE=0だと毎回閉じてしまうので使わない)
+    for connection in connections.all():
+        if connection.connection is not None and connection.errors_occurred:
+            if not connection.is_usable():
+                connection.close()
+            connection.errors_occurred = False
+
+
+class WorkerPool:
+    # サブリクエストを実行する、常駐するスレッドのプール
+    # スレッドが持っているDB接続は、shutdown()でスレッドが終わるときに閉じる
+
+    def __init__(self, size):
+        self.size = size
+        # forkされた子プロセスにはスレッドが引き継がれないので、作ったプロセスを覚えておく
+        self.pid = os.getpid()
+        self._tasks = queue.SimpleQueue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        future = Future()
+        self._ensure_threads()
+        self._tasks.put((future, fn, args))
+        return future
+
+    def _ensure_threads(self):
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.size:
+                thread = threading.Thread(target=self._run, name='api-batch-{0}'.format(len(self._threads)),
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        try:
+            while True:
+                task = self._tasks.get()
+                if task is None:
+                    return
+                future, fn, args = task
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as exc:
+                    future.set_exception(exc)
+                finally:
+                    close_unusable_connections()
+        finally:
+            connections.close_all()
+
+    def shutdown(self):
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(size):
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.size != size or _pool.pid != os.getpid():
+            if _pool is not None and _pool.pid == os.getpid():
+                _pool.shutdown()
+            _pool = WorkerPool(size)
+        return _pool
+
+
+@atexit.register
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None and pool.pid == os.getpid():
+        pool.shutdown()
+
+
+def run(request, subs, max_workers):
+    # 読み取りだけのサブリクエストが連続している区間をまとめて並列に実行する
+    results = [None] * len(subs)
+    group = []
+
+    def flush_group():
+        if len(group) > 1 and max_workers > 1:
+            pool = get_pool(max_workers)
+            futures = [(index, pool.submit(dispatch, request, subs[index])) for index in group]
+            for index, future in futures:
+                results[index] = future.result()
+        else:
+            for index in group:
+                results[index] = dispatch(request, subs[index])
+        group.clear()
+
+    for index, sub in enumerate(subs):
+        if sub['method'] in permissions.SAFE_METHODS:
+            group.append(index)
+        else:
+            flush_group()
+            results[index] = dispatch(request, sub)
+    flush_group()
+    return results
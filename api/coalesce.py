@@ -0,0 +1,99 @@
+import threading
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+
+# 同時に来た同じGETリクエストを1回の計算にまとめる(single-flight)
+#
+# 同じキー(View + 権限のスコープ + クエリパラメータなど。ResponseCacheMixinのキーと同じ)の
+# リクエストが処理中のとき、あとから来たリクエストはクエリもシリアライズもせずに処理中のものを待ち、
+# そのレンダリング済みのバイト列を使ってレスポンスを返す
+#
+# 処理中のものが200以外を返した・例外になった・TIMEOUT秒を超えたときは、待っていた側が自分で処理する
+#
+# まとめるのはWSGI(rest_api/wsgi.py)で受けたリクエストだけ
+# (gunicornのgthreadやrunserverのように、1つのワーカーが複数のスレッドで同時にリクエストを処理するとき)
+# Django 3.2のASGIでは、同期のViewやミドルウェアはすべて1つのスレッドで順番に実行され、
+# 次のリクエストはそのスレッドが空くまでViewにたどり着かないので、同時に処理中になるリクエストがない
+# そのため、ASGI(rest_api/asgi.py)で受けたリクエストはまとめずにそのまま処理する
+#
+# settings.pyのAPI_COALESCE['ENABLED']がTrueのときだけ使われる
+
+DEFAULTS = {
+    'ENABLED': False,
+    'TIMEOUT': 5.0,
+}
+
+
+def coalesce_settings():
+    conf = dict(DEFAULTS)
+    conf.update(getattr(settings, 'API_COALESCE', {}))
+    return conf
+
+
+def supported(request):
+    # まとめられるリクエストか(WSGIで受けたものだけ)
+    return not isinstance(request, ASGIRequest)
+
+
+class Flight:
+    # 処理中の1つの計算
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.waiters = 0
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, timeout):
+        # 同じキーで処理中のものがなければfn()を実行して結果を返す
+        # 処理中のものがあれば、それが終わるのを待ってその結果を返す(タイムアウトしたらNone)
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+                self.leaders += 1
+            else:
+                flight.waiters += 1
+
+        if leader:
+            try:
+                flight.result = fn()
+                return flight.result
+            finally:
+                # 終わったらすぐに外す(あとから来たリクエストは新しく計算する)
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+
+        if not flight.done.wait(timeout):
+            return None
+        if flight.result is not None:
+            with self._lock:
+                self.coalesced += 1
+        return flight.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._flights),
+                'waiting': sum(flight.waiters for flight in self._flights.values()),
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+            }
+
+    def clear(self):
+        with self._lock:
+            self.leaders = self.coalesced = 0
+
+
+flights = SingleFlight()
@@ -0,0 +1,87 @@
+import gzip
+import zlib
+
+from django.conf import settings
+
+try:
+    import brotli
+except ImportError:
+    # brotliがインストールされていなければgzipだけを使う
+    brotli = None
+
+# APIのレスポンスの圧縮(api.middleware.CompressionMiddleware)で使う関数
+#
+# ・Accept-Encodingを見て、brotli(br)かgzipを選ぶ(brotliはインストールされているときだけ)
+# ・MIN_SIZEより小さいレスポンスは圧縮しない
+# ・StreamingHttpResponseはチャンクごとに圧縮しながら返す
+# ・レスポンスキャッシュのエントリ(CachedResponse)は、圧縮したバイト列もエントリに持っておき、
+#   2回目以降は圧縮し直さずにそのまま返す
+
+DEFAULTS = {
+    'ENABLED': True,
+    'MIN_SIZE': 1024,
+    'GZIP_LEVEL': 6,
+    'BROTLI_QUALITY': 5,
+    'PATH_PREFIXES': ['/api/'],
+    'CONTENT_TYPES': ['application/json', 'text/'],
+}
+
+
+def compression_settings():
+    conf = dict(DEFAULTS)
+    conf.update(getattr(settings, 'API_COMPRESSION', {}))
+    return conf
+
+
+def available_encodings():
+    # 優先する順番に並べる
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def choose_encoding(accept_encoding):
+    # Accept-Encodingのq値を見て、使うエンコーディングを1つ選ぶ
+    weights = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        name = name.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name] = q
+    best = None
+    for encoding in available_encodings():
+        q = weights.get(encoding, weights.get('*', 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (encoding, q)
+    return best[0] if best else None
+
+
+def compress(data, encoding, conf=None):
+    conf = conf or compression_settings()
+    if encoding == 'br':
+        return brotli.compress(data, quality=conf['BROTLI_QUALITY'])
+    return gzip.compress(data, compresslevel=conf['GZIP_LEVEL'], mtime=0)
+
+
+def compress_stream(chunks, encoding, conf=None):
+    # チャンクを受け取るたびに圧縮して返すジェネレータ
+    conf = conf or compression_settings()
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=conf['BROTLI_QUALITY'])
+        for chunk in chunks:
+            data = compressor.process(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        # wbits=31はgzip形式のヘッダを付ける指定
+        compressor = zlib.compressobj(conf['GZIP_LEVEL'], zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
@@ -0,0 +1,99 @@
+import random
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+
+# 読み取りレプリカへのルーティングを行うDBルータ
+# settings.pyのDATABASE_ROUTERSに登録して使う
+#
+# ・GETなど安全なメソッドのリクエストだけがレプリカを読みに行く
+# ・書き込みは常にprimary(default)へ送る
+# ・同じリクエスト内で書き込みがあった場合は、以降の読み取りもprimaryへ送る(read-your-own-writes)
+# ・書き込みをしたユーザは、REPLICA_STICKY_SECONDSの間primaryに固定する(レプリケーション遅延対策)
+#   固定はREPLICA_PIN_CACHEのキャッシュに保存するので、次のリクエストが別のワーカーに来ても効く
+#   レプリカが設定されていなければ、固定の読み書きもしない(リクエストごとにキャッシュを読まない)
+# ・レプリカにはマイグレーションを実行しない(primaryからレプリケーションされる)
+
+PRIMARY_DB = 'default'
+
+# リクエスト単位のルーティング状態はスレッドローカルに保持する
+_state = threading.local()
+
+
+def replica_aliases():
+    return list(getattr(settings, 'REPLICA_DATABASES', []))
+
+
+def use_replica():
+    # このリクエストの読み取りをレプリカへ向ける
+    _state.use_replica = True
+
+
+def use_primary():
+    # このリクエストの読み取りをprimaryへ固定する
+    _state.use_replica = False
+
+
+def reset():
+    # リクエスト終了時に状態を初期化する
+    _state.use_replica = False
+
+
+def is_using_replica():
+    return getattr(_state, 'use_replica', False)
+
+
+def reads_from_replica():
+    # このリクエストの読み取りが実際にレプリカへ行くか(レプリカが設定されていなければFalse)
+    return bool(replica_aliases()) and is_using_replica()
+
+
+def _pin_cache():
+    return caches[getattr(settings, 'REPLICA_PIN_CACHE', 'default')]
+
+
+def _pin_key(user):
+    return 'api:replica-pin:{0}'.format(user.pk)
+
+
+def pin(user):
+    # 書き込みをしたユーザを一定時間primaryに固定する
+    timeout = getattr(settings, 'REPLICA_STICKY_SECONDS', 0)
+    if not replica_aliases():
+        return
+    if timeout and user is not None and user.is_authenticated:
+        _pin_cache().set(_pin_key(user), True, timeout)
+
+
+def is_pinned(user):
+    if not replica_aliases() or user is None or not user.is_authenticated:
+        return False
+    return bool(_pin_cache().get(_pin_key(user)))
+
+
+class PrimaryReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        replicas = replica_aliases()
+        if replicas and is_using_replica():
+            return random.choice(replicas)
+        return PRIMARY_DB
+
+    def db_for_write(self, model, **hints):
+        # 書き込みがあったら、このリクエストの残りの読み取りはprimaryから行う
+        use_primary()
+        return PRIMARY_DB
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # primaryとレプリカは同じデータを持っているので、どのDB間のリレーションも許可する
+        databases = {PRIMARY_DB, *replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # レプリカのテーブルはprimaryからレプリケーションされるので、マイグレーションしない
+        if db in replica_aliases():
+            return False
+        return None
@@ -0,0 +1,216 @@
+import atexit
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections, transaction
+
+from .models import Vehicle
+from .serializers import resolve_related_names
+
+# Vehicleの書き込みをまとめて行う(write-behind)ためのキュー
+#
+# POST /api/vehicles/ に「Prefer: respond-async」ヘッダを付けると、
+# VehicleSerializerで検証だけを行って202とtracking_idを返し、
+# 実際のINSERTはバックグラウンドのスレッドがまとめて1つのトランザクションでコミットする
+# 件数(BATCH_SIZE)か時間(FLUSH_INTERVAL)のどちらかに達したらコミットする
+#
+# 進捗はワーカー間で共有するキャッシュ(STATUS_CACHE)に保存するので、
+# 別のワーカーにリクエストが来ても GET /api/vehicles/ingest/<tracking_id>/ で確認できる
+#
+# 溜まっている行はプロセスのメモリにしかない
+# グレースフルシャットダウン(atexit)ではすべてコミットするが、SIGKILLやOOMでワーカーが落ちると失われる
+# そのときは、受け付けたワーカーのプロセスがもういないことが分かれば、ステータスをlostにして返す
+# (確実に残す必要があるデータは、Preferヘッダを付けずに同期で登録すること)
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = 'queued'
+STATUS_COMMITTED = 'committed'
+STATUS_FAILED = 'failed'
+STATUS_LOST = 'lost'
+
+DEFAULTS = {
+    'ENABLED': False,
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 0.5,
+    # これ以上溜まったら、受け付けたスレッドでその場でコミットする(メモリが溢れないように)
+    'MAX_PENDING': 5000,
+    # キャッシュにステータスを残しておく秒数
+    'STATUS_TIMEOUT': 60 * 60,
+    # ステータスを保存するキャッシュ(CACHESのエイリアス、ワーカー間で共有するものを指定する)
+    # 1行ごとにエントリができるので、MAX_ENTRIESで古くないエントリが消されないものを使う(settings.pyのCACHES)
+    'STATUS_CACHE': 'ingest_status',
+}
+
+
+def ingest_settings():
+    conf = dict(DEFAULTS)
+    conf.update(getattr(settings, 'VEHICLE_INGEST', {}))
+    return conf
+
+
+def _status_key(tracking_id):
+    return 'api:vehicle-ingest:{0}'.format(tracking_id)
+
+
+def _status_cache():
+    return caches[ingest_settings()['STATUS_CACHE']]
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def get_status(tracking_id):
+    result = _status_cache().get(_status_key(tracking_id))
+    if result is None or result['status'] != STATUS_QUEUED:
+        return result
+    # 受け付けたワーカーが同じホストで、もう動いていなければ、溜まっていた行は失われている
+    owner = result.pop('owner', None)
+    if owner and owner['host'] == socket.gethostname() and not _process_alive(owner['pid']):
+        result.update(status=STATUS_LOST, detail='The worker that accepted this vehicle exited before committing it.')
+    return result
+
+
+class VehicleIngestQueue:
+
+    def __init__(self, batch_size, flush_interval, max_pending, status_timeout, autostart=True):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.status_timeout = status_timeout
+        self.autostart = autostart
+        self._pending = []
+        self._cond = threading.Condition()
+        # flush()が同時に走らないようにするためのロック
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _set_status(self, tracking_id, status, **extra):
+        value = {'tracking_id': tracking_id, 'status': status}
+        value.update(extra)
+        _status_cache().set(_status_key(tracking_id), value, self.status_timeout)
+        return value
+
+    def submit(self, validated_data, user):
+        # 検証済みのデータを受け付けてtracking_idを返す
+        tracking_id = uuid.uuid4().hex
+        self._set_status(tracking_id, STATUS_QUEUED, owner={'host': socket.gethostname(), 'pid': os.getpid()})
+        with self._cond:
+            self._pending.append((tracking_id, dict(validated_data, user=user)))
+            size = len(self._pending)
+            if size >= self.batch_size:
+                self._cond.notify()
+        if self.autostart:
+            self._ensure_thread()
+        if size >= self.max_pending:
+            # バックグラウンドが追いついていないので、呼び出し元で書き込む
+            self.flush()
+        return tracking_id
+
+    def flush(self):
+        # 溜まっている行を1つのトランザクションでコミットする
+        # post_save等のシグナルが飛ぶように、bulk_createではなく1行ずつsave()している
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            results = []
+            try:
+                with transaction.atomic():
+                    for tracking_id, data in batch:
+                        try:
+                            # 1行失敗してもバッチ全体が巻き戻らないようにセーブポイントを使う
+                            with transaction.atomic():
+                                vehicle = Vehicle.objects.create(**resolve_related_names(data))
+                        except Exception as exc:
+                            logger.warning('vehicle ingest failed: %s', exc)
+                            results.append((tracking_id, STATUS_FAILED, {'detail': str(exc)}))
+                        else:
+                            results.append((tracking_id, STATUS_COMMITTED, {'vehicle_id': vehicle.id}))
+            except Exception as exc:
+                # コミット自体が失敗したとき(database is lockedなど)は、バッチのどの行も入っていない
+                # 黙って捨てずに、すべての行をfailedにする(クライアントは登録し直せる)
+                logger.exception('vehicle ingest batch failed')
+                results = [(tracking_id, STATUS_FAILED, {'detail': str(exc)}) for tracking_id, data in batch]
+            # コミットが終わってからステータスを更新する
+            for tracking_id, status, extra in results:
+                self._set_status(tracking_id, status, **extra)
+            return len(batch)
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='vehicle-ingest', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._stopping and len(self._pending) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                stopping = self._stopping
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('vehicle ingest flush failed')
+            finally:
+                close_old_connections()
+            if stopping:
+                return
+
+    def stop(self, timeout=None):
+        # グレースフルシャットダウン時に、溜まっている行をすべてコミットしてから終了する
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+        self.flush()
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                conf = ingest_settings()
+                _queue = VehicleIngestQueue(
+                    batch_size=conf['BATCH_SIZE'],
+                    flush_interval=conf['FLUSH_INTERVAL'],
+                    max_pending=conf['MAX_PENDING'],
+                    status_timeout=conf['STATUS_TIMEOUT'],
+                )
+                atexit.register(_queue.stop)
+    return _queue
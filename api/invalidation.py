@@ -0,0 +1,174 @@
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from .models import Segment, Brand, Vehicle
+from .throttling import project_suffix
+
+# 同じホストのワーカープロセスの間で、プロセス内のキャッシュの無効化を伝える
+#
+# /dev/shmのファイルをmmapし、トピック(モデル)ごとの更新回数(8バイト)を置いている
+#  ・書き込んだワーカー … コミットしたあとに、そのモデルの更新回数を1つ増やす(publish)
+#  ・ほかのワーカー     … キャッシュを読む前に更新回数を見て(poll)、前回から変わっていれば
+#                         subscribe()で登録した関数を呼んでキャッシュを捨てる
+# キャッシュを使うたびにpollするので、ほかのワーカーでコミットされた書き込みは、
+# そのあとに始まったリクエストでは必ず反映される
+# pollはmmapから数十バイト読むだけで、リクエストがなければ何もしない(スレッドもソケットも使わない)
+#
+# settings.pyのAPI_INVALIDATION_BUS['ENABLED']がFalseのときは、プロセス内だけで無効化する
+
+DEFAULTS = {
+    'ENABLED': True,
+    # Noneのときは/dev/shm(なければ一時ディレクトリ)に、プロジェクトとsettingsごとの名前で作る
+    # (同じホストのほかのプロジェクトや、別のsettingsで動いているプロセスと更新回数を共有しない)
+    'PATH': None,
+}
+
+# トピックの並び(ファイルの中の位置)。増やすときは末尾に追加する
+TOPICS = ['segment', 'brand', 'vehicle']
+COUNTER = struct.Struct('<Q')
+
+_conf = None
+
+
+def bus_settings():
+    # キャッシュを読むたびに呼ばれるので、設定は1回だけ組み立ててとっておく
+    global _conf
+    if _conf is None:
+        conf = dict(DEFAULTS)
+        conf.update(getattr(settings, 'API_INVALIDATION_BUS', {}))
+        if conf['PATH'] is None:
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            conf['PATH'] = os.path.join(directory, 'rest_api-invalidation-{0}'.format(project_suffix()))
+        _conf = conf
+    return _conf
+
+
+def _reset_settings(setting, **kwargs):
+    # テストでoverride_settingsしたときに読み直す
+    global _conf
+    if setting == 'API_INVALIDATION_BUS':
+        _conf = None
+
+
+setting_changed.connect(_reset_settings, dispatch_uid='api.invalidation.reset_settings')
+
+
+class InvalidationBus:
+
+    def __init__(self, path):
+        self.path = path
+        size = len(TOPICS) * COUNTER.size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # ほかのプロセスが先に作っていれば、そのまま使う
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self.lock = threading.Lock()
+        self.subscribers = {topic: [] for topic in TOPICS}
+        # 最後に見た更新回数(ここより前の書き込みは無視するので、キャッシュに何か入れる前に作ること。ApiConfig.ready()で作っている)
+        self.seen = self.read_all()
+
+    def read_all(self):
+        return [COUNTER.unpack_from(self.map, i * COUNTER.size)[0] for i in range(len(TOPICS))]
+
+    def subscribe(self, topic, callback):
+        self.subscribers[topic].append(callback)
+
+    def publish(self, topic):
+        # 更新回数を1つ増やす(読んで書くので、プロセス間はfcntlのロックで排他する)
+        index = TOPICS.index(topic)
+        offset = index * COUNTER.size
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, COUNTER.size, offset)
+            try:
+                value = COUNTER.unpack_from(self.map, offset)[0] + 1
+                COUNTER.pack_into(self.map, offset, value)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, COUNTER.size, offset)
+            # 前回のpollから自分しか書いていなければ、自分のキャッシュはシグナルで無効化済みなので既読にする
+            if self.seen[index] == value - 1:
+                self.seen[index] = value
+
+    def poll(self):
+        # 前回から更新回数が変わったトピックの関数を呼ぶ。変わったトピックのリストを返す
+        current = self.read_all()
+        if current == self.seen:
+            return []
+        with self.lock:
+            changed = [topic for i, topic in enumerate(TOPICS) if current[i] != self.seen[i]]
+            self.seen = current
+        for topic in changed:
+            for callback in self.subscribers[topic]:
+                callback()
+        return changed
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+_bus = None
+_bus_lock = threading.Lock()
+# バスを作り直しても登録が消えないように、登録はここにも持っておく
+_subscribers = []
+
+
+def get_bus():
+    global _bus
+    conf = bus_settings()
+    if not conf['ENABLED']:
+        return None
+    if _bus is None or _bus.path != conf['PATH']:
+        with _bus_lock:
+            if _bus is None or _bus.path != conf['PATH']:
+                bus = InvalidationBus(conf['PATH'])
+                for topic, callback in _subscribers:
+                    bus.subscribe(topic, callback)
+                # PATHが変わったら、前のファイルのmmapとfdを閉じる
+                old, _bus = _bus, bus
+                if old is not None:
+                    old.close()
+    return _bus
+
+
+def subscribe(topics, callback):
+    # ほかのワーカーでtopicsのモデルに書き込みがあったときに、callback()を呼ぶ
+    for topic in topics:
+        _subscribers.append((topic, callback))
+        if _bus is not None:
+            _bus.subscribe(topic, callback)
+
+
+def poll():
+    # キャッシュを読む前に呼ぶ
+    bus = get_bus()
+    return bus.poll() if bus is not None else []
+
+
+def publish(topic):
+    bus = get_bus()
+    if bus is not None:
+        bus.publish(topic)
+
+
+def publish_on_commit(topic):
+    # ほかのワーカーが古いデータを読み直さないように、コミットされてから伝える
+    transaction.on_commit(lambda: publish(topic))
+
+
+def _publish(sender, **kwargs):
+    publish_on_commit(sender._meta.model_name)
+
+
+for _model in (Segment, Brand, Vehicle):
+    post_save.connect(_publish, sender=_model, dispatch_uid='api.invalidation.save.{0}'.format(_model.__name__))
+    post_delete.connect(_publish, sender=_model, dispatch_uid='api.invalidation.delete.{0}'.format(_model.__name__))
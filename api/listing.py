@@ -0,0 +1,75 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from .models import Segment, Brand, Vehicle, VehicleListing
+
+# 非正規化したvehicle一覧(VehicleListing)をVehicle/Brand/Segmentと同期させる
+#
+# ・Vehicleの作成・更新・削除 → 該当する1行を作成・更新・削除
+# ・Brand/Segmentの名前の変更 → そのbrand/segmentを使っている行の名前をまとめて更新
+# シグナルは書き込みと同じDB接続・同じトランザクションの中で実行されるので、
+# 書き込みがatomicの中で行われていれば一緒にコミット・ロールバックされる
+#
+# QuerySet.update()やbulk_create()はシグナルを送らないので、
+# それらで書き込んだあとは「python manage.py rebuild_vehicle_listing」で作り直すこと
+
+
+def listing_from_vehicle(vehicle):
+    return VehicleListing(
+        id=vehicle.id,
+        vehicle_name=vehicle.vehicle_name,
+        release_year=vehicle.release_year,
+        price=vehicle.price,
+        segment_id=vehicle.segment_id,
+        brand_id=vehicle.brand_id,
+        segment_name=vehicle.segment.segment_name,
+        brand_name=vehicle.brand.brand_name,
+    )
+
+
+def rebuild(batch_size=500, using='default'):
+    # 一覧用のテーブルをVehicleから作り直す
+    with transaction.atomic(using=using):
+        VehicleListing.objects.using(using).all().delete()
+        vehicles = Vehicle.objects.using(using).select_related('segment', 'brand').order_by('id')
+        batch = []
+        count = 0
+        for vehicle in vehicles.iterator(chunk_size=batch_size):
+            batch.append(listing_from_vehicle(vehicle))
+            if len(batch) >= batch_size:
+                VehicleListing.objects.using(using).bulk_create(batch)
+                count += len(batch)
+                batch = []
+        VehicleListing.objects.using(using).bulk_create(batch)
+        return count + len(batch)
+
+
+def delete_vehicles(ids):
+    # シグナルを送らずにまとめて削除したvehicleの行を消す(api.archive)
+    return VehicleListing.objects.filter(id__in=ids).delete()[0]
+
+
+def _vehicle_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    listing_from_vehicle(instance).save()
+
+
+def _vehicle_deleted(sender, instance, **kwargs):
+    VehicleListing.objects.filter(id=instance.id).delete()
+
+
+def _segment_saved(sender, instance, created=False, raw=False, **kwargs):
+    if not created and not raw:
+        VehicleListing.objects.filter(segment_id=instance.id).update(segment_name=instance.segment_name)
+
+
+def _brand_saved(sender, instance, created=False, raw=False, **kwargs):
+    if not created and not raw:
+        VehicleListing.objects.filter(brand_id=instance.id).update(brand_name=instance.brand_name)
+
+
+post_save.connect(_vehicle_saved, sender=Vehicle, dispatch_uid='api.listing.vehicle_saved')
+post_delete.connect(_vehicle_deleted, sender=Vehicle, dispatch_uid='api.listing.vehicle_deleted')
+post_save.connect(_segment_saved, sender=Segment, dispatch_uid='api.listing.segment_saved')
+post_save.connect(_brand_saved, sender=Brand, dispatch_uid='api.listing.brand_saved')
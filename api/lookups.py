@@ -0,0 +1,106 @@
+import threading
+from collections import OrderedDict
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from . import invalidation
+from .models import Segment, Brand
+
+# brand_name / segment_name からIDを引くための小さなキャッシュ
+#
+# Vehicleを名前付きで作成するときに毎回Brand/Segmentを検索しなくて済むようにする
+# ・プロセス内のLRUなので、件数はMAX_SIZEで上限を決めている
+# ・トランザクションがロールバックされても存在しないIDが残らないよう、コミット後にキャッシュする
+# ・名前の変更や削除があったら、シグナルでキャッシュから消す
+#   ほかのワーカーでの変更は、api.invalidationのバスで伝わってきたときにキャッシュごと捨てる
+
+MAX_SIZE = 1024
+
+
+class NameLookupCache:
+
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            pk = self._data.get(name)
+            if pk is not None:
+                self._data.move_to_end(name)
+            return pk
+
+    def set(self, name, pk):
+        with self._lock:
+            self._data[name] = pk
+            self._data.move_to_end(name)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def discard_pk(self, pk):
+        with self._lock:
+            for name in [name for name, value in self._data.items() if value == pk]:
+                del self._data[name]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# {モデル: 名前の属性名}
+NAME_FIELDS = {
+    Segment: 'segment_name',
+    Brand: 'brand_name',
+}
+
+_caches = {model: NameLookupCache() for model in NAME_FIELDS}
+
+
+def get_or_create_by_name(model, name):
+    # 名前からインスタンスを返す。なければ作成する
+    # 呼び出し元のトランザクションの中で実行すること
+    name_field = NAME_FIELDS[model]
+    cache = _caches[model]
+    invalidation.poll()
+    pk = cache.get(name)
+    if pk is not None:
+        # FKに設定するだけなので、DBから読み直さずにインスタンスを作る
+        return model(pk=pk, **{name_field: name})
+    # unique制約があるので、同時に作成されてもget_or_createがIntegrityErrorを拾って取得し直してくれる
+    instance, _ = model.objects.get_or_create(**{name_field: name})
+    transaction.on_commit(lambda: cache.set(name, instance.pk))
+    return instance
+
+
+def preload(using=None):
+    # Brand/Segmentの名前とIDを、キャッシュに入るだけ読み込んでおく(ワーカーのウォームアップ用)
+    # 読み込む前にバスを作っておく(あとから作ると、読み込みからバスを作るまでのほかのワーカーの書き込みが既読になる)
+    invalidation.poll()
+    count = 0
+    for model, name_field in NAME_FIELDS.items():
+        cache = _caches[model]
+        rows = model.objects.using(using).order_by('pk').values_list(name_field, 'pk')[:cache.max_size]
+        for name, pk in rows:
+            cache.set(name, pk)
+            count += 1
+    return count
+
+
+def clear():
+    for cache in _caches.values():
+        cache.clear()
+
+
+def _discard(sender, instance, **kwargs):
+    _caches[sender].discard_pk(instance.pk)
+
+
+for _model in NAME_FIELDS:
+    post_save.connect(_discard, sender=_model, dispatch_uid='api.lookups.save.{0}'.format(_model.__name__))
+    post_delete.connect(_discard, sender=_model, dispatch_uid='api.lookups.delete.{0}'.format(_model.__name__))
+
+
+for _model, _cache in _caches.items():
+    invalidation.subscribe([_model._meta.model_name], _cache.clear)
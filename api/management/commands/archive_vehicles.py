@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api import archive
+
+# 古いrelease_yearのvehicleをコールドテーブル(ArchivedVehicle)へ移すコマンド
+# --beforeを省略したときはsettings.pyのVEHICLE_ARCHIVE['CUTOFF_YEAR']を使う
+#
+# 例: python manage.py archive_vehicles --before 2000 --batch-size 1000
+
+
+class Command(BaseCommand):
+    help = 'Move vehicles released before a cutoff year from the hot table to the archive table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--before', type=int, help='Archive vehicles with release_year before this year')
+        parser.add_argument('--batch-size', type=int, help='Vehicles moved per transaction')
+
+    def handle(self, *args, **options):
+        def progress(total):
+            if options['verbosity'] > 1:
+                self.stdout.write('Archived {0} vehicles...'.format(total))
+
+        try:
+            count = archive.archive(before=options['before'], batch_size=options['batch_size'], on_batch=progress)
+        except ValueError as exc:
+            raise CommandError(exc)
+        self.stdout.write(self.style.SUCCESS('Archived {0} vehicles.'.format(count)))
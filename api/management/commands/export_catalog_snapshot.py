@@ -0,0 +1,31 @@
+import shutil
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import snapshot
+
+# Vehicle(+Brand/Segmentの名前)の列指向スナップショットを作るコマンド
+# 今のデータのバージョンのファイルがすでにあれば、作り直さずにそれを使う
+#
+# 例: python manage.py export_catalog_snapshot --type arrow --output catalog.arrow
+
+
+class Command(BaseCommand):
+    help = 'Export Vehicle joined with Brand and Segment names as a Parquet or Arrow IPC snapshot'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--type', choices=sorted(snapshot.FORMATS), default='parquet', help='File format')
+        parser.add_argument('--output', help='Copy the snapshot to this path')
+
+    def handle(self, *args, **options):
+        try:
+            path, version, cached = snapshot.get_snapshot(options['type'])
+        except snapshot.SnapshotUnavailable as exc:
+            raise CommandError('{0} (pip install pyarrow)'.format(exc))
+        if options['output']:
+            if cached:
+                shutil.copyfile(path, options['output'])
+            else:
+                shutil.move(str(path), options['output'])
+            path = options['output']
+        self.stdout.write(self.style.SUCCESS('Wrote catalog snapshot v{0} to {1}.'.format(version, path)))
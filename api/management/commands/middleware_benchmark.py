@@ -0,0 +1,75 @@
+import logging
+import statistics
+import time
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+from api.middleware import expanded_middleware
+
+# PathScopedMiddlewareで、1リクエストあたりどれだけ短くなったかを計測するコマンド
+#
+# 次の2つのWSGIハンドラに同じリクエストを交互に送り、1リクエストあたりの時間の中央値を比べる
+#  ・full   … FULL_ONLYのミドルウェアをMIDDLEWAREに直接並べたもの(パスで切り替えない)
+#  ・scoped … 今のMIDDLEWARE
+# スロットルは計測の邪魔になるので止めている
+# --tokenを指定しなければ未認証のリクエストになる(DBにアクセスせずに401が返る)
+#
+# 例: python manage.py middleware_benchmark --path /api/ --path /admin/login/
+
+
+class Command(BaseCommand):
+    help = 'Compare per-request middleware overhead with and without PathScopedMiddleware'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', action='append', help='Path to request (repeatable, default: /api/)')
+        parser.add_argument('--token', help='Send "Authorization: Token <token>"')
+        parser.add_argument('--requests', type=int, default=500, help='Requests per round')
+        parser.add_argument('--rounds', type=int, default=7, help='Number of rounds')
+
+    def handle(self, *args, **options):
+        paths = options['path'] or ['/api/']
+        headers = {'HTTP_HOST': 'localhost'}
+        if options['token']:
+            headers['HTTP_AUTHORIZATION'] = 'Token {0}'.format(options['token'])
+
+        # 401/404の警告ログが大量に出るので、計測中はdjango.requestのログを止める
+        logging.getLogger('django.request').disabled = True
+        throttle = dict(getattr(settings, 'API_THROTTLE', {}), ENABLED=False)
+        with override_settings(API_THROTTLE=throttle, ALLOWED_HOSTS=['localhost']):
+            handlers = {}
+            with override_settings(MIDDLEWARE=expanded_middleware()):
+                handlers['full'] = WSGIHandler()
+            handlers['scoped'] = WSGIHandler()
+
+            self.stdout.write('{0:<24} {1:>7} {2:>12} {3:>12} {4:>12}'.format(
+                'path', 'status', 'full (us)', 'scoped (us)', 'saved (us)'))
+            for path in paths:
+                environ = RequestFactory().get(path, **headers).environ
+                timings = {name: [] for name in handlers}
+                statuses = set()
+                for _ in range(options['rounds']):
+                    for name, handler in handlers.items():
+                        elapsed, status = self.run_round(handler, environ, options['requests'])
+                        timings[name].append(elapsed)
+                        statuses.add(status)
+                full = statistics.median(timings['full']) * 1e6
+                scoped = statistics.median(timings['scoped']) * 1e6
+                self.stdout.write('{0:<24} {1:>7} {2:>12.1f} {3:>12.1f} {4:>12.1f}'.format(
+                    path, '/'.join(sorted(statuses)), full, scoped, full - scoped))
+
+    def run_round(self, handler, environ, requests):
+        # 1リクエストあたりの平均時間(秒)と、レスポンスのステータスを返す
+        status = []
+
+        def start_response(value, headers):
+            status.append(value.split(' ', 1)[0])
+
+        start = time.perf_counter()
+        for _ in range(requests):
+            response = handler(dict(environ), start_response)
+            response.close()
+        return (time.perf_counter() - start) / requests, status[-1]
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from api import listing
+
+# 非正規化したvehicle一覧(VehicleListing)をVehicleから作り直すコマンド
+#
+# 例: python manage.py rebuild_vehicle_listing
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the denormalized vehicle listing table from Vehicle, Brand and Segment'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows per insert')
+
+    def handle(self, *args, **options):
+        count = listing.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Rebuilt {0} vehicle listing rows.'.format(count)))
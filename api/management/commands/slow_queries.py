@@ -0,0 +1,40 @@
+import json
+import shutil
+
+from django.core.management.base import BaseCommand
+
+from api.slow_queries import load_dumps, slow_query_settings
+
+# 各ワーカーが書き出した遅いSQLの集計をまとめて表示するコマンド
+#
+# 例: python manage.py slow_queries --limit 10
+#     python manage.py slow_queries --json > slow_queries.json
+
+
+class Command(BaseCommand):
+    help = 'Dump the slow queries recorded by the API workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20, help='Number of queries to show')
+        parser.add_argument('--json', action='store_true', help='Output as JSON')
+        parser.add_argument('--clear', action='store_true', help='Delete the recorded files after dumping')
+
+    def handle(self, *args, **options):
+        directory = slow_query_settings()['DIRECTORY']
+        entries = load_dumps(directory)[:options['limit']] if directory.exists() else []
+
+        if options['json']:
+            self.stdout.write(json.dumps(entries, indent=2))
+        elif not entries:
+            self.stdout.write('No slow queries recorded.')
+        else:
+            for entry in entries:
+                self.stdout.write(self.style.MIGRATE_HEADING(
+                    '{fingerprint}  count={count}  total={total_ms:.1f}ms  max={max_ms:.1f}ms'.format(**entry)))
+                self.stdout.write('  views: {0}'.format(', '.join(entry['views'])))
+                self.stdout.write('  sql:   {0}'.format(entry['sql']))
+                for line in entry['plan'] or []:
+                    self.stdout.write('  plan:  {0}'.format(line))
+
+        if options['clear'] and directory.exists():
+            shutil.rmtree(directory)
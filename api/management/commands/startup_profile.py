@@ -0,0 +1,127 @@
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# ワーカーのコールドスタートにかかる時間を計測するコマンド
+#
+# 設定モジュールごとに新しいPythonプロセスを起動し、
+#  ・django.setup()までの時間
+#  ・最初のリクエストを返すまでの時間
+#  ・アプリごと、モジュールごとのimport時間
+# を表示する
+# import時間の内訳は、-X importtimeを付けた別のプロセスで計測する(計測自体のオーバーヘッドがあるため)
+#
+# 例: python manage.py startup_profile rest_api.settings rest_api.settings_api
+
+# 子プロセスで実行するスクリプト
+# DBにアクセスしないように、未認証のリクエストを送る(401が返る)
+CHILD_SCRIPT = '''
+import json, sys, time
+t0 = time.perf_counter()
+import django
+from django.conf import settings
+django.setup()
+t1 = time.perf_counter()
+from django.test import Client
+response = Client().get(sys.argv[1], HTTP_HOST='localhost')
+t2 = time.perf_counter()
+print(json.dumps({
+    'setup': t1 - t0,
+    'first_request': t2 - t0,
+    'status': response.status_code,
+    'apps': list(settings.INSTALLED_APPS),
+}))
+'''
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def parse_importtime(stderr):
+    # {モジュール名: (自身のimport時間, 累積import時間)}を秒で返す
+    modules = {}
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            modules[match.group(4)] = (int(match.group(1)) / 1e6, int(match.group(2)) / 1e6)
+    return modules
+
+
+def app_import_time(modules, name):
+    # アプリのパッケージ配下のモジュールの、自身のimport時間の合計
+    # (パッケージ自体の行がimporttimeに出ないことがあるので、配下のモジュールを合計している)
+    prefix = name + '.'
+    return sum(own for module, (own, _) in modules.items() if module == name or module.startswith(prefix))
+
+
+def app_module(app):
+    # 'api.apps.ApiConfig'のようなAppConfigの指定は、パッケージ名に直す
+    if '.apps.' in app:
+        return app.split('.apps.')[0]
+    return app
+
+
+class Command(BaseCommand):
+    help = 'Report import time and time to first request for each settings module'
+
+    def add_arguments(self, parser):
+        parser.add_argument('settings_modules', nargs='*',
+                            help='Settings modules to compare (default: current settings)')
+        parser.add_argument('--path', default='/api/brands/', help='Path of the first request')
+        parser.add_argument('--repeat', type=int, default=3, help='Number of cold starts to measure')
+        parser.add_argument('--top', type=int, default=15, help='Number of slowest modules to show')
+
+    def run_child(self, settings_module, path, importtime=False):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings_module)
+        command = [sys.executable, '-c', CHILD_SCRIPT, path]
+        if importtime:
+            command[1:1] = ['-X', 'importtime']
+        result = subprocess.run(command, cwd=str(settings.BASE_DIR), env=env, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1])
+        data = json.loads(result.stdout.strip().splitlines()[-1])
+        data['modules'] = parse_importtime(result.stderr)
+        return data
+
+    def handle(self, *args, **options):
+        settings_modules = options['settings_modules'] or [os.environ['DJANGO_SETTINGS_MODULE']]
+        # 計測のばらつきが偏らないように、設定モジュールを交互に起動する
+        runs = {settings_module: [] for settings_module in settings_modules}
+        for _ in range(options['repeat']):
+            for settings_module in settings_modules:
+                runs[settings_module].append(self.run_child(settings_module, options['path']))
+
+        summary = []
+        for settings_module in settings_modules:
+            setup = statistics.median(run['setup'] for run in runs[settings_module])
+            first_request = statistics.median(run['first_request'] for run in runs[settings_module])
+            last = self.run_child(settings_module, options['path'], importtime=True)
+            summary.append((settings_module, setup, first_request))
+
+            self.stdout.write(self.style.MIGRATE_HEADING(settings_module))
+            self.stdout.write('  django.setup():    {0:8.1f} ms'.format(setup * 1000))
+            self.stdout.write('  first request:     {0:8.1f} ms (status {1})'.format(
+                first_request * 1000, last['status']))
+
+            self.stdout.write('  import time per app (own modules):')
+            for app in last['apps']:
+                name = app_module(app)
+                seconds = app_import_time(last['modules'], name)
+                self.stdout.write('    {0:40s} {1:8.1f} ms'.format(name, seconds * 1000))
+
+            self.stdout.write('  slowest modules (cumulative):')
+            slowest = sorted(last['modules'].items(), key=lambda item: item[1][1], reverse=True)
+            for name, (_, seconds) in slowest[:options['top']]:
+                self.stdout.write('    {0:40s} {1:8.1f} ms'.format(name, seconds * 1000))
+
+        if len(summary) > 1:
+            base = summary[0][2]
+            self.stdout.write(self.style.MIGRATE_HEADING('time to first request'))
+            for settings_module, setup, first_request in summary:
+                self.stdout.write('  {0:40s} {1:8.1f} ms ({2:+.1f}%)'.format(
+                    settings_module, first_request * 1000, (first_request / base - 1) * 100))
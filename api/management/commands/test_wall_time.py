@@ -0,0 +1,62 @@
+import os
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.runner import default_test_processes
+
+from api import seed
+from api.testing import PERF_TAG
+
+# テストを直列(--parallel 1)と並列(--parallel N)で実行して、かかった時間(wall time)を比べるコマンド
+#
+# ・api     … 性能テスト以外のテスト
+# ・perf    … --tag perfの性能テスト(データセットを入れたテストDBを使う)
+# どちらも別プロセスでmanage.py testを実行して、プロセスの起動からの時間を計測する
+# データセットのスナップショットがなければ、計測の前に1回だけ作っておく(初回の作成時間を含めないため)
+#
+# 例: python manage.py test_wall_time --parallel 4
+
+
+class Command(BaseCommand):
+    help = 'Compare serial and parallel wall time of the API and perf test suites'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--parallel', type=int, default=0, help='Processes for the parallel run (default: cores)')
+        parser.add_argument('--suite', action='append', choices=['api', 'perf'], help='Suite to run (repeatable)')
+
+    def handle(self, *args, **options):
+        parallel = options['parallel'] or default_test_processes()
+        suites = options['suite'] or ['api', 'perf']
+        if 'perf' in suites:
+            self.warm_snapshot()
+
+        self.stdout.write('{0:<8} {1:>12} {2:>14} {3:>9}'.format(
+            'suite', 'serial (s)', 'parallel (s)', 'speedup'))
+        for suite in suites:
+            serial = self.run_suite(suite, 1)
+            concurrent = self.run_suite(suite, parallel)
+            self.stdout.write('{0:<8} {1:>12.2f} {2:>14.2f} {3:>8.2f}x'.format(
+                suite, serial, concurrent, serial / concurrent))
+        self.stdout.write('parallel = {0} processes ({1} cores)'.format(parallel, os.cpu_count()))
+
+    def warm_snapshot(self):
+        scale = seed.seed_settings()['SCALE']
+        if not seed.snapshot_path(scale).exists():
+            self.stdout.write('Creating seed snapshot ({0} vehicles)...'.format(scale))
+            self.run_suite('perf', 1, labels=['api.test_21_performance.SeededDatasetTests'])
+
+    def run_suite(self, suite, parallel, labels=()):
+        command = [sys.executable, str(settings.BASE_DIR / 'manage.py'), 'test', '--noinput', '--parallel', str(parallel), *labels]
+        if suite == 'perf':
+            command += ['--tag', PERF_TAG]
+        start = time.perf_counter()
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        elapsed = time.perf_counter() - start
+        if result.returncode:
+            # 失敗した実行の時間は比べても意味がないので、計測をやめる
+            self.stderr.write(result.stderr)
+            raise CommandError('{0} suite failed with --parallel {1}'.format(suite, parallel))
+        return elapsed
@@ -0,0 +1,329 @@
+import cProfile
+import json
+import random
+import time
+import uuid
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.core.handlers.exception import convert_exception_to_response
+from django.db import connections
+from django.urls import Resolver404, resolve
+from django.utils.cache import patch_vary_headers
+from django.utils.module_loading import import_string
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
+
+from .compression import choose_encoding, compress, compress_stream, compression_settings
+from .slow_queries import SlowQueryWrapper, slow_query_settings
+
+# リクエスト単位でプロファイルを取るミドルウェア
+#
+# 次のどちらかのときだけ、リクエストをcProfileで計測する
+#  ・スタッフユーザがHEADERのヘッダを付けてリクエストしたとき
+#  ・ROUTESに指定したURL名(例: 'api:vehicle-list')へのリクエストのうち、SAMPLE_RATEの割合
+# 結果はDIRECTORYに
+#  ・<id>.prof  … pstats形式の呼び出しグラフ(snakeviz等で開ける)
+#  ・<id>.json  … 実行したSQLとその時間など
+# として保存し、MAX_FILES件を超えたら古いものから削除する
+#
+# settings.pyのAPI_PROFILER['ENABLED']がFalseのときは、ミドルウェア自体が読み込まれない
+
+PROFILER_DEFAULTS = {
+    'ENABLED': False,
+    'HEADER': 'X-Profile',
+    'SAMPLE_RATE': 0.0,
+    'ROUTES': [],
+    'DIRECTORY': 'profiles',
+    'MAX_FILES': 50,
+}
+
+
+def profiler_settings():
+    conf = dict(PROFILER_DEFAULTS)
+    conf.update(getattr(settings, 'API_PROFILER', {}))
+    return conf
+
+
+class QueryRecorder:
+    # connection.execute_wrapper()に渡して、実行したSQLと時間を記録する
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'alias': context['connection'].alias,
+                'sql': sql,
+                'time_ms': round((time.perf_counter() - start) * 1000, 3),
+            })
+
+
+class ProfilerMiddleware:
+
+    def __init__(self, get_response):
+        self.conf = profiler_settings()
+        if not self.conf['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.directory = Path(self.conf['DIRECTORY'])
+        if not self.directory.is_absolute():
+            self.directory = Path(settings.BASE_DIR) / self.directory
+
+    def __call__(self, request):
+        if self.should_profile(request):
+            return self.profile(request)
+        return self.get_response(request)
+
+    def route_name(self, request):
+        try:
+            return resolve(request.path_info).view_name
+        except Resolver404:
+            return None
+
+    def is_staff(self, request):
+        # API はtoken認証なので、セッションのユーザでなければtokenからユーザを確認する
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            return user.is_staff
+        auth = get_authorization_header(request).split()
+        if len(auth) != 2 or auth[0].lower() != b'token':
+            return False
+        try:
+            user, _ = TokenAuthentication().authenticate_credentials(auth[1].decode())
+        except (exceptions.AuthenticationFailed, UnicodeError):
+            return False
+        return user.is_staff
+
+    def should_profile(self, request):
+        if self.conf['HEADER'] in request.headers:
+            return self.is_staff(request)
+        # URLの解決はサンプリングに当たったときだけ行う
+        if self.conf['ROUTES'] and random.random() < self.conf['SAMPLE_RATE']:
+            return self.route_name(request) in self.conf['ROUTES']
+        return False
+
+    def profile(self, request):
+        profile_id = '{0}-{1}'.format(time.strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex[:8])
+        profiler = cProfile.Profile()
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+        elapsed = time.perf_counter() - start
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(str(self.directory / (profile_id + '.prof')))
+        summary = {
+            'id': profile_id,
+            'method': request.method,
+            'path': request.get_full_path(),
+            'route': self.route_name(request),
+            'status': response.status_code,
+            'time_ms': round(elapsed * 1000, 3),
+            'query_count': len(recorder.queries),
+            'query_time_ms': round(sum(query['time_ms'] for query in recorder.queries), 3),
+            'queries': recorder.queries,
+        }
+        with open(self.directory / (profile_id + '.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        self.prune()
+
+        response['X-Profile-Id'] = profile_id
+        return response
+
+    def prune(self):
+        # MAX_FILES件を超えた古いプロファイルを削除する
+        profiles = sorted(self.directory.glob('*.prof'), key=lambda path: path.stat().st_mtime)
+        for path in profiles[:max(len(profiles) - self.conf['MAX_FILES'], 0)]:
+            path.unlink(missing_ok=True)
+            path.with_suffix('.json').unlink(missing_ok=True)
+
+
+# APIのリクエストで実行された遅いSQLを記録するミドルウェア(api.slow_queries)
+# settings.pyのSLOW_QUERY_LOG['ENABLED']がFalseのときは、ミドルウェア自体が読み込まれない
+class SlowQueryMiddleware:
+
+    def __init__(self, get_response):
+        self.conf = slow_query_settings()
+        if not self.conf['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        wrapper = SlowQueryWrapper(self.conf['THRESHOLD_MS'])
+        request._slow_query_wrapper = wrapper
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(wrapper))
+            return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # api配下のViewから実行されたSQLだけを対象にする
+        match = request.resolver_match
+        if match is not None and match.namespace == 'api':
+            request._slow_query_wrapper.view = match.view_name
+
+
+# APIのレスポンスをgzip/brotliで圧縮するミドルウェア(api.compression)
+# Django標準のGZipMiddlewareとの違いは
+#  ・brotliにも対応している
+#  ・レスポンスキャッシュのエントリ(response.precompressed)があれば、圧縮済みのバイト列をそのまま使う
+#  ・対象のパスとContent-Typeを絞っている
+class CompressionMiddleware:
+
+    def __init__(self, get_response):
+        self.conf = compression_settings()
+        if not self.conf['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        return self.compress_response(request, response)
+
+    def is_compressible(self, request, response):
+        if response.status_code != 200 or response.has_header('Content-Encoding'):
+            return False
+        if not any(request.path.startswith(prefix) for prefix in self.conf['PATH_PREFIXES']):
+            return False
+        content_type = response.get('Content-Type', '')
+        return any(content_type.startswith(prefix) for prefix in self.conf['CONTENT_TYPES'])
+
+    def compress_response(self, request, response):
+        if not self.is_compressible(request, response):
+            return response
+        # Accept-Encodingによって中身が変わるので、圧縮しない場合もVaryを付ける
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            # 大きいエクスポートなどは、全体をメモリに載せずにチャンクごとに圧縮する
+            response.streaming_content = compress_stream(response.streaming_content, encoding, self.conf)
+            del response['Content-Length']
+        else:
+            if len(response.content) < self.conf['MIN_SIZE']:
+                return response
+            precompressed = getattr(response, 'precompressed', None)
+            if precompressed is not None:
+                data = precompressed.encoded(encoding)
+            else:
+                data = compress(response.content, encoding, self.conf)
+            if len(data) >= len(response.content):
+                return response
+            response.content = data
+            response['Content-Length'] = str(len(data))
+
+        # 圧縮したら中身のバイト列が変わるので、強いETagは弱いETagにする
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
+        return response
+
+
+# パスによって通すミドルウェアを切り替えるミドルウェア
+#
+# SCOPED_MIDDLEWARE['FULL_ONLY']のミドルウェアを内側に持っていて、
+#  ・LEAN_PATH_PREFIXES(/api/)へのリクエスト … 内側のミドルウェアを通さずに、そのまま次へ渡す
+#  ・それ以外(admin/など) … 内側のミドルウェアを順番に通す(MIDDLEWAREに直接並べたときと同じ動き)
+# /api/ はtoken認証なので、セッション・CSRF・messages・clickjacking対策のミドルウェアはいらない
+# process_view/process_exception/process_template_responseも、/api/ 以外のときだけ内側に渡す
+
+SCOPED_MIDDLEWARE_DEFAULTS = {
+    'LEAN_PATH_PREFIXES': ['/api/'],
+    'FULL_ONLY': [],
+}
+
+
+def scoped_middleware_settings():
+    conf = dict(SCOPED_MIDDLEWARE_DEFAULTS)
+    conf.update(getattr(settings, 'SCOPED_MIDDLEWARE', {}))
+    return conf
+
+
+def expanded_middleware(middleware=None):
+    # PathScopedMiddlewareをFULL_ONLYのミドルウェアに置き換えたリスト(パスで切り替えないときのMIDDLEWARE)
+    middleware = settings.MIDDLEWARE if middleware is None else middleware
+    expanded = []
+    for path in middleware:
+        if path == 'api.middleware.PathScopedMiddleware':
+            expanded.extend(scoped_middleware_settings()['FULL_ONLY'])
+        else:
+            expanded.append(path)
+    return expanded
+
+
+class PathScopedMiddleware:
+
+    def __init__(self, get_response):
+        conf = scoped_middleware_settings()
+        self.get_response = get_response
+        self.lean_prefixes = tuple(conf['LEAN_PATH_PREFIXES'])
+        self.view_hooks = []
+        self.template_response_hooks = []
+        self.exception_hooks = []
+
+        # Djangoのハンドラ(BaseHandler.load_middleware)と同じように、内側から順番に組み立てる
+        handler = get_response
+        for path in reversed(conf['FULL_ONLY']):
+            try:
+                instance = import_string(path)(handler)
+            except MiddlewareNotUsed:
+                continue
+            if instance is None:
+                raise ImproperlyConfigured('Middleware factory {0} returned None.'.format(path))
+            if hasattr(instance, 'process_view'):
+                self.view_hooks.insert(0, instance.process_view)
+            if hasattr(instance, 'process_template_response'):
+                self.template_response_hooks.append(instance.process_template_response)
+            if hasattr(instance, 'process_exception'):
+                self.exception_hooks.append(instance.process_exception)
+            handler = convert_exception_to_response(instance)
+        self.full_chain = handler
+
+    def is_lean(self, request):
+        return bool(self.lean_prefixes) and request.path_info.startswith(self.lean_prefixes)
+
+    def __call__(self, request):
+        if self.is_lean(request):
+            return self.get_response(request)
+        return self.full_chain(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if self.is_lean(request):
+            return None
+        for hook in self.view_hooks:
+            response = hook(request, view_func, view_args, view_kwargs)
+            if response is not None:
+                return response
+        return None
+
+    def process_template_response(self, request, response):
+        if not self.is_lean(request):
+            for hook in self.template_response_hooks:
+                response = hook(request, response)
+        return response
+
+    def process_exception(self, request, exception):
+        if self.is_lean(request):
+            return None
+        for hook in self.exception_hooks:
+            response = hook(request, exception)
+            if response is not None:
+                return response
+        return None
@@ -0,0 +1,31 @@
+from django.db import migrations
+
+
+# unique制約を付ける前に、同じ名前のSegment/Brandを1つにまとめる
+# 一番小さいIDを残し、重複している行を参照しているVehicleを付け替えてから削除する
+def dedupe_names(apps, schema_editor):
+    Vehicle = apps.get_model('api', 'Vehicle')
+    for model_name, relation, name_field in (('Segment', 'segment', 'segment_name'),
+                                             ('Brand', 'brand', 'brand_name')):
+        model = apps.get_model('api', model_name)
+        keep = {}
+        duplicates = {}
+        for pk, name in model.objects.order_by('id').values_list('id', name_field):
+            if name in keep:
+                duplicates[pk] = keep[name]
+            else:
+                keep[name] = pk
+        for duplicate_pk, keep_pk in duplicates.items():
+            Vehicle.objects.filter(**{relation + '_id': duplicate_pk}).update(**{relation + '_id': keep_pk})
+        model.objects.filter(pk__in=list(duplicates)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_names, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_dedupe_brand_segment_names'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='brand',
+            name='brand_name',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='segment',
+            name='segment_name',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+    ]
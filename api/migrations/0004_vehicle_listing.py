@@ -0,0 +1,47 @@
+# Generated by Django 3.2.3 on 2026-10-19 12:17
+
+from django.db import migrations, models
+
+
+# 既存のvehicleから一覧用のテーブルを作る
+def populate_listing(apps, schema_editor):
+    Vehicle = apps.get_model('api', 'Vehicle')
+    VehicleListing = apps.get_model('api', 'VehicleListing')
+    vehicles = Vehicle.objects.select_related('segment', 'brand').order_by('id')
+    VehicleListing.objects.bulk_create([
+        VehicleListing(
+            id=vehicle.id,
+            vehicle_name=vehicle.vehicle_name,
+            release_year=vehicle.release_year,
+            price=vehicle.price,
+            segment_id=vehicle.segment_id,
+            brand_id=vehicle.brand_id,
+            segment_name=vehicle.segment.segment_name,
+            brand_name=vehicle.brand.brand_name,
+        )
+        for vehicle in vehicles.iterator()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_unique_brand_segment_names'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VehicleListing',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('vehicle_name', models.CharField(max_length=100)),
+                ('release_year', models.IntegerField()),
+                ('price', models.DecimalField(decimal_places=2, max_digits=6)),
+                ('segment_id', models.IntegerField(db_index=True)),
+                ('brand_id', models.IntegerField(db_index=True)),
+                ('segment_name', models.CharField(max_length=100)),
+                ('brand_name', models.CharField(max_length=100)),
+            ],
+        ),
+        migrations.RunPython(populate_listing, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.3 on 2026-10-19 12:37
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0005_catalog_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedVehicle',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('vehicle_name', models.CharField(max_length=100)),
+                ('release_year', models.IntegerField()),
+                ('price', models.DecimalField(decimal_places=2, max_digits=6)),
+                ('brand', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_vehicles', to='api.brand')),
+                ('segment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_vehicles', to='api.segment')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_vehicles', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.3 on 2026-10-19 13:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_archived_vehicle'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='vehicle',
+            name='release_year',
+            field=models.IntegerField(db_index=True),
+        ),
+    ]
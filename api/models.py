@@ -3,14 +3,15 @@ from django.contrib.auth.models import User
 
 # Create your models here.
 
+# segment_name, brand_nameは名前からget_or_createできるようにunique制約を付けている
 class Segment(models.Model):
-    segment_name = models.CharField(max_length=100)
+    segment_name = models.CharField(max_length=100, unique=True)
 
     def __str__(self):
         return self.segment_name
 
 class Brand(models.Model):
-    brand_name = models.CharField(max_length=100)
+    brand_name = models.CharField(max_length=100, unique=True)
 
     def __str__(self):
         return self.brand_name
@@ -23,7 +24,8 @@ class Vehicle(models.Model):
         on_delete=models.CASCADE
     )
     vehicle_name = models.CharField(max_length=100)
-    release_year = models.IntegerField()
+    # 古いvehicleをコールドテーブルへ移すとき(api.archive)に、release_yearで絞り込むのでインデックスを付ける
+    release_year = models.IntegerField(db_index=True)
     # priceは小数点以下も使用できるようにdecimalを使う
     # decimal_placesは、小数点以下の桁数を意味する
     # max_digitsは、上記の小数点2桁も含めた最大桁数を意味する
@@ -40,3 +42,60 @@ class Vehicle(models.Model):
 
     def __str__(self):
         return self.vehicle_name
+
+
+# 古いrelease_yearのvehicleを移しておくテーブル(コールドテーブル)
+# 「python manage.py archive_vehicles」でVehicleから移動する。IDはVehicleのときと同じものを使う
+# Vehicleと列の順番をそろえているので、UNIONで両方のテーブルをまとめて読める
+class ArchivedVehicle(models.Model):
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='archived_vehicles'
+    )
+    vehicle_name = models.CharField(max_length=100)
+    release_year = models.IntegerField()
+    price = models.DecimalField(max_digits=6, decimal_places=2)
+    segment = models.ForeignKey(
+        Segment,
+        on_delete=models.CASCADE,
+        related_name='archived_vehicles'
+    )
+    brand = models.ForeignKey(
+        Brand,
+        on_delete=models.CASCADE,
+        related_name='archived_vehicles'
+    )
+
+    def __str__(self):
+        return self.vehicle_name
+
+
+# vehicle一覧の表示用に、brand_nameとsegment_nameを持たせた非正規化テーブル
+# 一覧・詳細をJOINなしの1テーブルで読めるようにするためのもの
+# 中身はapi.listingのシグナルでVehicle/Brand/Segmentの書き込みと同じトランザクションで更新される
+# ずれてしまったときは「python manage.py rebuild_vehicle_listing」で作り直せる
+class VehicleListing(models.Model):
+    # Vehicleと同じIDを使う
+    id = models.IntegerField(primary_key=True)
+    vehicle_name = models.CharField(max_length=100)
+    release_year = models.IntegerField()
+    price = models.DecimalField(max_digits=6, decimal_places=2)
+    segment_id = models.IntegerField(db_index=True)
+    brand_id = models.IntegerField(db_index=True)
+    segment_name = models.CharField(max_length=100)
+    brand_name = models.CharField(max_length=100)
+
+    def __str__(self):
+        return self.vehicle_name
+
+
+# Vehicle/Brand/Segmentのデータのバージョン
+# どれかに書き込みがあると、そのトランザクションがコミットされたあとにversionが1つ進む(api.snapshot)
+# カタログのスナップショットのファイルは、このバージョンをキーにしてキャッシュしている
+class CatalogVersion(models.Model):
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return str(self.version)
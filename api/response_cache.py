@@ -0,0 +1,127 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from . import invalidation
+from .compression import compress
+from .models import Segment, Brand, Vehicle
+
+# segment/brand/vehicleの一覧・詳細のレスポンスをキャッシュする(プロセス内のLRU)
+#
+# キャッシュのキーには世代番号(generation)を含めていて、Vehicle/Brand/Segmentに書き込みがあると
+# 世代番号を1つ進める。古い世代のキーは二度と参照されないので、キーを探して消す必要がない(O(1)の無効化)
+# 古い世代のエントリはLRUで押し出される
+#
+# エントリには圧縮したバイト列も一緒に持たせて、圧縮はエンコーディングごとに1回だけにしている
+#
+# ほかのワーカーでの書き込みは、api.invalidationのバスで伝わってきたときに世代を進める
+#
+# settings.pyのAPI_RESPONSE_CACHE['ENABLED']がTrueのときだけ使われる
+
+DEFAULTS = {
+    'ENABLED': False,
+    'MAX_ENTRIES': 512,
+}
+
+
+def cache_settings():
+    conf = dict(DEFAULTS)
+    conf.update(getattr(settings, 'API_RESPONSE_CACHE', {}))
+    return conf
+
+
+class CachedResponse:
+    # キャッシュの1エントリ(レンダリング済みのバイト列)
+
+    def __init__(self, content, content_type):
+        self.content = content
+        self.content_type = content_type
+        self._encoded = {}
+
+    def encoded(self, encoding):
+        # 圧縮したバイト列を返す。初回だけ圧縮して、以降は保存しておいたものを返す
+        # 同時に圧縮されても結果は同じなので、ロックはしていない
+        data = self._encoded.get(encoding)
+        if data is None:
+            data = self._encoded[encoding] = compress(self.content, encoding)
+        return data
+
+
+class ResponseCache:
+
+    def __init__(self):
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        max_entries = cache_settings()['MAX_ENTRIES']
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def bump(self):
+        # 世代番号を進めて、それまでのエントリをすべて無効にする
+        with self._lock:
+            self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.generation += 1
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'generation': self.generation,
+                'entries': len(self._data),
+                'max_entries': cache_settings()['MAX_ENTRIES'],
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+response_cache = ResponseCache()
+
+
+def invalidate():
+    # 書き込みの直後と、コミットされたあとの両方で世代を進める
+    # (コミット前に古いデータを読んだリクエストが、新しい世代でキャッシュしてしまわないように)
+    response_cache.bump()
+    transaction.on_commit(response_cache.bump)
+
+
+def _invalidate(sender, **kwargs):
+    invalidate()
+
+
+for _model in (Segment, Brand, Vehicle):
+    post_save.connect(_invalidate, sender=_model, dispatch_uid='api.response_cache.save.{0}'.format(_model.__name__))
+    post_delete.connect(_invalidate, sender=_model, dispatch_uid='api.response_cache.delete.{0}'.format(_model.__name__))
+
+
+# ほかのワーカーで書き込みがあったら、このプロセスのキャッシュも無効にする
+invalidation.subscribe(invalidation.TOPICS, response_cache.bump)
@@ -0,0 +1,136 @@
+import hashlib
+import os
+import random
+import sqlite3
+import tempfile
+from decimal import Decimal
+from pathlib import Path
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connections, transaction
+
+from . import listing
+from .models import Segment, Brand, Vehicle
+
+# 性能テスト(api.testing.PERF_TAG)用の大きなデータセットを作る
+#
+# ・同じSCALEなら毎回同じデータになる(乱数のシードを固定している)
+# ・パスワードのハッシュ(PBKDF2)は1回だけ計算して、全ユーザで使い回す
+# ・SQLiteのときは、作ったテストDBをSNAPSHOT_DIRECTORYにファイルとして保存しておき、
+#   次からはマイグレーション・データセットを作るコード・SCALEが変わっていなければ、そのファイルをコピーするだけにする
+# ・並列実行のときは、データを入れたテストDBがワーカーごとに複製される(api.testing.ApiTestRunner)
+
+DEFAULTS = {
+    'SCALE': 5000,
+    'SNAPSHOT_DIRECTORY': '.test_snapshots',
+}
+
+RANDOM_SEED = 20210601
+SEGMENTS = ['Sedan', 'SUV', 'Hatchback', 'Coupe', 'Wagon', 'Pickup', 'Van', 'Convertible']
+BRANDS = 40
+USERS_PER_VEHICLE = 500
+BATCH_SIZE = 1000
+PASSWORD = 'seeded_pw'
+
+
+def seed_settings():
+    conf = dict(DEFAULTS)
+    conf.update(getattr(settings, 'TEST_SEED', {}))
+    directory = Path(conf['SNAPSHOT_DIRECTORY'])
+    if not directory.is_absolute():
+        directory = Path(settings.BASE_DIR) / directory
+    conf['SNAPSHOT_DIRECTORY'] = directory
+    return conf
+
+
+def seed(scale, using='default'):
+    # データセットを作り、{モデル名: 件数}を返す
+    rng = random.Random(RANDOM_SEED)
+    password = make_password(PASSWORD)
+    with transaction.atomic(using=using):
+        User.objects.using(using).bulk_create(
+            [User(username='seeded{0}'.format(i), password=password) for i in range(max(scale // USERS_PER_VEHICLE, 1))])
+        Segment.objects.using(using).bulk_create([Segment(segment_name=name) for name in SEGMENTS])
+        Brand.objects.using(using).bulk_create([Brand(brand_name='Brand {0}'.format(i)) for i in range(BRANDS)])
+        # SQLiteのbulk_createはIDを返さないので読み直す
+        users = list(User.objects.using(using).filter(username__startswith='seeded').values_list('id', flat=True))
+        segments = list(Segment.objects.using(using).values_list('id', flat=True))
+        brands = list(Brand.objects.using(using).values_list('id', flat=True))
+
+        batch = []
+        for i in range(scale):
+            batch.append(Vehicle(
+                user_id=rng.choice(users),
+                vehicle_name='MODEL {0}'.format(i),
+                release_year=rng.randint(1990, 2024),
+                price=Decimal(rng.randint(1000, 999999)) / 100,
+                segment_id=rng.choice(segments),
+                brand_id=rng.choice(brands),
+            ))
+            if len(batch) >= BATCH_SIZE:
+                Vehicle.objects.using(using).bulk_create(batch)
+                batch = []
+        Vehicle.objects.using(using).bulk_create(batch)
+        # bulk_createはシグナルを送らないので、一覧用のテーブルはまとめて作る
+        listing.rebuild(batch_size=BATCH_SIZE, using=using)
+    return counts(using)
+
+
+def counts(using='default'):
+    return {
+        'users': User.objects.using(using).filter(username__startswith='seeded').count(),
+        'segments': Segment.objects.using(using).count(),
+        'brands': Brand.objects.using(using).count(),
+        'vehicles': Vehicle.objects.using(using).count(),
+    }
+
+
+def snapshot_key(scale):
+    # マイグレーション・データセットを作るコード(このファイル・一覧用のテーブル・モデル)・SCALE・
+    # Djangoのバージョンが変わったら別のスナップショットにする
+    digest = hashlib.sha1()
+    digest.update('{0}:{1}'.format(scale, django.get_version()).encode())
+    package = Path(__file__).resolve().parent
+    sources = [Path(__file__).resolve(), package / 'listing.py', package / 'models.py']
+    for path in sorted((package / 'migrations').glob('*.py')) + sources:
+        digest.update(path.name.encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()[:16]
+
+
+def snapshot_path(scale):
+    return seed_settings()['SNAPSHOT_DIRECTORY'] / 'seed-{0}-{1}.sqlite3'.format(scale, snapshot_key(scale))
+
+
+def load(scale, using='default'):
+    # テストDBにデータセットを入れる。スナップショットを使ったときはTrueを返す
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        seed(scale, using)
+        return False
+
+    connection.ensure_connection()
+    path = snapshot_path(scale)
+    if path.exists():
+        # ファイルからテストDB(メモリ上)へページごとコピーする
+        source = sqlite3.connect(str(path))
+        try:
+            source.backup(connection.connection)
+        finally:
+            source.close()
+        return True
+
+    seed(scale, using)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), suffix='.tmp')
+    os.close(fd)
+    target = sqlite3.connect(tmp)
+    try:
+        connection.connection.backup(target)
+    finally:
+        target.close()
+    os.replace(tmp, path)
+    return False
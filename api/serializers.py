@@ -1,6 +1,8 @@
 from rest_framework import serializers
-from .models import Segment, Brand, Vehicle
+from django.db import transaction
+from .models import Segment, Brand, Vehicle, VehicleListing
 from django.contrib.auth.models import User
+from . import lookups
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -35,18 +37,99 @@ class BrandSerializer(serializers.ModelSerializer):
         model = Brand
         fields = ['id', 'brand_name']
 
+# 読み取り時は紐付いているオブジェクトの名前を返し、
+# 書き込み時は受け取った名前をそのままvalidated_dataに入れるフィールド
+# source='*'にすることで、segment(ID)のフィールドとぶつからないようにしている
+class RelatedNameField(serializers.CharField):
+
+    def __init__(self, relation, name_field, **kwargs):
+        self.relation = relation
+        self.name_field = name_field
+        kwargs['source'] = '*'
+        kwargs.setdefault('required', False)
+        kwargs.setdefault('max_length', 100)
+        super().__init__(**kwargs)
+
+    def to_representation(self, instance):
+        return getattr(getattr(instance, self.relation), self.name_field)
+
+    def to_internal_value(self, data):
+        return {self.field_name: super().to_internal_value(data)}
+
+
+# validated_dataの中のsegment_name/brand_nameを、Segment/Brandのインスタンスに置き換える
+# IDが指定されていればIDを優先し、名前だけのときはget_or_createする
+# 呼び出し元のトランザクションの中で実行すること
+def resolve_related_names(validated_data):
+    for relation, model in (('segment', Segment), ('brand', Brand)):
+        name = validated_data.pop(lookups.NAME_FIELDS[model], None)
+        if validated_data.get(relation) is None and name is not None:
+            validated_data[relation] = lookups.get_or_create_by_name(model, name)
+    return validated_data
+
+
 class VehicleSerializer(serializers.ModelSerializer):
-    # ReadOnlyFieldメソッドを使って、紐付いているオブジェクトが持っている特定の属性にアクセスできます
-    segment_name = serializers.ReadOnlyField(source='segment.segment_name', read_only=True)
-    brand_name = serializers.ReadOnlyField(source='brand.brand_name', read_only=True)
+    # ForeignKeyのsegment, brandはIDなので、名前を取得するために'segment_name'と'brand_name'をカスタムで作る
+    # 書き込み時は、IDの代わりに名前を渡すこともできる(存在しなければ作成される)
+    segment_name = RelatedNameField(relation='segment', name_field='segment_name')
+    brand_name = RelatedNameField(relation='brand', name_field='brand_name')
+    # Vehicleオブジェクトを新規作成したとき、ログインしているユーザをUserに自動的に設定する
+    # (更新のときは変えない。レスポンスにも出さない)
+    user = serializers.HiddenField(default=serializers.CreateOnlyDefault(serializers.CurrentUserDefault()))
 
     class Meta:
         model = Vehicle
-        # ForeignKeyのsegment, brandはIDなので、名前を取得するために'segment_name'と'brand_name'をカスタムで作る
-        fields = ['id', 'vehicle_name', 'release_year', 'price', 'segment', 'brand', 'segment_name', 'brand_name']
-        # Vehicleオブジェクトを新規作成したとき、ログインしているユーザをUserに自動的に設定する
+        fields = ['id', 'vehicle_name', 'release_year', 'price', 'segment', 'brand', 'segment_name', 'brand_name',
+                  'user']
         extra_kwargs = {
-            'user': {
-                'read_only': True
-            }
+            # segment_name/brand_nameを渡したときは省略できる
+            'segment': {
+                'required': False
+            },
+            'brand': {
+                'required': False
+            },
         }
+
+    def validate(self, attrs):
+        # 新規作成時は、IDか名前のどちらかが必要
+        if self.instance is None:
+            errors = {}
+            for relation, name_field in (('segment', 'segment_name'), ('brand', 'brand_name')):
+                if attrs.get(relation) is None and not attrs.get(name_field):
+                    errors[relation] = ['Either {0} or {1} is required.'.format(relation, name_field)]
+            if errors:
+                raise serializers.ValidationError(errors)
+        return attrs
+
+    def create(self, validated_data):
+        # 名前からのget_or_createとVehicleの作成を同じトランザクションで行う
+        with transaction.atomic():
+            return super().create(resolve_related_names(validated_data))
+
+    def update(self, instance, validated_data):
+        with transaction.atomic():
+            return super().update(instance, resolve_related_names(validated_data))
+
+
+# 非正規化したvehicle一覧(VehicleListing)用のserializer
+# VehicleSerializerと同じ形のレスポンスを、JOINなしで返す(読み取り専用)
+class VehicleListingSerializer(serializers.ModelSerializer):
+    segment = serializers.IntegerField(source='segment_id', read_only=True)
+    brand = serializers.IntegerField(source='brand_id', read_only=True)
+
+    class Meta:
+        model = VehicleListing
+        fields = ['id', 'vehicle_name', 'release_year', 'price', 'segment', 'brand', 'segment_name', 'brand_name']
+        read_only_fields = fields
+
+
+# バッチリクエスト(/api/batch/)の1件分のサブリクエスト
+class SubRequestSerializer(serializers.Serializer):
+    method = serializers.ChoiceField(choices=['GET', 'HEAD', 'OPTIONS', 'POST', 'PUT', 'PATCH', 'DELETE'])
+    path = serializers.RegexField(r'^/')
+    body = serializers.JSONField(required=False)
+
+
+class BatchRequestSerializer(serializers.Serializer):
+    requests = SubRequestSerializer(many=True, allow_empty=False)
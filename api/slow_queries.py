@@ -0,0 +1,241 @@
+import atexit
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+
+# APIから実行された遅いSQLを集計する
+#
+# api.middleware.SlowQueryMiddlewareがリクエストごとにSlowQueryWrapperをDB接続に差し込み、
+# THRESHOLD_MSを超えたSQLについて
+#  ・正規化したSQLのフィンガープリント
+#  ・実行計画(SQLiteはEXPLAIN QUERY PLAN、PostgreSQL/MySQLはEXPLAIN)
+#  ・どのViewから実行されたか
+# をプロセス内のテーブルに集計する
+# 集計結果は/api/slow-queries/(管理者のみ)で確認でき、
+# DIRECTORYにプロセスごとのJSONとして書き出すので「python manage.py slow_queries」でまとめて表示できる
+# 書き出しはDUMP_INTERVALごとで、間隔内に記録されたものもタイマーとプロセスの終了時(atexit)に書き出す
+
+DEFAULTS = {
+    'ENABLED': False,
+    'THRESHOLD_MS': 100,
+    'TOP_N': 50,
+    'DIRECTORY': 'slow_queries',
+    # JSONを書き出す間隔(秒)
+    'DUMP_INTERVAL': 5,
+}
+
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+
+
+def slow_query_settings():
+    conf = dict(DEFAULTS)
+    conf.update(getattr(settings, 'SLOW_QUERY_LOG', {}))
+    directory = Path(conf['DIRECTORY'])
+    if not directory.is_absolute():
+        directory = Path(settings.BASE_DIR) / directory
+    conf['DIRECTORY'] = directory
+    return conf
+
+
+def normalize_sql(sql):
+    # 値の違いを無視して同じ形のSQLをまとめられるようにする
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    sql = sql.replace('%s', '?')
+    sql = re.sub(r'\bIN \((?:\?\s*,\s*)*\?\)', 'IN (...)', sql, flags=re.IGNORECASE)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+def fingerprint(normalized):
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+
+class SlowQueryLog:
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._last_dump = 0.0
+        # 書き出していない記録があるか
+        self._dirty = False
+        self._timer = None
+
+    def has_plan(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry['plan'] is not None
+
+    def record(self, key, normalized, elapsed_ms, view, plan=None):
+        top_n = slow_query_settings()['TOP_N']
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = {
+                    'fingerprint': key,
+                    'sql': normalized,
+                    'count': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'views': [],
+                    'plan': None,
+                }
+            entry['count'] += 1
+            entry['total_ms'] = round(entry['total_ms'] + elapsed_ms, 3)
+            entry['max_ms'] = max(entry['max_ms'], round(elapsed_ms, 3))
+            entry['last_seen'] = time.time()
+            if view and view not in entry['views']:
+                entry['views'].append(view)
+            if plan is not None:
+                entry['plan'] = plan
+            # 合計時間が小さいものから捨てて、メモリを一定に保つ
+            if len(self._entries) > top_n * 2:
+                for stale in sorted(self._entries.values(), key=lambda e: e['total_ms'])[:len(self._entries) - top_n]:
+                    del self._entries[stale['fingerprint']]
+            self._dirty = True
+        self.maybe_dump()
+
+    def top(self, n=None):
+        n = n or slow_query_settings()['TOP_N']
+        with self._lock:
+            entries = sorted(self._entries.values(), key=lambda e: e['total_ms'], reverse=True)
+            return [dict(entry, views=list(entry['views'])) for entry in entries[:n]]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dirty = False
+            self._cancel_timer()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def maybe_dump(self):
+        conf = slow_query_settings()
+        with self._lock:
+            if not self._dirty:
+                return
+            wait = conf['DUMP_INTERVAL'] - (time.monotonic() - self._last_dump)
+            if wait > 0:
+                # 間隔内に記録されたものは、次の記録を待たずに間隔が過ぎたら書き出す
+                if self._timer is None:
+                    self._timer = threading.Timer(wait, self._dump_on_timer)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            self._mark_dumped()
+        self.dump(conf['DIRECTORY'])
+
+    def _dump_on_timer(self):
+        with self._lock:
+            self._timer = None
+        self.maybe_dump()
+
+    def _mark_dumped(self):
+        self._last_dump = time.monotonic()
+        self._dirty = False
+        self._cancel_timer()
+
+    def flush(self):
+        # 書き出していない記録があれば、間隔に関係なくすぐに書き出す(プロセスの終了時)
+        with self._lock:
+            if not self._dirty:
+                return
+            self._mark_dumped()
+        self.dump(slow_query_settings()['DIRECTORY'])
+
+    def after_fork(self):
+        # forkされた子プロセスにはタイマーのスレッドがないので、作り直せるようにする
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def dump(self, directory):
+        # プロセスごとのファイルに書き出す(一時ファイルに書いてから置き換える)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / 'slow_queries-{0}.json'.format(os.getpid())
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.top(), f, indent=2)
+        os.replace(tmp, path)
+
+
+slow_query_log = SlowQueryLog()
+atexit.register(slow_query_log.flush)
+os.register_at_fork(after_in_child=slow_query_log.after_fork)
+
+
+def load_dumps(directory):
+    # 各プロセスが書き出したJSONを読み込み、フィンガープリントごとにまとめる
+    merged = {}
+    for path in sorted(Path(directory).glob('slow_queries-*.json')):
+        with open(path) as f:
+            for entry in json.load(f):
+                current = merged.get(entry['fingerprint'])
+                if current is None:
+                    merged[entry['fingerprint']] = dict(entry)
+                    continue
+                current['count'] += entry['count']
+                current['total_ms'] = round(current['total_ms'] + entry['total_ms'], 3)
+                current['max_ms'] = max(current['max_ms'], entry['max_ms'])
+                current['views'] = sorted(set(current['views']) | set(entry['views']))
+                current['plan'] = current['plan'] or entry['plan']
+    return sorted(merged.values(), key=lambda e: e['total_ms'], reverse=True)
+
+
+class SlowQueryWrapper:
+    # connection.execute_wrapper()に渡すラッパー
+    # viewはミドルウェアがURLの解決後に設定する
+
+    def __init__(self, threshold_ms, log=slow_query_log):
+        self.threshold_ms = threshold_ms
+        self.log = log
+        self.view = None
+        self._explaining = False
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.view is None or self._explaining:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if elapsed_ms >= self.threshold_ms:
+                self.flag(sql, params, many, context['connection'], elapsed_ms)
+
+    def flag(self, sql, params, many, connection, elapsed_ms):
+        normalized = normalize_sql(sql)
+        key = fingerprint(normalized)
+        plan = None
+        # 実行計画はフィンガープリントごとに1回だけ取る
+        if not many and not self.log.has_plan(key):
+            plan = self.explain(sql, params, connection)
+        self.log.record(key, normalized, elapsed_ms, self.view, plan)
+
+    def explain(self, sql, params, connection):
+        prefix = EXPLAIN_PREFIXES.get(connection.vendor)
+        if prefix is None or not sql.lstrip().upper().startswith('SELECT'):
+            return None
+        # EXPLAINのSQLもこのラッパーを通るので、再帰しないようにする
+        self._explaining = True
+        try:
+            # 失敗してもリクエストのトランザクションを壊さないようにセーブポイントの中で実行する
+            with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+                cursor.execute(prefix + sql, params)
+                return [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+        except Exception as exc:
+            return ['EXPLAIN failed: {0}'.format(exc)]
+        finally:
+            self._explaining = False
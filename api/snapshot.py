@@ -0,0 +1,220 @@
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import BooleanField, F, Value
+from django.db.models.signals import post_delete, post_save
+
+from .db_routers import PRIMARY_DB
+from .models import Segment, Brand, Vehicle, ArchivedVehicle, CatalogVersion
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # pyarrowがインストールされていなければ、スナップショットは作れない
+    pa = pq = None
+
+# 分析用に、Vehicle(+Brand/Segmentの名前)を列指向のファイル(ParquetかArrow IPC)に書き出す
+#
+# ・Vehicleをチャンクごとに読み込み、RecordBatchにして少しずつ書き出す(全件をメモリに載せない)
+# ・コールドテーブルへ移したvehicle(api.archive)もUNION ALLで含め、archivedの列で区別する
+#   (アーカイブを実行しても、分析用のデータから古いvehicleが消えないように)
+# ・priceは固定小数点のdecimal128(6, 2)の列にする
+# ・ファイルはCatalogVersionのバージョンをキーにしてSNAPSHOT_DIRにキャッシュし、
+#   データが変わっていなければ同じファイルをそのまま返す
+# ・バージョンはトランザクションがコミットされたあとに1回だけ進める
+#   (書き込みのトランザクションの中で1行しかないCatalogVersionをロックすると、すべての書き込みが直列になるため)
+# ・レプリカの遅延で古いデータに新しいバージョンを付けないように、バージョンもデータもprimaryから読む
+
+FORMATS = {
+    'parquet': ('.parquet', 'application/vnd.apache.parquet'),
+    'arrow': ('.arrow', 'application/vnd.apache.arrow.file'),
+}
+
+DEFAULTS = {
+    'DIRECTORY': 'snapshots',
+    'BATCH_SIZE': 10000,
+}
+
+# 作っている間にデータが変わったときに作り直す回数
+MAX_ATTEMPTS = 3
+
+
+class SnapshotUnavailable(Exception):
+    pass
+
+
+def snapshot_settings():
+    conf = dict(DEFAULTS)
+    conf.update(getattr(settings, 'CATALOG_SNAPSHOT', {}))
+    directory = Path(conf['DIRECTORY'])
+    if not directory.is_absolute():
+        directory = Path(settings.BASE_DIR) / directory
+    conf['DIRECTORY'] = directory
+    return conf
+
+
+def current_version():
+    version = CatalogVersion.objects.using(PRIMARY_DB).filter(pk=1).values_list('version', flat=True).first()
+    return version or 0
+
+
+def bump_version():
+    # コミットのあとに単独のUPDATEとして実行するので、行のロックはこの文の間しか持たない
+    versions = CatalogVersion.objects.using(PRIMARY_DB)
+    if not versions.filter(pk=1).update(version=F('version') + 1):
+        versions.get_or_create(pk=1, defaults={'version': 1})
+
+
+# まだバージョンを進めていない書き込みの印(スレッド・DBのエイリアスごと)
+_pending = threading.local()
+
+
+class _PendingBump:
+    # 書き込みのたびにon_commitに登録する関数
+    # 同じ印を持つものは、コミットのあとに最初の1つだけがバージョンを進め、残りは何もしない
+
+    def __init__(self, token):
+        self.token = token
+
+    def __call__(self):
+        if self.token['done']:
+            return
+        self.token['done'] = True
+        bump_version()
+
+
+def schedule_bump(using=PRIMARY_DB):
+    # 同じトランザクションで何行書き込んでも、コミットのあとに1回だけバージョンを進める
+    # 毎回登録しておくので、一部の登録がロールバックされたセーブポイントと一緒に捨てられても、
+    # 残った登録でバージョンが進む(全部捨てられたら進まない)
+    # 印はコミットのあとに使い終わり、次の書き込みで新しく作る
+    tokens = _pending.__dict__.setdefault('tokens', {})
+    token = tokens.get(using)
+    if token is None or token['done']:
+        token = tokens[using] = {'done': False}
+    transaction.on_commit(_PendingBump(token), using=using)
+
+
+def schema():
+    return pa.schema([
+        ('id', pa.int64()),
+        ('vehicle_name', pa.string()),
+        ('release_year', pa.int32()),
+        ('price', pa.decimal128(6, 2)),
+        ('segment_id', pa.int64()),
+        ('segment_name', pa.string()),
+        ('brand_id', pa.int64()),
+        ('brand_name', pa.string()),
+        ('archived', pa.bool_()),
+    ])
+
+
+def catalog_rows(model, archived):
+    return (
+        model.objects.using(PRIMARY_DB)
+        .annotate(archived=Value(archived, output_field=BooleanField()))
+        .values_list('id', 'vehicle_name', 'release_year', 'price',
+                     'segment_id', 'segment__segment_name', 'brand_id', 'brand__brand_name', 'archived')
+    )
+
+
+def record_batches(batch_size):
+    # Vehicleとコールドテーブルのvehicleを、ID順にbatch_size件ずつRecordBatchにして返す
+    arrow_schema = schema()
+    rows = (
+        catalog_rows(Vehicle, False).union(catalog_rows(ArchivedVehicle, True), all=True)
+        .order_by('id')
+        .iterator(chunk_size=batch_size)
+    )
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield to_record_batch(batch, arrow_schema)
+            batch = []
+    if batch:
+        yield to_record_batch(batch, arrow_schema)
+
+
+def to_record_batch(rows, arrow_schema):
+    # 行のリストを列ごとの配列に組み替える
+    columns = zip(*rows)
+    return pa.RecordBatch.from_arrays(
+        [pa.array(column, type=field.type) for field, column in zip(arrow_schema, columns)],
+        schema=arrow_schema,
+    )
+
+
+def write_snapshot(path, fmt, batch_size):
+    if fmt == 'parquet':
+        with pq.ParquetWriter(str(path), schema()) as writer:
+            for batch in record_batches(batch_size):
+                writer.write_batch(batch)
+    else:
+        with pa.OSFile(str(path), 'wb') as sink, pa.ipc.new_file(sink, schema()) as writer:
+            for batch in record_batches(batch_size):
+                writer.write_batch(batch)
+
+
+def snapshot_path(fmt, version=None):
+    conf = snapshot_settings()
+    version = current_version() if version is None else version
+    return conf['DIRECTORY'] / 'catalog-v{0}{1}'.format(version, FORMATS[fmt][0])
+
+
+def get_snapshot(fmt):
+    # 今のバージョンのスナップショットを(パス, バージョン, キャッシュしたかどうか)で返す。なければ作る
+    if pa is None:
+        raise SnapshotUnavailable('pyarrow is not installed')
+    conf = snapshot_settings()
+    conf['DIRECTORY'].mkdir(parents=True, exist_ok=True)
+    for attempt in range(MAX_ATTEMPTS):
+        version = current_version()
+        path = snapshot_path(fmt, version)
+        if path.exists():
+            return path, version, True
+        tmp = build(fmt, conf)
+        if current_version() == version:
+            os.replace(tmp, path)
+            remove_old_snapshots(fmt, keep=path)
+            return path, version, True
+        # 作っている間にデータが変わったので、このバージョンのファイルとしては残さずに作り直す
+        if attempt < MAX_ATTEMPTS - 1:
+            os.unlink(tmp)
+    # 書き込みが続いて落ち着かないときは、最後に作ったファイルをキャッシュせずに返す
+    return Path(tmp), version, False
+
+
+def build(fmt, conf):
+    # 一時ファイルに書き出して、そのパスを返す
+    fd, tmp = tempfile.mkstemp(dir=str(conf['DIRECTORY']), suffix='.tmp')
+    os.close(fd)
+    try:
+        write_snapshot(tmp, fmt, conf['BATCH_SIZE'])
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return tmp
+
+
+def remove_old_snapshots(fmt, keep):
+    for old in keep.parent.glob('catalog-v*' + FORMATS[fmt][0]):
+        if old != keep:
+            try:
+                old.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def _bump(sender, using=PRIMARY_DB, **kwargs):
+    schedule_bump(using)
+
+
+for _model in (Segment, Brand, Vehicle):
+    post_save.connect(_bump, sender=_model, dispatch_uid='api.snapshot.save.{0}'.format(_model.__name__))
+    post_delete.connect(_bump, sender=_model, dispatch_uid='api.snapshot.delete.{0}'.format(_model.__name__))
@@ -0,0 +1,78 @@
+# リクエスト単位のプロファイラのテストコードを書くファイル
+import json
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from .testing import temp_directory
+
+# エンドポイントをあらかじめ定義しておく
+VEHICLES_URL = '/api/vehicles/'
+
+
+class ProfilerMiddlewareTests(TestCase):
+
+    def setUp(self):
+        self.directory = temp_directory(self)
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.token = Token.objects.create(user=self.user)
+
+    def profiler_settings(self, **params):
+        conf = {'ENABLED': True, 'DIRECTORY': self.directory, 'MAX_FILES': 2}
+        conf.update(params)
+        return override_settings(API_PROFILER=conf)
+
+    def get(self, **headers):
+        # ミドルウェアはclientの最初のリクエストで読み込まれるので、毎回clientを作る
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+        return client.get(VEHICLES_URL, **headers)
+
+    # スタッフユーザがヘッダを付けると、プロファイルとSQLが保存される
+    def test_10_1_should_profile_staff_request_with_header(self):
+        self.user.is_staff = True
+        self.user.save()
+        with self.profiler_settings():
+            res = self.get(HTTP_X_PROFILE='1')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        profile_id = res['X-Profile-Id']
+        self.assertTrue((self.directory / (profile_id + '.prof')).exists())
+
+        with open(self.directory / (profile_id + '.json')) as f:
+            summary = json.load(f)
+        self.assertEqual(summary['route'], 'api:vehicle-list')
+        self.assertGreater(summary['query_count'], 0)
+        self.assertIn('api_vehicle', ' '.join(query['sql'] for query in summary['queries']))
+
+    # スタッフでなければ、ヘッダを付けてもプロファイルしない
+    def test_10_2_should_not_profile_non_staff_request(self):
+        with self.profiler_settings():
+            res = self.get(HTTP_X_PROFILE='1')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertNotIn('X-Profile-Id', res)
+
+    # ROUTESに指定したURLはサンプリングでプロファイルされる
+    def test_10_3_should_profile_sampled_route(self):
+        with self.profiler_settings(SAMPLE_RATE=1.0, ROUTES=['api:vehicle-list']):
+            res = self.get()
+        self.assertIn('X-Profile-Id', res)
+
+        with self.profiler_settings(SAMPLE_RATE=1.0, ROUTES=['api:brand-list']):
+            res = self.get()
+        self.assertNotIn('X-Profile-Id', res)
+
+    # MAX_FILESを超えたら古いものから削除される
+    def test_10_4_should_keep_directory_bounded(self):
+        with self.profiler_settings(SAMPLE_RATE=1.0, ROUTES=['api:vehicle-list']):
+            for _ in range(4):
+                self.get()
+        self.assertEqual(len(list(self.directory.glob('*.prof'))), 2)
+        self.assertEqual(len(list(self.directory.glob('*.json'))), 2)
+
+    # 無効のときはミドルウェア自体が使われない
+    def test_10_5_should_not_profile_when_disabled(self):
+        self.user.is_staff = True
+        self.user.save()
+        res = self.get(HTTP_X_PROFILE='1')
+        self.assertNotIn('X-Profile-Id', res)
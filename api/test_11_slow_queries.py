@@ -0,0 +1,107 @@
+# 遅いSQLのログのテストコードを書くファイル
+import json
+import time
+from io import StringIO
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from .slow_queries import SlowQueryLog, load_dumps, normalize_sql, slow_query_log
+from .testing import enable_settings, temp_directory
+
+# エンドポイントをあらかじめ定義しておく
+VEHICLES_URL = '/api/vehicles/'
+SLOW_QUERIES_URL = '/api/slow-queries/'
+
+
+class NormalizeSqlTests(TestCase):
+
+    # 値が違うだけのSQLは同じ形になる
+    def test_11_1_should_normalize_literals(self):
+        self.assertEqual(
+            normalize_sql("SELECT * FROM api_vehicle WHERE id IN (1, 2, 3) AND  vehicle_name = 'A'"),
+            normalize_sql("SELECT * FROM api_vehicle WHERE id IN (%s, %s) AND vehicle_name = %s"),
+        )
+
+
+class SlowQueryLogTests(TestCase):
+
+    def setUp(self):
+        slow_query_log.clear()
+        self.directory = temp_directory(self)
+        # 閾値を0にして、すべてのSQLを遅いSQLとして扱う
+        enable_settings(self, SLOW_QUERY_LOG={
+            'ENABLED': True, 'THRESHOLD_MS': 0, 'DIRECTORY': self.directory, 'DUMP_INTERVAL': 0,
+        })
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=self.user).key)
+
+    def tearDown(self):
+        slow_query_log.clear()
+
+    def vehicle_entry(self, entries):
+        return next(entry for entry in entries if 'FROM "api_vehicle"' in entry['sql'])
+
+    # APIから実行したSQLが、Viewと実行計画と一緒に記録される
+    def test_11_2_should_record_api_queries_with_plan(self):
+        res = self.client.get(VEHICLES_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+        entry = self.vehicle_entry(slow_query_log.top())
+        self.assertEqual(entry['views'], ['api:vehicle-list'])
+        self.assertEqual(entry['count'], 1)
+        self.assertIn('SCAN', ' '.join(entry['plan']))
+
+    # 集計は管理者だけが見られる
+    def test_11_3_should_get_slow_queries_only_for_staff(self):
+        res = self.client.get(SLOW_QUERIES_URL)
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.user.is_staff = True
+        self.user.save()
+        self.client.get(VEHICLES_URL)
+        res = self.client.get(SLOW_QUERIES_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.vehicle_entry(res.data)['views'], ['api:vehicle-list'])
+
+    # コマンドでワーカーが書き出した集計を表示できる
+    def test_11_4_should_dump_with_command(self):
+        self.client.get(VEHICLES_URL)
+        out = StringIO()
+        call_command('slow_queries', '--json', stdout=out)
+        entry = self.vehicle_entry(json.loads(out.getvalue()))
+        self.assertEqual(entry['views'], ['api:vehicle-list'])
+
+
+class SlowQueryDumpTests(TestCase):
+
+    def setUp(self):
+        self.directory = temp_directory(self)
+        enable_settings(self, SLOW_QUERY_LOG={'DIRECTORY': self.directory, 'DUMP_INTERVAL': 0.2})
+        self.log = SlowQueryLog()
+        self.addCleanup(self.log.clear)
+
+    def dumped_count(self):
+        return sum(entry['count'] for entry in load_dumps(self.directory))
+
+    # 間隔内に記録されたものも、次の記録を待たずにタイマーで書き出される
+    def test_11_5_should_dump_pending_entries_on_timer(self):
+        self.log.record('a', 'SELECT ?', 1, 'api:vehicle-list')
+        self.assertEqual(self.dumped_count(), 1)
+        self.log.record('a', 'SELECT ?', 1, 'api:vehicle-list')
+        self.assertEqual(self.dumped_count(), 1)
+
+        deadline = time.monotonic() + 5
+        while self.dumped_count() < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.dumped_count(), 2)
+
+    # プロセスの終了時(flush)には、間隔に関係なく書き出される
+    def test_11_6_should_dump_pending_entries_on_flush(self):
+        self.log.record('a', 'SELECT ?', 1, 'api:vehicle-list')
+        self.log.record('a', 'SELECT ?', 1, 'api:vehicle-list')
+        self.log.flush()
+        self.assertEqual(self.dumped_count(), 2)
@@ -0,0 +1,105 @@
+# 非正規化したvehicle一覧(VehicleListing)のテストコードを書くファイル
+from io import StringIO
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from .models import Vehicle, VehicleListing, Brand, Segment
+from .serializers import VehicleSerializer
+from .testing import create_vehicle
+from .views import AtomicWriteMixin
+
+# エンドポイントをあらかじめ定義しておく
+VEHICLES_URL = '/api/vehicles/'
+
+
+class VehicleListingTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.segment = Segment.objects.create(segment_name='Sedan')
+        self.brand = Brand.objects.create(brand_name='Tesla')
+
+    # Vehicleを作成すると一覧用の行もできる
+    def test_12_1_should_sync_on_vehicle_write(self):
+        vehicle = create_vehicle(self.user, self.segment, self.brand)
+        listing = VehicleListing.objects.get(id=vehicle.id)
+        self.assertEqual(listing.brand_name, 'Tesla')
+        self.assertEqual(listing.segment_name, 'Sedan')
+
+        vehicle.vehicle_name = 'MODEL X'
+        vehicle.save()
+        self.assertEqual(VehicleListing.objects.get(id=vehicle.id).vehicle_name, 'MODEL X')
+
+        vehicle.delete()
+        self.assertFalse(VehicleListing.objects.exists())
+
+    # Brand/Segmentの名前を変更すると一覧用の行にも反映される
+    def test_12_2_should_sync_on_rename(self):
+        vehicle = create_vehicle(self.user, self.segment, self.brand)
+        self.client.patch(reverse('api:brand-detail', args=[self.brand.id]), {'brand_name': 'Lexus'})
+        self.client.patch(reverse('api:segment-detail', args=[self.segment.id]), {'segment_name': 'SUV'})
+        listing = VehicleListing.objects.get(id=vehicle.id)
+        self.assertEqual(listing.brand_name, 'Lexus')
+        self.assertEqual(listing.segment_name, 'SUV')
+
+    # Brandを削除すると、カスケードで削除されたvehicleの行も消える
+    def test_12_3_should_sync_on_cascade_delete(self):
+        create_vehicle(self.user, self.segment, self.brand)
+        self.client.delete(reverse('api:brand-detail', args=[self.brand.id]))
+        self.assertFalse(VehicleListing.objects.exists())
+
+    # 一覧・詳細を非正規化したテーブルからJOINなしで読み、レスポンスは同じ形になる
+    @override_settings(VEHICLE_LISTING_READ_MODEL=True)
+    def test_12_4_should_read_from_listing(self):
+        vehicle = create_vehicle(self.user, self.segment, self.brand)
+        create_vehicle(self.user, self.segment, self.brand, vehicle_name='MODEL X')
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get(VEHICLES_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        serializer = VehicleSerializer(Vehicle.objects.all().order_by('id'), many=True)
+        self.assertEqual(res.data, serializer.data)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('"api_vehiclelisting"', queries[0]['sql'])
+        self.assertNotIn('JOIN', queries[0]['sql'])
+
+        res = self.client.get(reverse('api:vehicle-detail', args=[vehicle.id]))
+        self.assertEqual(res.data, VehicleSerializer(vehicle).data)
+
+    # コマンドで作り直せる
+    def test_12_5_should_rebuild_with_command(self):
+        create_vehicle(self.user, self.segment, self.brand)
+        Brand.objects.filter(id=self.brand.id).update(brand_name='Lexus')
+        out = StringIO()
+        call_command('rebuild_vehicle_listing', stdout=out)
+        self.assertIn('1', out.getvalue())
+        self.assertEqual(VehicleListing.objects.get().brand_name, 'Lexus')
+
+    # APIからの作成はAtomicWriteMixinのトランザクションの中で保存され、ログイン中のユーザが設定される
+    # (更新ではユーザは変わらない)
+    def test_12_6_should_create_vehicle_in_atomic_write(self):
+        payload = {'vehicle_name': 'MODEL S', 'release_year': 2019, 'price': 500,
+                   'segment': self.segment.id, 'brand': self.brand.id}
+        with mock.patch.object(AtomicWriteMixin, 'perform_create', autospec=True,
+                               side_effect=AtomicWriteMixin.perform_create) as perform_create:
+            res = self.client.post(VEHICLES_URL, payload)
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        perform_create.assert_called_once()
+        self.assertNotIn('user', res.data)
+        vehicle = Vehicle.objects.get(id=res.data['id'])
+        self.assertEqual(vehicle.user, self.user)
+        self.assertTrue(VehicleListing.objects.filter(id=vehicle.id).exists())
+
+        other = APIClient()
+        other.force_authenticate(get_user_model().objects.create_user(username='other', password='dummy_pw'))
+        res = other.put(reverse('api:vehicle-detail', args=[vehicle.id]), dict(payload, vehicle_name='MODEL X'))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        vehicle.refresh_from_db()
+        self.assertEqual(vehicle.user, self.user)
@@ -0,0 +1,74 @@
+# APIのレスポンスの圧縮のテストコードを書くファイル
+import gzip
+from unittest import mock, skipIf
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from rest_framework import status
+from rest_framework.test import APIClient
+from . import compression
+from .models import Brand
+from .response_cache import response_cache
+
+# エンドポイントをあらかじめ定義しておく
+BRANDS_URL = '/api/brands/'
+
+
+class CompressionMiddlewareTests(TestCase):
+
+    def setUp(self):
+        response_cache.clear()
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # 圧縮の対象になる大きさのレスポンスにする
+        Brand.objects.bulk_create([Brand(brand_name='Brand {0}'.format(i)) for i in range(100)])
+
+    def tearDown(self):
+        response_cache.clear()
+
+    # Accept-Encodingのq値を見てエンコーディングを選ぶ
+    def test_13_1_should_choose_encoding(self):
+        self.assertEqual(compression.choose_encoding('gzip, deflate'), 'gzip')
+        self.assertIsNone(compression.choose_encoding('identity'))
+        self.assertIsNone(compression.choose_encoding('gzip;q=0'))
+        if compression.brotli is not None:
+            self.assertEqual(compression.choose_encoding('gzip, br'), 'br')
+            self.assertEqual(compression.choose_encoding('gzip;q=1.0, br;q=0.5'), 'gzip')
+
+    # gzipで圧縮され、展開すると元のJSONになる
+    def test_13_2_should_compress_with_gzip(self):
+        plain = self.client.get(BRANDS_URL)
+        res = self.client.get(BRANDS_URL, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res['Vary'])
+        self.assertEqual(gzip.decompress(res.content), plain.content)
+
+    @skipIf(compression.brotli is None, 'brotli is not installed')
+    def test_13_3_should_compress_with_brotli(self):
+        plain = self.client.get(BRANDS_URL)
+        res = self.client.get(BRANDS_URL, HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(res['Content-Encoding'], 'br')
+        self.assertEqual(compression.brotli.decompress(res.content), plain.content)
+
+    # MIN_SIZEより小さいレスポンスは圧縮しない
+    def test_13_4_should_not_compress_small_response(self):
+        res = self.client.get('/api/profile/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(res.has_header('Content-Encoding'))
+
+    # キャッシュされたレスポンスは、1回だけ圧縮してあとは圧縮済みのバイト列を使う
+    @override_settings(API_RESPONSE_CACHE={'ENABLED': True})
+    def test_13_5_should_reuse_precompressed_cache_entry(self):
+        with mock.patch('api.response_cache.compress', wraps=compression.compress) as compress:
+            first = self.client.get(BRANDS_URL, HTTP_ACCEPT_ENCODING='gzip')
+            second = self.client.get(BRANDS_URL, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(compress.call_count, 1)
+        self.assertEqual(response_cache.hits, 1)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(second['Content-Encoding'], 'gzip')
+
+    # ストリーミングのレスポンスはチャンクごとに圧縮する
+    def test_13_6_should_compress_stream(self):
+        chunks = [b'{"a": 1}\n' * 100, b'{"b": 2}\n' * 100]
+        data = b''.join(compression.compress_stream(iter(chunks), 'gzip'))
+        self.assertEqual(gzip.decompress(data), b''.join(chunks))
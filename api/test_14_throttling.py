@@ -0,0 +1,105 @@
+# 共有メモリを使うスロットルのテストコードを書くファイル
+import os
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from rest_framework import status
+from rest_framework.test import APIClient
+from .testing import temp_directory
+from .throttling import DEFAULTS, SharedBuckets, SharedMemoryThrottle, throttle_settings
+
+# エンドポイントをあらかじめ定義しておく
+BRANDS_URL = '/api/brands/'
+SEGMENTS_URL = '/api/segments/'
+TOKEN_URL = '/api/auth/'
+
+
+class SharedBucketsTests(TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(temp_directory(self), 'throttle')
+
+    # 容量を使い切ったら待ち時間が返り、時間が経つと回復する
+    def test_14_1_should_refill_tokens(self):
+        buckets = SharedBuckets(self.path, 64)
+        self.addCleanup(buckets.close)
+        self.assertEqual(buckets.consume('user:1', 2, 1.0, now=100.0), 0)
+        self.assertEqual(buckets.consume('user:1', 2, 1.0, now=100.0), 0)
+        self.assertAlmostEqual(buckets.consume('user:1', 2, 1.0, now=100.0), 1.0)
+        self.assertEqual(buckets.consume('user:1', 2, 1.0, now=101.0), 0)
+        # ほかのキーには影響しない
+        self.assertEqual(buckets.consume('user:2', 2, 1.0, now=101.0), 0)
+
+    # 同じファイルを開いた別のテーブル(別のワーカー)とも状態を共有する
+    def test_14_2_should_share_state_between_mappings(self):
+        first = SharedBuckets(self.path, 64)
+        second = SharedBuckets(self.path, 64)
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+        self.assertEqual(first.consume('user:1', 1, 0.5, now=100.0), 0)
+        self.assertAlmostEqual(second.consume('user:1', 1, 0.5, now=100.0), 2.0)
+
+
+class ThrottleSettingsTests(TestCase):
+
+    # 何も指定しなければ無効で、ファイルはプロジェクトとsettingsごとに分かれる
+    def test_14_3_should_be_disabled_and_scoped_by_default(self):
+        self.assertFalse(DEFAULTS['ENABLED'])
+        with override_settings(API_THROTTLE={}):
+            conf = throttle_settings()
+            self.assertFalse(conf['ENABLED'])
+            path = conf['PATH']
+        self.assertRegex(os.path.basename(path), r'^rest_api-throttle-[0-9a-f]{12}$')
+        with override_settings(API_THROTTLE={}, SETTINGS_MODULE='rest_api.other_settings'):
+            self.assertNotEqual(throttle_settings()['PATH'], path)
+
+
+class ThrottleApiTests(TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(temp_directory(self), 'throttle')
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def throttle_settings(self, **params):
+        conf = {'ENABLED': True, 'PATH': self.path, 'USER_RATE': None, 'ROUTE_RATES': {}}
+        conf.update(params)
+        return override_settings(API_THROTTLE=conf)
+
+    # URL名ごとの制限を超えると429とRetry-Afterが返る
+    def test_14_4_should_throttle_route(self):
+        with self.throttle_settings(ROUTE_RATES={'api:brand-list': '2/min'}):
+            for _ in range(2):
+                self.assertEqual(self.client.get(BRANDS_URL).status_code, status.HTTP_200_OK)
+            res = self.client.get(BRANDS_URL)
+            self.assertEqual(res.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(res['Retry-After'], '30')
+            # ほかのURLは制限されない
+            self.assertEqual(self.client.get(SEGMENTS_URL).status_code, status.HTTP_200_OK)
+
+    # ユーザごとの制限はすべてのURLで共通
+    def test_14_5_should_throttle_user(self):
+        with self.throttle_settings(USER_RATE='2/hour'):
+            self.client.get(BRANDS_URL)
+            self.client.get(SEGMENTS_URL)
+            res = self.client.get(BRANDS_URL)
+            self.assertEqual(res.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    # tokenの取得(/api/auth/)も制限される
+    def test_14_6_should_throttle_token_endpoint(self):
+        client = APIClient()
+        payload = {'username': 'dummy', 'password': 'wrong_pw'}
+        with self.throttle_settings(ROUTE_RATES={'api:auth': '1/min'}):
+            self.assertEqual(client.post(TOKEN_URL, payload).status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(client.post(TOKEN_URL, payload).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    # 無効にすれば制限しない
+    def test_14_7_should_not_throttle_when_disabled(self):
+        with self.throttle_settings(ENABLED=False, ROUTE_RATES={'api:brand-list': '1/min'}):
+            for _ in range(3):
+                self.assertEqual(self.client.get(BRANDS_URL).status_code, status.HTTP_200_OK)
+
+    # ベースクラスはレートとキーを決めていないので、そのままでは使えない
+    def test_14_8_should_not_instantiate_base_throttle(self):
+        with self.assertRaises(TypeError):
+            SharedMemoryThrottle()
@@ -0,0 +1,164 @@
+# 列指向スナップショット(Parquet/Arrow IPC)のテストコードを書くファイル
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock, skipIf
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from . import archive, snapshot
+from . import db_routers
+from .models import Vehicle, Brand, Segment
+from .testing import enable_settings, temp_directory
+
+# エンドポイントをあらかじめ定義しておく
+SNAPSHOT_URL = reverse('api:vehicle-snapshot')
+
+
+@skipIf(snapshot.pa is None, 'pyarrow is not installed')
+class CatalogSnapshotTests(TestCase):
+
+    def setUp(self):
+        self.directory = temp_directory(self)
+        enable_settings(self, CATALOG_SNAPSHOT={'DIRECTORY': self.directory, 'BATCH_SIZE': 2})
+
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # バージョンはコミットのあとに進むので、テストのトランザクションの中ではコミットされたことにする
+        with self.captureOnCommitCallbacks(execute=True):
+            segment = Segment.objects.create(segment_name='Sedan')
+            brand = Brand.objects.create(brand_name='Tesla')
+            for i, name in enumerate(['MODEL S', 'MODEL 3', 'MODEL X']):
+                Vehicle.objects.create(user=self.user, segment=segment, brand=brand, vehicle_name=name,
+                                       release_year=2017 + i, price='1234.56')
+
+    def download(self, fmt, **headers):
+        res = self.client.get(SNAPSHOT_URL, {'type': fmt}, **headers)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return res, b''.join(res.streaming_content)
+
+    # Parquetでダウンロードでき、名前のJOINと固定小数点のpriceが入っている
+    def test_15_1_should_export_parquet(self):
+        res, content = self.download('parquet')
+        table = snapshot.pq.read_table(BytesIO(content))
+        self.assertEqual(table.num_rows, 3)
+        self.assertEqual(table.schema.field('price').type, snapshot.pa.decimal128(6, 2))
+        self.assertEqual(table.column('price').to_pylist(), [Decimal('1234.56')] * 3)
+        self.assertEqual(table.column('brand_name').to_pylist(), ['Tesla'] * 3)
+        self.assertEqual(table.column('vehicle_name').to_pylist(), ['MODEL S', 'MODEL 3', 'MODEL X'])
+
+    # Arrow IPCでダウンロードでき、BATCH_SIZEごとのRecordBatchに分かれている
+    def test_15_2_should_export_arrow_in_batches(self):
+        res, content = self.download('arrow')
+        reader = snapshot.pa.ipc.open_file(snapshot.pa.BufferReader(content))
+        self.assertEqual(reader.num_record_batches, 2)
+        self.assertEqual(reader.read_all().column('segment_name').to_pylist(), ['Sedan'] * 3)
+
+    # データが変わらなければ同じファイルを使い、変われば作り直す
+    def test_15_3_should_cache_by_version(self):
+        res, _ = self.download('parquet')
+        etag = res['ETag']
+        res = self.client.get(SNAPSHOT_URL, {'type': 'parquet'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Vehicle.objects.filter(vehicle_name='MODEL X').get().delete()
+        res, content = self.download('parquet')
+        self.assertNotEqual(res['ETag'], etag)
+        self.assertEqual(snapshot.pq.read_table(BytesIO(content)).num_rows, 2)
+        # 古いバージョンのファイルは消えている
+        self.assertEqual(len(list(self.directory.glob('*.parquet'))), 1)
+
+    # ログインしていなければダウンロードできない
+    def test_15_4_should_require_authentication(self):
+        res = APIClient().get(SNAPSHOT_URL)
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    # 知らない形式は400
+    def test_15_5_should_reject_unknown_type(self):
+        res = self.client.get(SNAPSHOT_URL, {'type': 'csv'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    # コマンドで指定したパスに書き出せる
+    def test_15_6_should_export_with_command(self):
+        output = self.directory / 'out.arrow'
+        out = StringIO()
+        call_command('export_catalog_snapshot', '--type', 'arrow', '--output', str(output), stdout=out)
+        self.assertIn('Wrote catalog snapshot', out.getvalue())
+        self.assertEqual(snapshot.pa.ipc.open_file(str(output)).read_all().num_rows, 3)
+
+    # コールドテーブルへ移したvehicleも、archivedの列を付けて含める
+    def test_15_7_should_include_archived_vehicles(self):
+        res, _ = self.download('parquet')
+        etag = res['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            archive.archive(before=2018)
+        res, content = self.download('parquet')
+        self.assertNotEqual(res['ETag'], etag)
+        table = snapshot.pq.read_table(BytesIO(content))
+        self.assertEqual(table.column('vehicle_name').to_pylist(), ['MODEL S', 'MODEL 3', 'MODEL X'])
+        self.assertEqual(table.column('archived').to_pylist(), [True, False, False])
+        self.assertEqual(table.column('brand_name').to_pylist(), ['Tesla'] * 3)
+
+
+class CatalogVersionTests(TestCase):
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.segment = Segment.objects.create(segment_name='Sedan')
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+
+    # 1つのトランザクションで何行書き込んでも、コミットのあとに1回だけバージョンが進む
+    def test_15_8_should_bump_once_per_transaction(self):
+        version = snapshot.current_version()
+        with mock.patch.object(snapshot, 'bump_version', wraps=snapshot.bump_version) as bump_version:
+            with self.captureOnCommitCallbacks(execute=True):
+                brand = Brand.objects.create(brand_name='Tesla')
+                for name in ['MODEL S', 'MODEL 3', 'MODEL X']:
+                    Vehicle.objects.create(user=self.user, segment=self.segment, brand=brand, vehicle_name=name,
+                                           release_year=2020, price=500)
+                # コミットされるまではバージョンは変わらない
+                self.assertEqual(snapshot.current_version(), version)
+        bump_version.assert_called_once_with()
+        self.assertEqual(snapshot.current_version(), version + 1)
+
+    # ロールバックされたセーブポイントの書き込みではバージョンは進まないが、そのあとの書き込みでは進む
+    def test_15_9_should_bump_after_rolled_back_savepoint(self):
+        version = snapshot.current_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    Brand.objects.create(brand_name='Tesla')
+                    raise ValueError
+            except ValueError:
+                pass
+            Brand.objects.create(brand_name='BYD')
+        self.assertEqual(snapshot.current_version(), version + 1)
+
+    # レプリカへのルーティング中でも、バージョンはprimaryから読む
+    @override_settings(REPLICA_DATABASES=['replica'])
+    def test_15_10_should_read_version_from_primary(self):
+        version = snapshot.current_version()
+        db_routers.use_replica()
+        self.addCleanup(db_routers.reset)
+        self.assertEqual(snapshot.current_version(), version)
+
+    # 書き込みがすべてロールバックされたらバージョンは進まず、次のトランザクションでは進む
+    def test_15_11_should_bump_after_rolled_back_transaction(self):
+        version = snapshot.current_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    Brand.objects.create(brand_name='Tesla')
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(snapshot.current_version(), version)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Brand.objects.create(brand_name='BYD')
+        self.assertEqual(snapshot.current_version(), version + 1)
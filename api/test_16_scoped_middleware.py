@@ -0,0 +1,62 @@
+# パスによってミドルウェアを切り替える(PathScopedMiddleware)テストコードを書くファイル
+from unittest import skipUnless
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import Client, TestCase, override_settings
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from .middleware import expanded_middleware
+
+# エンドポイントをあらかじめ定義しておく
+SEGMENTS_URL = '/api/segments/'
+ADMIN_URL = '/admin/'
+ADMIN_LOGIN_URL = '/admin/login/'
+
+
+@skipUnless(apps.is_installed('django.contrib.admin'), 'admin is not installed')
+@override_settings(ROOT_URLCONF='rest_api.urls')
+class PathScopedMiddlewareTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw', is_staff=True,
+                                                         is_superuser=True)
+        self.token = Token.objects.create(user=self.user)
+
+    # /api/ にはセッション・clickjackingのミドルウェアが使われない
+    def test_16_1_should_skip_full_only_middleware_for_api(self):
+        res = self.client.get(SEGMENTS_URL, HTTP_AUTHORIZATION='Token ' + self.token.key)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertFalse(res.has_header('X-Frame-Options'))
+        self.assertFalse(hasattr(res.wsgi_request, 'session'))
+
+    # admin/ にはすべてのミドルウェアが使われる
+    def test_16_2_should_use_full_chain_for_admin(self):
+        res = self.client.get(ADMIN_LOGIN_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['X-Frame-Options'], 'DENY')
+        self.assertIn('csrftoken', res.cookies)
+
+        self.client.force_login(self.user)
+        res = self.client.get(ADMIN_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    # admin/ ではCSRFのチェック(process_view)も行われる
+    def test_16_3_should_check_csrf_for_admin(self):
+        client = Client(enforce_csrf_checks=True)
+        res = client.post(ADMIN_LOGIN_URL, {'username': 'dummy', 'password': 'dummy_pw'})
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+    # /api/ はtoken認証なので、CSRFトークンがなくても書き込める
+    def test_16_4_should_not_check_csrf_for_api(self):
+        client = Client(enforce_csrf_checks=True)
+        res = client.post(SEGMENTS_URL, {'segment_name': 'Sedan'}, HTTP_AUTHORIZATION='Token ' + self.token.key)
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+
+    # パスで切り替えないときのMIDDLEWAREには、FULL_ONLYがPathScopedMiddlewareの位置に入る
+    def test_16_5_should_expand_middleware(self):
+        expanded = expanded_middleware()
+        self.assertNotIn('api.middleware.PathScopedMiddleware', expanded)
+        start = settings.MIDDLEWARE.index('api.middleware.PathScopedMiddleware')
+        full_only = settings.SCOPED_MIDDLEWARE['FULL_ONLY']
+        self.assertEqual(expanded[start:start + len(full_only)], full_only)
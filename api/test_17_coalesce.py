@@ -0,0 +1,234 @@
+# 同時に来た同じGETリクエストをまとめる(single-flight)テストコードを書くファイル
+import threading
+import time
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from rest_framework import mixins, status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from . import db_routers
+from .coalesce import SingleFlight, flights
+from .response_cache import response_cache
+from .models import Brand
+
+# エンドポイントをあらかじめ定義しておく
+BRANDS_URL = '/api/brands/'
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.001)
+
+
+class SingleFlightTests(SimpleTestCase):
+
+    # 処理中の同じキーを待って、その結果を受け取る
+    def test_17_1_should_share_result_of_in_flight_call(self):
+        group = SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            release.wait(5)
+            return 'bytes'
+
+        threads = [threading.Thread(target=lambda: results.append(group.do('key', compute, 5))) for _ in range(4)]
+        threads[0].start()
+        wait_until(lambda: group.stats()['in_flight'] == 1)
+        for thread in threads[1:]:
+            thread.start()
+        wait_until(lambda: group.stats()['waiting'] == 3)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['bytes'] * 4)
+        self.assertEqual(group.stats(), {'in_flight': 0, 'waiting': 0, 'leaders': 1, 'coalesced': 3})
+
+    # 処理中のものが例外になったら、待っていた側はNoneを受け取る(自分で処理する)
+    def test_17_2_should_return_none_when_leader_fails(self):
+        group = SingleFlight()
+        release = threading.Event()
+        results = []
+
+        def fail():
+            release.wait(5)
+            raise ValueError('boom')
+
+        def leader():
+            with self.assertRaises(ValueError):
+                group.do('key', fail, 5)
+
+        first = threading.Thread(target=leader)
+        first.start()
+        wait_until(lambda: group.stats()['in_flight'] == 1)
+        second = threading.Thread(target=lambda: results.append(group.do('key', lambda: 'unused', 5)))
+        second.start()
+        wait_until(lambda: group.stats()['waiting'] == 1)
+        release.set()
+        first.join()
+        second.join()
+        self.assertEqual(results, [None])
+
+    # 待ち時間を超えたらNoneを返す
+    def test_17_3_should_time_out(self):
+        group = SingleFlight()
+        release = threading.Event()
+        first = threading.Thread(target=lambda: group.do('key', lambda: release.wait(5), 5))
+        first.start()
+        wait_until(lambda: group.stats()['in_flight'] == 1)
+        self.assertIsNone(group.do('key', lambda: 'unused', 0.01))
+        release.set()
+        first.join()
+
+
+@override_settings(API_COALESCE={'ENABLED': True, 'TIMEOUT': 5.0})
+class CoalescedViewTests(TestCase):
+
+    def setUp(self):
+        flights.clear()
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.token = Token.objects.create(user=self.user).key
+        Brand.objects.create(brand_name='Tesla')
+
+    # 処理中の一覧のリクエストがあれば、同じリクエストはクエリを実行せずにそのバイト列を返す
+    def test_17_4_should_coalesce_identical_list_requests(self):
+        real_list = mixins.ListModelMixin.list
+        follower_results = []
+
+        def follower():
+            client = APIClient()
+            client.force_authenticate(self.user)
+            follower_results.append(client.get(BRANDS_URL, {'format': 'json'}))
+
+        thread = threading.Thread(target=follower)
+
+        def slow_list(view, request, *args, **kwargs):
+            # 1回目のリクエストの処理中に、同じリクエストを別のスレッドから送る
+            response = real_list(view, request, *args, **kwargs)
+            thread.start()
+            wait_until(lambda: flights.stats()['waiting'] == 1)
+            return response
+
+        with mock.patch.object(mixins.ListModelMixin, 'list', autospec=True, side_effect=slow_list) as patched:
+            res = self.client.get(BRANDS_URL, {'format': 'json'})
+            thread.join()
+
+        self.assertEqual(patched.call_count, 1)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(follower_results[0].status_code, status.HTTP_200_OK)
+        self.assertEqual(follower_results[0].content, res.content)
+        self.assertEqual(flights.stats()['coalesced'], 1)
+
+    # 順番に来たリクエストはまとめない
+    def test_17_5_should_not_coalesce_sequential_requests(self):
+        with mock.patch.object(mixins.ListModelMixin, 'list', autospec=True,
+                               side_effect=mixins.ListModelMixin.list) as patched:
+            self.client.get(BRANDS_URL)
+            self.client.get(BRANDS_URL)
+        self.assertEqual(patched.call_count, 2)
+        self.assertEqual(flights.stats()['coalesced'], 0)
+
+    # ASGIのハンドラで受けたリクエストはまとめずに、そのまま処理する
+    async def test_17_6_should_not_coalesce_under_asgi(self):
+        res = await self.async_client.get(BRANDS_URL, {'format': 'json'}, AUTHORIZATION='Token ' + self.token)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.json()[0]['brand_name'], 'Tesla')
+        self.assertEqual(flights.stats()['leaders'], 0)
+
+
+# 読み取り先が違うリクエストは、キャッシュもまとめる処理も共有しない
+# (レプリカのエイリアスにはテストDB(default)を使う)
+@override_settings(API_RESPONSE_CACHE={'ENABLED': True, 'MAX_ENTRIES': 16},
+                   API_COALESCE={'ENABLED': True, 'TIMEOUT': 5.0},
+                   REPLICA_DATABASES=['default'])
+class RoutedResponseKeyTests(TestCase):
+
+    def setUp(self):
+        response_cache.clear()
+        # ほかのテストで固定されたユーザが残っていないようにする
+        db_routers._pin_cache().clear()
+        self.addCleanup(db_routers._pin_cache().clear)
+        Brand.objects.create(brand_name='Tesla')
+        self.reader = get_user_model().objects.create_user(username='reader', password='dummy_pw')
+        self.writer = get_user_model().objects.create_user(username='writer', password='dummy_pw')
+
+    def tearDown(self):
+        db_routers.reset()
+        response_cache.clear()
+
+    def get_brands(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        res = client.get(BRANDS_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return res
+
+    # primaryに固定されたユーザには、レプリカから読んだレスポンスを返さない
+    def test_17_7_should_not_share_replica_response_with_pinned_user(self):
+        db_routers.pin(self.writer)
+        self.get_brands(self.reader)
+        self.get_brands(self.writer)
+        self.assertEqual(response_cache.hits, 0)
+        self.assertEqual(response_cache.misses, 2)
+        # 読み取り先が同じなら共有する
+        self.get_brands(self.reader)
+        self.assertEqual(response_cache.hits, 1)
+
+
+@override_settings(API_COALESCE={'ENABLED': True, 'TIMEOUT': 5.0})
+class WsgiCoalesceTests(TransactionTestCase):
+    # WSGIのアプリケーション(rest_api/wsgi.py)に、別々のスレッドから同時にリクエストを送る
+    # (それぞれのスレッドが自分のDB接続で読むので、データはコミットしておく)
+
+    def setUp(self):
+        flights.clear()
+        user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.token = Token.objects.create(user=user).key
+        Brand.objects.create(brand_name='Tesla')
+
+    def call_application(self, results):
+        from rest_api.wsgi import application
+        environ = RequestFactory().get(BRANDS_URL, {'format': 'json'},
+                                       HTTP_AUTHORIZATION='Token ' + self.token).environ
+        statuses = []
+        body = application(environ, lambda status_line, headers: statuses.append(status_line))
+        try:
+            results.append((statuses[0], b''.join(body)))
+        finally:
+            body.close()
+
+    # 処理中のリクエストがあれば、同じリクエストはその計算の結果を使う
+    def test_17_8_should_coalesce_overlapping_wsgi_requests(self):
+        real_list = mixins.ListModelMixin.list
+
+        def slow_list(view, request, *args, **kwargs):
+            # 2つ目のリクエストが待ち始めるまで、1つ目の計算を終わらせない
+            response = real_list(view, request, *args, **kwargs)
+            wait_until(lambda: flights.stats()['waiting'] == 1)
+            return response
+
+        leader_results = []
+        follower_results = []
+        with mock.patch.object(mixins.ListModelMixin, 'list', autospec=True, side_effect=slow_list) as patched:
+            leader = threading.Thread(target=self.call_application, args=(leader_results,))
+            leader.start()
+            wait_until(lambda: flights.stats()['in_flight'] == 1)
+            follower = threading.Thread(target=self.call_application, args=(follower_results,))
+            follower.start()
+            leader.join()
+            follower.join()
+
+        self.assertEqual(patched.call_count, 1)
+        self.assertEqual(leader_results[0][0], '200 OK')
+        self.assertEqual(follower_results, leader_results)
+        self.assertEqual(flights.stats()['coalesced'], 1)
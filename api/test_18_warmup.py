@@ -0,0 +1,88 @@
+# ワーカーのウォームアップ(api.warmup)と /api/ready/ のテストコードを書くファイル
+import importlib
+from unittest import mock
+from django.apps import apps
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from . import lookups, warmup
+from .models import Brand, Segment
+
+# エンドポイントをあらかじめ定義しておく
+READY_URL = reverse('api:ready')
+
+
+class WarmupTests(TestCase):
+
+    def setUp(self):
+        warmup.state.reset()
+        lookups.clear()
+        self.client = APIClient()
+
+    def tearDown(self):
+        warmup.state.reset()
+        lookups.clear()
+
+    # 無効のときは何もせず、readyを返す
+    def test_18_1_should_be_ready_when_disabled(self):
+        self.assertIsNone(warmup.start())
+        res = self.client.get(READY_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['status'], warmup.STATUS_DISABLED)
+
+    # 終わるまでは503を返す(ログインしていなくても見られる)
+    def test_18_2_should_report_not_ready_until_finished(self):
+        warmup.state.reset(warmup.STATUS_PENDING)
+        res = self.client.get(READY_URL)
+        self.assertEqual(res.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertFalse(res.data['ready'])
+
+    # すべてのステップを実行し、brand/segmentの名前のキャッシュも読み込む
+    @override_settings(API_WARMUP={'ENABLED': True})
+    def test_18_3_should_run_all_steps(self):
+        brand = Brand.objects.create(brand_name='Tesla')
+        Segment.objects.create(segment_name='Sedan')
+        warmup.start()
+
+        res = self.client.get(READY_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['status'], warmup.STATUS_READY)
+        self.assertEqual(set(res.data['steps']), {'serializers', 'routes', 'databases', 'lookups'})
+        self.assertEqual(res.data['errors'], {})
+        self.assertEqual(res.data['steps']['lookups']['result'], 2)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(lookups.get_or_create_by_name(Brand, 'Tesla').pk, brand.pk)
+        self.assertEqual(len(queries), 0)
+
+    # 失敗したステップがあっても残りは実行し、エラーを返す
+    @override_settings(API_WARMUP={'ENABLED': True, 'STEPS': ['routes', 'serializers'],
+                                   'ROUTES': ['api:no-such-route']})
+    def test_18_4_should_record_failed_steps(self):
+        with self.assertLogs('api.warmup', 'WARNING'):
+            warmup.start()
+        result = warmup.state.as_dict()
+        self.assertTrue(result['ready'])
+        self.assertIn('routes', result['errors'])
+        self.assertIn('serializers', result['steps'])
+
+    # BACKGROUNDがTrueのときは別スレッドで実行する
+    @override_settings(API_WARMUP={'ENABLED': True, 'BACKGROUND': True, 'STEPS': ['serializers', 'routes']})
+    def test_18_5_should_run_in_background(self):
+        thread = warmup.start()
+        thread.join(10)
+        self.assertEqual(warmup.state.as_dict()['status'], warmup.STATUS_READY)
+
+    # manage.pyのコマンドでも呼ばれるready()では実行せず、WSGIのアプリケーションを読み込んだときに実行する
+    @override_settings(API_WARMUP={'ENABLED': True, 'STEPS': []})
+    def test_18_6_should_run_only_in_server_process(self):
+        from rest_api import wsgi
+        with mock.patch.object(warmup, 'start') as start:
+            apps.get_app_config('api').ready()
+            start.assert_not_called()
+
+            importlib.reload(wsgi)
+            start.assert_called_once_with()
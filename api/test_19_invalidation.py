@@ -0,0 +1,158 @@
+# ワーカー間のキャッシュの無効化(api.invalidation)のテストコードを書くファイル
+import os
+from unittest import mock
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework import status
+from rest_framework.test import APIClient
+from . import invalidation, lookups, throttling
+from .models import Brand
+from .response_cache import response_cache
+from .testing import enable_settings, temp_directory
+
+# エンドポイントをあらかじめ定義しておく
+BRANDS_URL = '/api/brands/'
+
+
+def publish_in_child(path, topic):
+    # 別のワーカープロセスからの書き込みの代わり
+    bus = invalidation.InvalidationBus(path)
+    bus.publish(topic)
+    bus.close()
+
+
+class InvalidationBusTests(TestCase):
+
+    def setUp(self):
+        self.directory = temp_directory(self)
+        self.path = os.path.join(self.directory, 'invalidation')
+        enable_settings(self, API_INVALIDATION_BUS={'ENABLED': True, 'PATH': self.path},
+                        API_RESPONSE_CACHE={'ENABLED': True, 'MAX_ENTRIES': 16})
+        response_cache.clear()
+        lookups.clear()
+        self.addCleanup(response_cache.clear)
+        self.addCleanup(lookups.clear)
+
+        self.bus = invalidation.get_bus()
+        # ほかのワーカーのバス(同じファイルをmmapする)
+        self.other = invalidation.InvalidationBus(self.path)
+        self.addCleanup(self.other.close)
+
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    # ほかのワーカーの書き込みがpollで伝わる
+    def test_19_1_should_deliver_other_workers_events(self):
+        calls = []
+        self.bus.subscribe('brand', lambda: calls.append('brand'))
+        self.assertEqual(invalidation.poll(), [])
+
+        self.other.publish('brand')
+        self.assertEqual(invalidation.poll(), ['brand'])
+        self.assertEqual(calls, ['brand'])
+        # 2回目は何も起きない
+        self.assertEqual(invalidation.poll(), [])
+
+    # 自分の書き込みは、自分のキャッシュを二重に無効化しない
+    def test_19_2_should_skip_own_events(self):
+        invalidation.publish('vehicle')
+        self.assertEqual(invalidation.poll(), [])
+        self.assertEqual(self.other.read_all()[invalidation.TOPICS.index('vehicle')], 1)
+
+    # コミットされたらほかのワーカーへ伝える
+    def test_19_3_should_publish_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post(BRANDS_URL, {'brand_name': 'Tesla'})
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.other.read_all()[invalidation.TOPICS.index('brand')], 1)
+
+    # ほかのワーカーの書き込みで、レスポンスキャッシュが無効になる
+    def test_19_4_should_invalidate_response_cache(self):
+        self.client.get(BRANDS_URL)
+        self.client.get(BRANDS_URL)
+        self.assertEqual(response_cache.hits, 1)
+
+        self.other.publish('brand')
+        self.client.get(BRANDS_URL)
+        self.assertEqual(response_cache.hits, 1)
+        self.assertEqual(response_cache.misses, 2)
+
+    # ほかのワーカーの書き込みで、brand_nameのキャッシュが捨てられる
+    def test_19_5_should_invalidate_name_lookups(self):
+        brand = Brand.objects.create(brand_name='Tesla')
+        lookups._caches[Brand].set('Tesla', brand.pk)
+        with CaptureQueriesContext(connection) as queries:
+            lookups.get_or_create_by_name(Brand, 'Tesla')
+        self.assertEqual(len(queries), 0)
+
+        self.other.publish('brand')
+        with CaptureQueriesContext(connection) as queries:
+            lookups.get_or_create_by_name(Brand, 'Tesla')
+        self.assertGreater(len(queries), 0)
+
+    # 名前のキャッシュを読み込んだあとにバスを作っても、読み込み中のほかのワーカーの書き込みを取りこぼさない
+    def test_19_6_should_not_miss_events_after_preload(self):
+        brand = Brand.objects.create(brand_name='Tesla')
+        invalidation._bus = None
+        self.addCleanup(setattr, invalidation, '_bus', None)
+        real_poll = invalidation.poll
+
+        def publish_during_preload():
+            # バスを作ったあと、キャッシュを読み込む前にほかのワーカーが書き込む
+            changed = real_poll()
+            self.other.publish('brand')
+            return changed
+
+        with mock.patch.object(invalidation, 'poll', side_effect=publish_during_preload):
+            lookups.preload()
+        self.assertEqual(lookups._caches[Brand].get('Tesla'), brand.pk)
+        self.assertEqual(invalidation.poll(), ['brand'])
+        self.assertIsNone(lookups._caches[Brand].get('Tesla'))
+
+    # ready()でバスが作られる
+    def test_19_7_should_create_bus_when_app_is_ready(self):
+        invalidation._bus = None
+        self.addCleanup(setattr, invalidation, '_bus', None)
+        apps.get_app_config('api').ready()
+        self.assertIsNotNone(invalidation._bus)
+        self.assertEqual(invalidation._bus.path, self.path)
+
+    # 別のプロセスからの書き込みも伝わる
+    # (並列実行のワーカーはデーモンプロセスでmultiprocessingの子プロセスを作れないので、直接forkする)
+    def test_19_8_should_work_across_processes(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                publish_in_child(self.path, 'segment')
+                code = 0
+            finally:
+                os._exit(code)
+        _, status_code = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status_code), 0)
+        self.assertEqual(invalidation.poll(), ['segment'])
+
+    # 無効のときは何もしない
+    def test_19_9_should_do_nothing_when_disabled(self):
+        with override_settings(API_INVALIDATION_BUS={'ENABLED': False, 'PATH': self.path}):
+            invalidation.publish('brand')
+            self.assertEqual(invalidation.poll(), [])
+        self.assertEqual(self.other.read_all(), [0, 0, 0])
+
+    # PATHを指定しなければ、プロジェクトとsettingsごとのファイルを使う
+    def test_19_10_should_scope_default_path_by_project(self):
+        with override_settings(API_INVALIDATION_BUS={'ENABLED': True}):
+            path = invalidation.bus_settings()['PATH']
+        self.assertEqual(os.path.basename(path), 'rest_api-invalidation-{0}'.format(throttling.project_suffix()))
+
+    # PATHが変わってバスを作り直したら、前のファイルは閉じる
+    def test_19_11_should_close_replaced_bus(self):
+        old = invalidation.get_bus()
+        with override_settings(API_INVALIDATION_BUS={'ENABLED': True,
+                                                     'PATH': os.path.join(self.directory, 'other')}):
+            self.assertIsNot(invalidation.get_bus(), old)
+        self.assertTrue(old.map.closed)
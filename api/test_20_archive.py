@@ -0,0 +1,130 @@
+# 古いvehicleのコールドテーブル(ArchivedVehicle)のテストコードを書くファイル
+from io import StringIO
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from . import archive, invalidation, snapshot
+from .models import Vehicle, ArchivedVehicle, VehicleListing, Brand, Segment
+from .response_cache import response_cache
+
+# エンドポイントをあらかじめ定義しておく
+VEHICLES_URL = '/api/vehicles/'
+
+
+def detail_url(vehicle_id):
+    return reverse('api:vehicle-detail', args=[vehicle_id])
+
+
+class VehicleArchiveTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # カタログのバージョンはコミット後に進むので、ここで実行しておく
+        with self.captureOnCommitCallbacks(execute=True):
+            segment = Segment.objects.create(segment_name='Sedan')
+            brand = Brand.objects.create(brand_name='Tesla')
+            self.vehicles = [
+                Vehicle.objects.create(user=self.user, segment=segment, brand=brand, vehicle_name=name,
+                                       release_year=year, price=500)
+                for name, year in [('ROADSTER', 2008), ('MODEL S', 2012), ('MODEL 3', 2017), ('MODEL Y', 2020)]
+            ]
+
+    def names(self, res):
+        return [vehicle['vehicle_name'] for vehicle in res.data]
+
+    # cutoffより前のvehicleを同じIDでコールドテーブルへ移す
+    def test_20_1_should_move_old_vehicles_in_batches(self):
+        batches = []
+        count = archive.archive(before=2015, batch_size=1, on_batch=batches.append)
+        self.assertEqual(count, 2)
+        self.assertEqual(batches, [1, 2])
+        self.assertEqual(list(ArchivedVehicle.objects.order_by('id').values_list('id', flat=True)),
+                         [self.vehicles[0].id, self.vehicles[1].id])
+        self.assertEqual(Vehicle.objects.count(), 2)
+        # 一覧用のテーブルからも消える
+        self.assertEqual(VehicleListing.objects.count(), 2)
+
+    # 一覧はホットテーブルだけ、?archived=includeで両方、?archived=onlyでコールドだけ
+    def test_20_2_should_list_hot_table_by_default(self):
+        archive.archive(before=2015)
+        self.assertEqual(self.names(self.client.get(VEHICLES_URL)), ['MODEL 3', 'MODEL Y'])
+        self.assertEqual(self.names(self.client.get(VEHICLES_URL, {'archived': 'include'})),
+                         ['ROADSTER', 'MODEL S', 'MODEL 3', 'MODEL Y'])
+        res = self.client.get(VEHICLES_URL, {'archived': 'only'})
+        self.assertEqual(self.names(res), ['ROADSTER', 'MODEL S'])
+        self.assertEqual(res.data[0]['brand_name'], 'Tesla')
+
+    # 知らない値は400
+    def test_20_3_should_reject_unknown_archived_value(self):
+        res = self.client.get(VEHICLES_URL, {'archived': 'all'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    # 移動したあとも同じURLで詳細を読めるが、更新はできない
+    def test_20_4_should_keep_detail_urls(self):
+        old = self.vehicles[0]
+        before = self.client.get(detail_url(old.id)).data
+        archive.archive(before=2015)
+
+        res = self.client.get(detail_url(old.id))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data, before)
+
+        res = self.client.patch(detail_url(old.id), {'vehicle_name': 'ROADSTER 2'})
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    # 一覧用のテーブルを使う設定でも、コールドテーブルの詳細と一覧を読める
+    @override_settings(VEHICLE_LISTING_READ_MODEL=True)
+    def test_20_5_should_work_with_listing_read_model(self):
+        archive.archive(before=2015)
+        res = self.client.get(detail_url(self.vehicles[0].id))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['segment_name'], 'Sedan')
+        self.assertEqual(self.names(self.client.get(VEHICLES_URL)), ['MODEL 3', 'MODEL Y'])
+        self.assertEqual(len(self.client.get(VEHICLES_URL, {'archived': 'include'}).data), 4)
+
+    # 移動したあとに作ったvehicleのIDは、コールドテーブルのIDとぶつからない
+    def test_20_6_should_not_reuse_ids(self):
+        last = self.vehicles[-1]
+        last.release_year = 1999
+        last.save()
+        archive.archive(before=2015)
+        res = self.client.post(VEHICLES_URL, {'vehicle_name': 'CYBERTRUCK', 'release_year': 2023, 'price': 900,
+                                              'segment_name': 'Sedan', 'brand_name': 'Tesla'})
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertGreater(res.data['id'], last.id)
+
+    # コマンドで移動できる。cutoffがなければエラー
+    def test_20_7_should_archive_with_command(self):
+        with self.assertRaises(CommandError):
+            call_command('archive_vehicles', stdout=StringIO())
+        out = StringIO()
+        with override_settings(VEHICLE_ARCHIVE={'CUTOFF_YEAR': 2010}):
+            call_command('archive_vehicles', stdout=out)
+        self.assertIn('Archived 1 vehicles.', out.getvalue())
+        self.assertTrue(ArchivedVehicle.objects.filter(vehicle_name='ROADSTER').exists())
+
+    # 1行ずつシグナルを送らず、キャッシュの世代・スナップショットのバージョン・通知はバッチごとに1回だけ進める
+    def test_20_8_should_invalidate_once_per_batch(self):
+        version = snapshot.current_version()
+        generation = response_cache.generation
+        with mock.patch.object(invalidation, 'publish') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(archive.archive_batch(before=2015, batch_size=10), 2)
+        publish.assert_called_once_with('vehicle')
+        self.assertEqual(snapshot.current_version(), version + 1)
+        self.assertEqual(response_cache.generation, generation + 2)
+        self.assertEqual(VehicleListing.objects.count(), 2)
+
+    # SQLに渡せるパラメータの数より多くても、分けて削除する
+    def test_20_9_should_delete_in_chunks(self):
+        with mock.patch.object(connection.features, 'max_query_params', 1):
+            self.assertEqual(archive.archive_batch(before=2015, batch_size=10), 2)
+        self.assertEqual(list(Vehicle.objects.order_by('id').values_list('vehicle_name', flat=True)),
+                         ['MODEL 3', 'MODEL Y'])
@@ -0,0 +1,156 @@
+# 大きなデータセット(api.seed)を使った性能テストと、データセット自体のテストコードを書くファイル
+# 性能テストはperfタグを付けていて、「python manage.py test --tag perf」のときだけ実行される
+import random
+import subprocess
+from io import StringIO
+from pathlib import Path
+from unittest import mock, skipIf
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings, tag
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from . import archive, seed, snapshot
+from .models import Vehicle, ArchivedVehicle, VehicleListing, Brand, Segment
+from .response_cache import response_cache
+from .testing import PERF_TAG, ApiTestRunner, SeededTestCase
+
+# エンドポイントをあらかじめ定義しておく
+VEHICLES_URL = '/api/vehicles/'
+BRANDS_URL = '/api/brands/'
+
+
+class SeedTests(TestCase):
+
+    # 同じSCALEなら同じデータができ、一覧用のテーブルも作られる
+    def test_21_1_should_seed_deterministic_dataset(self):
+        counts = seed.seed(50)
+        self.assertEqual(counts, {'users': 1, 'segments': len(seed.SEGMENTS), 'brands': seed.BRANDS, 'vehicles': 50})
+        self.assertEqual(VehicleListing.objects.count(), 50)
+        first = list(Vehicle.objects.order_by('id').values_list('vehicle_name', 'release_year', 'price')[:5])
+
+        Vehicle.objects.all().delete()
+        User.objects.all().delete()
+        Brand.objects.all().delete()
+        Segment.objects.all().delete()
+        seed.seed(50)
+        self.assertEqual(list(Vehicle.objects.order_by('id').values_list('vehicle_name', 'release_year', 'price')[:5]),
+                         first)
+
+    # 性能テストは--tag perfのときだけ実行する
+    def test_21_2_should_exclude_perf_tag_by_default(self):
+        self.assertIn(PERF_TAG, ApiTestRunner(parallel=1).exclude_tags)
+        self.assertNotIn(PERF_TAG, ApiTestRunner(parallel=1, tags=[PERF_TAG]).exclude_tags)
+
+    # スナップショットのキーには、データセットの中身を決めるコード(一覧用のテーブル・モデル)も含める
+    def test_21_3_should_hash_dataset_sources_in_snapshot_key(self):
+        with mock.patch.object(Path, 'read_bytes', autospec=True, side_effect=lambda path: path.name.encode()) as read:
+            seed.snapshot_key(50)
+        names = {call.args[0].name for call in read.call_args_list}
+        self.assertTrue({'seed.py', 'listing.py', 'models.py', '0001_initial.py'} <= names)
+
+    # 失敗した実行の時間は表示せず、コマンドをエラーにする
+    def test_21_4_should_fail_wall_time_command_on_failed_run(self):
+        failed = subprocess.CompletedProcess([], 1, stderr='FAILED (failures=1)')
+        with mock.patch('subprocess.run', return_value=failed):
+            with self.assertRaises(CommandError):
+                call_command('test_wall_time', suite=['api'], stdout=StringIO(), stderr=StringIO())
+
+
+class PerformanceTestCase(SeededTestCase):
+
+    def setUp(self):
+        self.user = User.objects.filter(username__startswith='seeded').first()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        response_cache.clear()
+
+
+@tag(PERF_TAG)
+class SeededDatasetTests(PerformanceTestCase):
+
+    # ワーカーごとのテストDBに、データセットがすべて入っている
+    def test_21_5_should_have_seeded_dataset(self):
+        self.assertEqual(self.seed_counts['vehicles'], Vehicle.objects.count())
+        self.assertEqual(VehicleListing.objects.count(), Vehicle.objects.count())
+
+
+@tag(PERF_TAG)
+class VehicleListPerformanceTests(PerformanceTestCase):
+
+    # Vehicle/Brand/SegmentをJOINして一覧を返す
+    def test_21_6_should_list_vehicles(self):
+        with self.timed('list'):
+            res = self.client.get(VEHICLES_URL, {'format': 'json'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(res.json()), self.seed_counts['vehicles'])
+
+    # 非正規化した一覧用のテーブルから一覧を返す
+    @override_settings(VEHICLE_LISTING_READ_MODEL=True)
+    def test_21_7_should_list_vehicles_from_listing(self):
+        with self.timed('list_from_listing'):
+            res = self.client.get(VEHICLES_URL, {'format': 'json'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(res.json()), self.seed_counts['vehicles'])
+
+    # キャッシュから一覧を返す
+    @override_settings(API_RESPONSE_CACHE={'ENABLED': True, 'MAX_ENTRIES': 16},
+                       VEHICLE_LISTING_READ_MODEL=True)
+    def test_21_8_should_list_vehicles_from_cache(self):
+        self.client.get(VEHICLES_URL, {'format': 'json'})
+        with self.timed('list_from_cache_x10'):
+            for _ in range(10):
+                res = self.client.get(VEHICLES_URL, {'format': 'json'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(response_cache.hits, 10)
+
+
+@tag(PERF_TAG)
+class VehicleDetailPerformanceTests(PerformanceTestCase):
+
+    # ランダムに選んだvehicleの詳細を返す
+    def test_21_9_should_retrieve_vehicles(self):
+        ids = list(Vehicle.objects.values_list('id', flat=True))
+        sample = random.Random(seed.RANDOM_SEED).sample(ids, min(200, len(ids)))
+        with self.timed('retrieve_x{0}'.format(len(sample))):
+            for vehicle_id in sample:
+                res = self.client.get(reverse('api:vehicle-detail', args=[vehicle_id]))
+                self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    # brandの一覧を返す
+    def test_21_10_should_list_brands(self):
+        with self.timed('brands_x50'):
+            for _ in range(50):
+                res = self.client.get(BRANDS_URL)
+        self.assertEqual(len(res.data), self.seed_counts['brands'])
+
+
+@tag(PERF_TAG)
+class VehicleArchivePerformanceTests(PerformanceTestCase):
+
+    # 古いvehicleをコールドテーブルへ移し、両方を読む
+    def test_21_11_should_archive_and_list_both_tables(self):
+        before = 2000
+        expected = Vehicle.objects.filter(release_year__lt=before).count()
+        with self.timed('archive'):
+            moved = archive.archive(before=before, batch_size=500)
+        self.assertEqual(moved, expected)
+        self.assertEqual(ArchivedVehicle.objects.count(), expected)
+        with self.timed('list_include_archived'):
+            res = self.client.get(VEHICLES_URL, {'archived': 'include', 'format': 'json'})
+        self.assertEqual(len(res.json()), self.seed_counts['vehicles'])
+
+
+@tag(PERF_TAG)
+@skipIf(snapshot.pa is None, 'pyarrow is not installed')
+class SnapshotPerformanceTests(PerformanceTestCase):
+
+    # Parquetのスナップショットを作る
+    def test_21_12_should_export_parquet(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(CATALOG_SNAPSHOT={'DIRECTORY': directory, 'BATCH_SIZE': 1000}):
+                with self.timed('snapshot_parquet'):
+                    path, version, cached = snapshot.get_snapshot('parquet')
+                self.assertEqual(snapshot.pq.read_metadata(str(path)).num_rows, self.seed_counts['vehicles'])
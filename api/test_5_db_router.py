@@ -0,0 +1,164 @@
+# 読み取りレプリカへのルーティングのテストコードを書くファイル
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework import status
+from rest_framework.test import APIClient
+from . import db_routers
+from .db_routers import PrimaryReplicaRouter
+from .models import Brand
+
+# エンドポイントをあらかじめ定義しておく
+BRANDS_URL = '/api/brands/'
+
+
+@override_settings(REPLICA_DATABASES=['replica'])
+class PrimaryReplicaRouterTests(TestCase):
+
+    def setUp(self):
+        self.router = PrimaryReplicaRouter()
+        db_routers.reset()
+
+    def tearDown(self):
+        db_routers.reset()
+
+    # 何も指定していなければprimaryから読む
+    def test_5_1_should_read_from_primary_by_default(self):
+        self.assertEqual(self.router.db_for_read(Brand), 'default')
+
+    # use_replica()したリクエストはレプリカから読む
+    def test_5_2_should_read_from_replica(self):
+        db_routers.use_replica()
+        self.assertEqual(self.router.db_for_read(Brand), 'replica')
+
+    # 同じリクエスト内で書き込みがあったら、以降の読み取りはprimaryに戻る
+    def test_5_3_should_read_from_primary_after_write(self):
+        db_routers.use_replica()
+        self.assertEqual(self.router.db_for_write(Brand), 'default')
+        self.assertEqual(self.router.db_for_read(Brand), 'default')
+
+    # レプリカにはマイグレーションしない
+    def test_5_4_should_not_migrate_replica(self):
+        self.assertFalse(self.router.allow_migrate('replica', 'api', 'brand'))
+        self.assertIsNone(self.router.allow_migrate('default', 'api', 'brand'))
+
+    # レプリカが設定されていなければ、use_replica()してもprimaryから読む
+    @override_settings(REPLICA_DATABASES=[])
+    def test_5_5_should_read_from_primary_without_replicas(self):
+        db_routers.use_replica()
+        self.assertEqual(self.router.db_for_read(Brand), 'default')
+
+
+class ReplicaRoutingViewTests(TestCase):
+
+    def setUp(self):
+        caches['shared'].clear()
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def tearDown(self):
+        caches['shared'].clear()
+
+    # GETはレプリカから読み取る
+    def test_5_6_should_use_replica_for_get(self):
+        with mock.patch.object(db_routers, 'use_replica') as use_replica:
+            res = self.client.get(BRANDS_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        use_replica.assert_called_once_with()
+        # リクエストが終わったら状態は元に戻っている
+        self.assertFalse(db_routers.is_using_replica())
+
+    # 書き込みをしたユーザは、しばらくprimaryから読む
+    @override_settings(REPLICA_DATABASES=['replica'])
+    def test_5_7_should_pin_user_to_primary_after_write(self):
+        res = self.client.post(BRANDS_URL, {'brand_name': 'Tesla'})
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(db_routers.is_pinned(self.user))
+
+        with mock.patch.object(db_routers, 'use_replica') as use_replica:
+            res = self.client.get(BRANDS_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        use_replica.assert_not_called()
+
+
+@override_settings(REPLICA_DATABASES=['replica'])
+class ReplicaRoutingQueryTests(TransactionTestCase):
+    # 実際にreplicaのエイリアスを作り、どちらの接続でSQLが実行されたかを確認する
+    # (replicaはテストDBと同じDBを指す、別の接続。settingsにはないので、クラスの準備のときに追加する)
+
+    @classmethod
+    def setUpClass(cls):
+        connections.databases['replica'] = dict(connections['default'].settings_dict)
+        cls.databases = {'default', 'replica'}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica'].close()
+        del connections['replica']
+        del connections.databases['replica']
+
+    def setUp(self):
+        caches['shared'].clear()
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def tearDown(self):
+        caches['shared'].clear()
+
+    def get_brands(self):
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            res = self.client.get(BRANDS_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return len(primary), len(replica)
+
+    # GETはreplicaの接続で実行され、書き込んだあとはprimaryの接続で実行される
+    def test_5_8_should_route_queries_to_replica_until_write(self):
+        self.assertEqual(self.get_brands(), (0, 1))
+
+        res = self.client.post(BRANDS_URL, {'brand_name': 'Tesla'})
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.get_brands(), (1, 0))
+
+    # 固定は共有キャッシュに保存されるので、プロセスごとのキャッシュが消えても(別のワーカーでも)効く
+    def test_5_9_should_share_pin_across_workers(self):
+        self.client.post(BRANDS_URL, {'brand_name': 'Tesla'})
+        caches['default'].clear()
+        self.assertTrue(db_routers.is_pinned(self.user))
+        self.assertEqual(self.get_brands(), (1, 0))
+
+
+class ReplicaPinTests(TestCase):
+
+    def setUp(self):
+        caches['shared'].clear()
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def tearDown(self):
+        caches['shared'].clear()
+
+    # レプリカが設定されていなければ、固定のためにキャッシュを読み書きしない
+    @override_settings(REPLICA_DATABASES=[])
+    def test_5_10_should_not_touch_pin_cache_without_replicas(self):
+        with mock.patch.object(db_routers, '_pin_cache') as pin_cache:
+            self.assertEqual(self.client.post(BRANDS_URL, {'brand_name': 'Tesla'}).status_code,
+                             status.HTTP_201_CREATED)
+            self.assertEqual(self.client.get(BRANDS_URL).status_code, status.HTTP_200_OK)
+        pin_cache.assert_not_called()
+        self.assertFalse(db_routers.is_pinned(self.user))
+
+    # 失敗した書き込み(400)では固定しない
+    @override_settings(REPLICA_DATABASES=['replica'])
+    def test_5_11_should_not_pin_user_after_failed_write(self):
+        res = self.client.post(BRANDS_URL, {'brand_name': ''})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(db_routers.is_pinned(self.user))
@@ -0,0 +1,142 @@
+# Vehicleのまとめて書き込み(write-behind)のテストコードを書くファイル
+from contextlib import contextmanager
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import OperationalError, transaction
+from django.test import TestCase, override_settings
+from rest_framework import status
+from rest_framework.test import APIClient
+from . import ingest
+from .models import Vehicle, Brand, Segment
+
+# エンドポイントをあらかじめ定義しておく
+VEHICLES_URL = '/api/vehicles/'
+
+
+@override_settings(VEHICLE_INGEST={'ENABLED': True})
+class VehicleIngestApiTests(TestCase):
+
+    def setUp(self):
+        caches['ingest_status'].clear()
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.segment = Segment.objects.create(segment_name='Sedan')
+        self.brand = Brand.objects.create(brand_name='Tesla')
+        # テストではバックグラウンドのスレッドを起動せず、flush()を直接呼ぶ
+        self.queue = ingest.VehicleIngestQueue(
+            batch_size=100, flush_interval=1, max_pending=1000, status_timeout=60, autostart=False
+        )
+        patcher = mock.patch.object(ingest, 'get_queue', return_value=self.queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def payload(self, **params):
+        defaults = {
+            'vehicle_name': 'MODEL S',
+            'release_year': 2019,
+            'price': 500.00,
+            'segment': self.segment.id,
+            'brand': self.brand.id,
+        }
+        defaults.update(params)
+        return defaults
+
+    # Preferヘッダを付けたPOSTは202を返し、flushされるまでDBには書き込まれない
+    def test_6_1_should_accept_vehicle_asynchronously(self):
+        res = self.client.post(VEHICLES_URL, self.payload(), HTTP_PREFER='respond-async')
+        self.assertEqual(res.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(res.data['status'], ingest.STATUS_QUEUED)
+        self.assertEqual(0, Vehicle.objects.count())
+        self.assertEqual(1, len(self.queue))
+
+        # ステータスを確認できる
+        res = self.client.get(res['Location'])
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['status'], ingest.STATUS_QUEUED)
+
+    # flushするとまとめてコミットされ、ステータスがcommittedになる
+    def test_6_2_should_commit_vehicles_on_flush(self):
+        tracking_ids = []
+        for i in range(3):
+            res = self.client.post(VEHICLES_URL, self.payload(vehicle_name='MODEL {0}'.format(i)),
+                                   HTTP_PREFER='respond-async')
+            tracking_ids.append(res.data['tracking_id'])
+
+        self.assertEqual(3, self.queue.flush())
+        self.assertEqual(3, Vehicle.objects.filter(user=self.user).count())
+
+        result = ingest.get_status(tracking_ids[0])
+        self.assertEqual(result['status'], ingest.STATUS_COMMITTED)
+        self.assertTrue(Vehicle.objects.filter(id=result['vehicle_id']).exists())
+
+    # 検証エラーのときは、これまで通り400を返す
+    def test_6_3_should_not_accept_invalid_vehicle(self):
+        res = self.client.post(VEHICLES_URL, self.payload(brand=''), HTTP_PREFER='respond-async')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(0, len(self.queue))
+
+    # Preferヘッダがなければ、これまで通りその場で作成する
+    def test_6_4_should_create_vehicle_synchronously_without_prefer(self):
+        res = self.client.post(VEHICLES_URL, self.payload())
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(1, Vehicle.objects.count())
+
+    # stop()すると溜まっている行をコミットする(グレースフルシャットダウン)
+    def test_6_5_should_flush_pending_vehicles_on_stop(self):
+        self.client.post(VEHICLES_URL, self.payload(), HTTP_PREFER='respond-async')
+        self.queue.stop()
+        self.assertEqual(1, Vehicle.objects.count())
+
+    # 存在しないtracking_idは404
+    def test_6_6_should_not_get_unknown_status(self):
+        res = self.client.get(VEHICLES_URL + 'ingest/0123abcd/')
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    # ステータスはワーカー間で共有するキャッシュにあるので、プロセスごとのキャッシュが消えても(別のワーカーでも)読める
+    def test_6_7_should_share_status_across_workers(self):
+        tracking_id = self.client.post(VEHICLES_URL, self.payload(), HTTP_PREFER='respond-async').data['tracking_id']
+        caches['default'].clear()
+        res = self.client.get(VEHICLES_URL + 'ingest/{0}/'.format(tracking_id))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['status'], ingest.STATUS_QUEUED)
+        self.assertNotIn('owner', res.data)
+
+    # 受け付けたワーカーがコミットする前に落ちたら、lostになる
+    def test_6_8_should_report_lost_when_worker_is_gone(self):
+        tracking_id = self.client.post(VEHICLES_URL, self.payload(), HTTP_PREFER='respond-async').data['tracking_id']
+        with mock.patch.object(ingest, '_process_alive', return_value=False):
+            res = self.client.get(VEHICLES_URL + 'ingest/{0}/'.format(tracking_id))
+        self.assertEqual(res.data['status'], ingest.STATUS_LOST)
+
+    # バッチのコミットが失敗したら、行を黙って捨てずにすべてfailedにする
+    def test_6_9_should_fail_batch_when_commit_fails(self):
+        tracking_ids = [
+            self.client.post(VEHICLES_URL, self.payload(vehicle_name='MODEL {0}'.format(i)),
+                             HTTP_PREFER='respond-async').data['tracking_id']
+            for i in range(2)
+        ]
+        atomic = transaction.atomic
+
+        @contextmanager
+        def locked_at_commit():
+            with atomic():
+                yield
+                raise OperationalError('database is locked')
+
+        # バッチ全体を囲むatomic()だけ、抜けるときに失敗させる
+        blocks = iter([locked_at_commit()])
+
+        def atomic_block(*args, **kwargs):
+            return next(blocks, None) or atomic(*args, **kwargs)
+
+        with mock.patch.object(transaction, 'atomic', side_effect=atomic_block):
+            with self.assertLogs('api.ingest', 'ERROR'):
+                self.assertEqual(2, self.queue.flush())
+        self.assertEqual(0, Vehicle.objects.count())
+        self.assertEqual(0, len(self.queue))
+        for tracking_id in tracking_ids:
+            result = ingest.get_status(tracking_id)
+            self.assertEqual(result['status'], ingest.STATUS_FAILED)
+            self.assertIn('database is locked', result['detail'])
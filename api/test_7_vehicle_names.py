@@ -0,0 +1,100 @@
+# brand_name/segment_nameを指定してvehicleを作成するテストコードを書くファイル
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from rest_framework import status
+from rest_framework.test import APIClient
+from . import lookups
+from .models import Vehicle, Brand, Segment
+
+# エンドポイントをあらかじめ定義しておく
+VEHICLES_URL = '/api/vehicles/'
+
+
+class VehicleNameApiTests(TestCase):
+
+    def setUp(self):
+        lookups.clear()
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def tearDown(self):
+        lookups.clear()
+
+    # 名前だけで、Brand/Segmentも一緒に作成できる
+    def test_7_1_should_create_vehicle_with_new_names(self):
+        payload = {
+            'vehicle_name': 'MODEL S',
+            'release_year': 2019,
+            'price': 500.00,
+            'segment_name': 'Sedan',
+            'brand_name': 'Tesla',
+        }
+        res = self.client.post(VEHICLES_URL, payload)
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data['segment_name'], 'Sedan')
+        self.assertEqual(res.data['brand_name'], 'Tesla')
+
+        vehicle = Vehicle.objects.get(id=res.data['id'])
+        self.assertEqual(vehicle.segment, Segment.objects.get(segment_name='Sedan'))
+        self.assertEqual(vehicle.brand, Brand.objects.get(brand_name='Tesla'))
+
+    # 既にある名前のときは、新しく作らずに既存のものを使う
+    def test_7_2_should_reuse_existing_names(self):
+        brand = Brand.objects.create(brand_name='Tesla')
+        for _ in range(2):
+            payload = {
+                'vehicle_name': 'MODEL S',
+                'release_year': 2019,
+                'price': 500.00,
+                'segment_name': 'Sedan',
+                'brand_name': 'Tesla',
+            }
+            res = self.client.post(VEHICLES_URL, payload)
+            self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(res.data['brand'], brand.id)
+
+        self.assertEqual(1, Brand.objects.count())
+        self.assertEqual(1, Segment.objects.count())
+        self.assertEqual(2, Vehicle.objects.count())
+
+    # IDも名前もなければBad request
+    def test_7_3_should_not_create_vehicle_without_brand(self):
+        payload = {
+            'vehicle_name': 'MODEL S',
+            'release_year': 2019,
+            'price': 500.00,
+            'segment_name': 'Sedan',
+        }
+        res = self.client.post(VEHICLES_URL, payload)
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('brand', res.data)
+        self.assertEqual(0, Segment.objects.count())
+
+    # 名前を変更したら、古い名前のキャッシュは使われない
+    def test_7_4_should_not_use_renamed_cache(self):
+        payload = {
+            'vehicle_name': 'MODEL S',
+            'release_year': 2019,
+            'price': 500.00,
+            'segment_name': 'Sedan',
+            'brand_name': 'Tesla',
+        }
+        # コミット後にキャッシュされるので、on_commitのコールバックを実行する
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post(VEHICLES_URL, payload)
+        brand = Brand.objects.get(id=res.data['brand'])
+        self.assertEqual(lookups._caches[Brand].get('Tesla'), brand.id)
+        brand.brand_name = 'Lexus'
+        brand.save()
+
+        res = self.client.post(VEHICLES_URL, payload)
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertNotEqual(res.data['brand'], brand.id)
+        self.assertEqual(res.data['brand_name'], 'Tesla')
+
+    # 同じ名前のbrandは作成できない
+    def test_7_5_should_not_create_duplicate_brand(self):
+        Brand.objects.create(brand_name='Tesla')
+        res = self.client.post('/api/brands/', {'brand_name': 'Tesla'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,170 @@
+# バッチリクエスト(/api/batch/)のテストコードを書くファイル
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.db.backends.signals import connection_created
+from django.test import TestCase, TransactionTestCase, override_settings
+from rest_framework import status
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from . import batch
+from .models import Brand, Segment, Vehicle
+
+# エンドポイントをあらかじめ定義しておく
+BATCH_URL = '/api/batch/'
+
+
+# テストのDBはトランザクションの中にあり、別スレッドの接続からは見えないので、
+# DBを読むテストは1スレッドで実行する
+@override_settings(API_BATCH={'MAX_WORKERS': 1})
+class AuthorizedBatchApiTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    # 複数のGETをまとめて実行し、同じ順番で結果が返る
+    def test_8_1_should_get_multiple_responses(self):
+        brand = Brand.objects.create(brand_name='Tesla')
+        payload = {'requests': [
+            {'method': 'GET', 'path': '/api/profile/'},
+            {'method': 'GET', 'path': '/api/brands/'},
+            {'method': 'GET', 'path': '/api/brands/{0}/'.format(brand.id)},
+        ]}
+        res = self.client.post(BATCH_URL, payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+        responses = res.data['responses']
+        self.assertEqual([r['status'] for r in responses], [200, 200, 200])
+        self.assertEqual(responses[0]['body']['username'], 'dummy')
+        self.assertEqual(responses[1]['body'], [{'id': brand.id, 'brand_name': 'Tesla'}])
+        self.assertEqual(responses[2]['body']['brand_name'], 'Tesla')
+
+    # 書き込みのあとの読み取りには、書き込んだ内容が反映されている
+    def test_8_2_should_run_writes_in_order(self):
+        payload = {'requests': [
+            {'method': 'POST', 'path': '/api/brands/', 'body': {'brand_name': 'Audi'}},
+            {'method': 'GET', 'path': '/api/brands/?format=json'},
+        ]}
+        res = self.client.post(BATCH_URL, payload, format='json')
+        responses = res.data['responses']
+        self.assertEqual(responses[0]['status'], status.HTTP_201_CREATED)
+        self.assertEqual(responses[1]['body'][0]['brand_name'], 'Audi')
+
+    # サブリクエストのエラーは、それぞれの結果として返る
+    def test_8_3_should_return_errors_per_sub_request(self):
+        payload = {'requests': [
+            {'method': 'GET', 'path': '/api/brands/999/'},
+            {'method': 'GET', 'path': '/api/unknown/'},
+            {'method': 'POST', 'path': '/api/brands/', 'body': {'brand_name': ''}},
+            {'method': 'POST', 'path': BATCH_URL, 'body': {'requests': []}},
+        ]}
+        res = self.client.post(BATCH_URL, payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([r['status'] for r in res.data['responses']], [404, 404, 400, 400])
+
+    # サブリクエストの数が多すぎるとBad request
+    @override_settings(API_BATCH={'MAX_REQUESTS': 2})
+    def test_8_4_should_not_run_too_many_requests(self):
+        payload = {'requests': [{'method': 'GET', 'path': '/api/profile/'}] * 3}
+        res = self.client.post(BATCH_URL, payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    # 読み取りのサブリクエストを並列に実行できる(profileはDBを読まない)
+    @override_settings(API_BATCH={'MAX_WORKERS': 4})
+    def test_8_5_should_run_reads_concurrently(self):
+        payload = {'requests': [{'method': 'GET', 'path': '/api/profile/'}] * 4}
+        res = self.client.post(BATCH_URL, payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([r['body']['username'] for r in res.data['responses']], ['dummy'] * 4)
+
+
+# 別スレッドの接続からも見えるように、データをコミットするTransactionTestCaseを使う
+@override_settings(API_BATCH={'MAX_WORKERS': 4})
+class ConcurrentBatchApiTests(TransactionTestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        # 常駐しているスレッドのDB接続を閉じておく
+        batch.shutdown_pool()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.segment = Segment.objects.create(segment_name='Sedan')
+        self.brand = Brand.objects.create(brand_name='Tesla')
+        self.vehicle = Vehicle.objects.create(user=self.user, segment=self.segment, brand=self.brand,
+                                              vehicle_name='MODEL S', release_year=2019, price=500)
+        self.payload = {'requests': [
+            {'method': 'GET', 'path': '/api/brands/'},
+            {'method': 'GET', 'path': '/api/segments/'},
+            {'method': 'GET', 'path': '/api/vehicles/'},
+            {'method': 'GET', 'path': '/api/vehicles/{0}/'.format(self.vehicle.id)},
+        ] * 2}
+
+    def post_batch(self):
+        created = []
+
+        def on_connection_created(sender, connection, **kwargs):
+            created.append(connection)
+
+        connection_created.connect(on_connection_created)
+        try:
+            res = self.client.post(BATCH_URL, self.payload, format='json')
+        finally:
+            connection_created.disconnect(on_connection_created)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return res.data['responses'], created
+
+    # DBを読むサブリクエストを並列に実行でき、スレッドのDB接続はバッチをまたいで使い回す
+    # (どのスレッドがどのサブリクエストを取るかは決まらないので、接続の数がスレッドの数を超えないことを確認する)
+    def test_8_6_should_reuse_connections_for_concurrent_reads(self):
+        batch.shutdown_pool()
+        created = []
+        for _ in range(3):
+            responses, new_connections = self.post_batch()
+            created += new_connections
+            self.assertEqual([r['status'] for r in responses], [200] * 8)
+            self.assertEqual(responses[0]['body'], [{'id': self.brand.id, 'brand_name': 'Tesla'}])
+            self.assertEqual(responses[1]['body'][0]['segment_name'], 'Sedan')
+            self.assertEqual(responses[2]['body'][0]['vehicle_name'], 'MODEL S')
+            self.assertEqual(responses[3]['body']['brand_name'], 'Tesla')
+            self.assertEqual(responses[4:], responses[:4])
+        self.assertGreater(len(created), 0)
+        self.assertLessEqual(len(created), 4)
+
+
+class UnauthorizedBatchApiTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    # Token認証が通っていなければバッチは実行できない
+    def test_8_7_should_not_run_batch_when_unauthorized(self):
+        payload = {'requests': [{'method': 'GET', 'path': '/api/brands/'}]}
+        res = self.client.post(BATCH_URL, payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(API_BATCH={'MAX_WORKERS': 1})
+class TokenBatchApiTests(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=self.user).key)
+
+    # token認証はバッチのリクエストで1回だけ行い、サブリクエストはBatchAuthenticationで同じユーザになる
+    def test_8_8_should_authenticate_sub_requests_once(self):
+        payload = {'requests': [{'method': 'GET', 'path': '/api/profile/'}] * 3}
+        with mock.patch.object(TokenAuthentication, 'authenticate_credentials', autospec=True,
+                               side_effect=TokenAuthentication.authenticate_credentials) as check_token, \
+                mock.patch.object(batch.BatchAuthentication, 'authenticate', autospec=True,
+                                  side_effect=batch.BatchAuthentication.authenticate) as batch_authenticate:
+            res = self.client.post(BATCH_URL, payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([r['body']['username'] for r in res.data['responses']], ['dummy'] * 3)
+        self.assertEqual(check_token.call_count, 1)
+        self.assertEqual(batch_authenticate.call_count, 3)
@@ -0,0 +1,81 @@
+# vehicleのレスポンスキャッシュのテストコードを書くファイル
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from .models import Brand, Segment
+from .response_cache import response_cache
+from .testing import create_vehicle
+
+# エンドポイントをあらかじめ定義しておく
+VEHICLES_URL = '/api/vehicles/'
+CACHE_STATS_URL = '/api/vehicles/cache-stats/'
+
+
+@override_settings(API_RESPONSE_CACHE={'ENABLED': True, 'MAX_ENTRIES': 2})
+class VehicleResponseCacheTests(TestCase):
+
+    def setUp(self):
+        response_cache.clear()
+        self.user = get_user_model().objects.create_user(username='dummy', password='dummy_pw')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.segment = Segment.objects.create(segment_name='Sedan')
+        self.brand = Brand.objects.create(brand_name='Tesla')
+        self.vehicle = create_vehicle(self.user, self.segment, self.brand)
+
+    def tearDown(self):
+        response_cache.clear()
+
+    # 2回目のGETはキャッシュから返り、内容は同じ
+    def test_9_1_should_serve_list_from_cache(self):
+        first = self.client.get(VEHICLES_URL, {'format': 'json'})
+        second = self.client.get(VEHICLES_URL, {'format': 'json'})
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(response_cache.hits, 1)
+        self.assertEqual(response_cache.misses, 1)
+
+    # Vehicleに書き込みがあると、キャッシュは使われない
+    def test_9_2_should_invalidate_on_vehicle_write(self):
+        self.client.get(VEHICLES_URL, {'format': 'json'})
+        create_vehicle(self.user, self.segment, self.brand, vehicle_name='MODEL X')
+        res = self.client.get(VEHICLES_URL, {'format': 'json'})
+        self.assertEqual(len(res.json()), 2)
+        self.assertEqual(response_cache.hits, 0)
+
+    # Brandの名前を変更すると、詳細のキャッシュも無効になる
+    def test_9_3_should_invalidate_on_brand_rename(self):
+        url = reverse('api:vehicle-detail', args=[self.vehicle.id])
+        self.client.get(url, {'format': 'json'})
+        self.brand.brand_name = 'Lexus'
+        self.brand.save()
+        res = self.client.get(url, {'format': 'json'})
+        self.assertEqual(res.json()['brand_name'], 'Lexus')
+
+    # クエリパラメータの順番が違っても、同じキャッシュを使う
+    def test_9_4_should_normalize_query_parameters(self):
+        self.client.get(VEHICLES_URL + '?format=json&a=1')
+        self.client.get(VEHICLES_URL + '?a=1&format=json')
+        self.assertEqual(response_cache.hits, 1)
+
+    # MAX_ENTRIESを超えたら古いものから追い出される
+    def test_9_5_should_evict_least_recently_used(self):
+        for i in range(3):
+            self.client.get(VEHICLES_URL, {'format': 'json', 'page': i})
+        stats = response_cache.stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['evictions'], 1)
+
+    # 統計は管理者だけが見られる
+    def test_9_6_should_get_stats_only_for_staff(self):
+        res = self.client.get(CACHE_STATS_URL)
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.user.is_staff = True
+        self.user.save()
+        res = self.client.get(CACHE_STATS_URL)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertIn('hit_rate', res.data)
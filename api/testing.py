@@ -0,0 +1,184 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from unittest import SkipTest
+
+from django.conf import settings
+from django.db import connections
+from django.test import TestCase
+from django.test import runner
+from django.test.runner import DiscoverRunner, ParallelTestSuite, default_test_processes
+from django.test.utils import override_settings
+
+from . import seed
+from .models import Vehicle
+
+# テストの実行(settings.pyのTEST_RUNNER)
+#
+# ・デフォルトでCPUのコア数だけプロセスを使って並列に実行する(--parallel 1で直列)
+# ・テスト中のパスワードのハッシュは軽いMD5にする(setUpのたびにPBKDF2を計算しない)
+# ・共有メモリのスロットル・キャッシュ無効化のファイルと、ワーカー間で共有するキャッシュ(CACHESのshared)は、
+#   実行ごとの一時ディレクトリに作る
+#   (前回の実行や、同時に動いているほかの実行の状態を引き継がない)
+#   並列実行のときは、さらにワーカーごとのディレクトリに分ける(ほかのワーカーのテストの書き込みが見えない)
+# ・perfタグの性能テストは、--tag perfを指定したときだけ実行する
+#   そのときはテストDBに大きなデータセット(api.seed)を1回だけ入れてから、ワーカーごとに複製する
+# ・最後に、かかった時間(wall time)を表示する
+#
+# 例: python manage.py test                 … APIのテストを並列に実行
+#     python manage.py test --tag perf      … 性能テストを並列に実行
+#     python manage.py test_wall_time       … 直列と並列の時間を比べる
+
+PERF_TAG = 'perf'
+FAST_PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+# 実行ごとの一時ディレクトリ(forkしたワーカーにも引き継がれる)
+_tmpdir = None
+
+
+def isolated_settings(directory):
+    # ファイルを使う状態を、すべてdirectoryの中に作る設定
+    os.makedirs(directory, exist_ok=True)
+    caches = {alias: dict(conf) for alias, conf in settings.CACHES.items()}
+    for alias, conf in caches.items():
+        if conf['BACKEND'].endswith('FileBasedCache'):
+            conf['LOCATION'] = os.path.join(directory, 'cache-{0}'.format(alias))
+    return override_settings(
+        CACHES=caches,
+        API_THROTTLE=dict(getattr(settings, 'API_THROTTLE', {}), PATH=os.path.join(directory, 'throttle')),
+        API_INVALIDATION_BUS=dict(getattr(settings, 'API_INVALIDATION_BUS', {}),
+                                  PATH=os.path.join(directory, 'invalidation')),
+    )
+
+
+def _init_worker(counter):
+    # multiprocessingの都合で、モジュールのトップレベルに置いている
+    runner._init_worker(counter)
+    isolated_settings(os.path.join(_tmpdir, 'worker-{0}'.format(runner._worker_id))).enable()
+
+
+class ApiParallelTestSuite(ParallelTestSuite):
+    init_worker = _init_worker
+
+
+class ApiTestRunner(DiscoverRunner):
+    parallel_test_suite = ApiParallelTestSuite
+
+    def __init__(self, parallel=0, seed_scale=None, **kwargs):
+        if parallel == 0:
+            parallel = default_test_processes()
+        super().__init__(parallel=parallel, **kwargs)
+        if PERF_TAG not in self.tags:
+            self.exclude_tags.add(PERF_TAG)
+        self.seed_scale = seed_scale or seed.seed_settings()['SCALE']
+        self.started_at = None
+
+    @classmethod
+    def add_arguments(cls, parser):
+        super().add_arguments(parser)
+        # --parallelを指定しなければ、コア数だけ使う
+        parser.set_defaults(parallel=0)
+        parser.add_argument('--seed-scale', type=int, help='Number of vehicles seeded for --tag perf')
+
+    @property
+    def seeds(self):
+        return PERF_TAG in self.tags
+
+    def setup_test_environment(self, **kwargs):
+        self.started_at = time.perf_counter()
+        super().setup_test_environment(**kwargs)
+        global _tmpdir
+        self.tmpdir = _tmpdir = tempfile.mkdtemp(prefix='rest_api-test-')
+        self.test_settings = [override_settings(PASSWORD_HASHERS=FAST_PASSWORD_HASHERS), isolated_settings(self.tmpdir)]
+        for test_settings in self.test_settings:
+            test_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        for test_settings in reversed(self.test_settings):
+            test_settings.disable()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
+
+    def setup_databases(self, **kwargs):
+        if not self.seeds:
+            return super().setup_databases(**kwargs)
+
+        # データセットを入れてからワーカー用に複製したいので、作成と複製を分けている
+        parallel, self.parallel = self.parallel, 0
+        try:
+            old_config = super().setup_databases(**kwargs)
+        finally:
+            self.parallel = parallel
+        start = time.perf_counter()
+        from_snapshot = seed.load(self.seed_scale)
+        if self.verbosity >= 1:
+            self.log('Seeded {0} vehicles {1} in {2:.2f}s.'.format(
+                self.seed_scale, 'from snapshot' if from_snapshot else 'and saved a snapshot',
+                time.perf_counter() - start))
+        if self.parallel > 1:
+            connection = connections['default']
+            for index in range(self.parallel):
+                # メモリ上のSQLiteはforkで複製されるので、ここでは何もしない(ファイルのときはコピーする)
+                connection.creation.clone_test_db(suffix=str(index + 1), verbosity=self.verbosity,
+                                                  keepdb=self.keepdb)
+        return old_config
+
+    def log(self, message):
+        sys.stderr.write(message + '\n')
+
+    def run_tests(self, test_labels, extra_tests=None, **kwargs):
+        result = super().run_tests(test_labels, extra_tests, **kwargs)
+        if self.verbosity >= 1:
+            self.log('Wall time: {0:.2f}s ({1} process{2}).'.format(
+                time.perf_counter() - self.started_at, self.parallel, 'es' if self.parallel > 1 else ''))
+        return result
+
+
+def create_vehicle(user, segment, brand, **params):
+    # テスト用のvehicleを作る(指定しなかった項目は固定の値)
+    defaults = {
+        'vehicle_name': 'MODEL S',
+        'release_year': 2019,
+        'price': 500.00,
+    }
+    defaults.update(params)
+    return Vehicle.objects.create(user=user, segment=segment, brand=brand, **defaults)
+
+
+def temp_directory(testcase):
+    # テストが終わったら消える一時ディレクトリ
+    directory = Path(tempfile.mkdtemp())
+    testcase.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+    return directory
+
+
+def enable_settings(testcase, **kwargs):
+    # setUpの中で設定を変え、テストが終わったら戻す
+    override = override_settings(**kwargs)
+    override.enable()
+    testcase.addCleanup(override.disable)
+
+
+class SeededTestCase(TestCase):
+    # 性能テストのベースクラス
+    # ApiTestRunnerが入れたデータセットを使う(各テストはトランザクションの中で実行され、最後に戻される)
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.seed_counts = seed.counts()
+        if not cls.seed_counts['vehicles']:
+            cls.tearDownClass()
+            raise SkipTest('No seeded data: run with "python manage.py test --tag perf"')
+
+    @contextmanager
+    def timed(self, name):
+        # 計測した時間を表示する
+        start = time.perf_counter()
+        yield
+        elapsed = (time.perf_counter() - start) * 1000
+        sys.stderr.write('\n[perf] {0}.{1}: {2:.1f} ms\n'.format(type(self).__name__, name, elapsed))
@@ -0,0 +1,205 @@
+import abc
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from rest_framework.throttling import BaseThrottle
+
+# 同じホストのワーカープロセスで状態を共有するトークンバケット方式のスロットル
+#
+# DRF標準のスロットルはキャッシュを使うので、リクエストのたびにキャッシュへの往復が発生する
+# こちらは/dev/shmのファイルをmmapした固定サイズのハッシュテーブルにバケットを置くので、
+# 1回のチェックはロックとメモリの読み書きだけで済む(数マイクロ秒)
+#
+# ・SharedMemoryUserThrottle  … ユーザごと(未ログインはIPごと)の制限(USER_RATE)
+# ・SharedMemoryRouteThrottle … URL名ごと・ユーザごとの制限(ROUTE_RATES)
+# 制限に引っかかったリクエストは429になり、DRFがRetry-Afterヘッダを付ける
+#
+# バケットはプロセスが終わっても残り、同じファイルを使うプロセス(開発サーバ、コマンドなど)で共有されるので、
+# 使うときだけENABLEDをTrueにする
+# PATHを指定しなければ、プロジェクトの場所とsettingsのモジュールごとに別のファイルになる
+
+DEFAULTS = {
+    'ENABLED': False,
+    # Noneのときは/dev/shm(なければ一時ディレクトリ)に、プロジェクトとsettingsごとの名前で作る
+    'PATH': None,
+    # バケットの数。埋まったら一番古いバケットを再利用する
+    'SLOTS': 65536,
+    'USER_RATE': '600/min',
+    'ROUTE_RATES': {},
+}
+
+# 1スロット = キーのハッシュ(8バイト) + 残りトークン数(double) + 最終更新時刻(double)
+SLOT = struct.Struct('<Qdd')
+# ハッシュから決まるグループ内の8スロットだけを探す(ロックもグループ単位)
+GROUP_SIZE = 8
+
+
+_conf = None
+
+
+def throttle_settings():
+    # リクエストのたびに呼ばれるので、設定は1回だけ組み立ててとっておく
+    global _conf
+    if _conf is None:
+        conf = dict(DEFAULTS)
+        conf.update(getattr(settings, 'API_THROTTLE', {}))
+        if conf['PATH'] is None:
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            conf['PATH'] = os.path.join(directory, 'rest_api-throttle-{0}'.format(project_suffix()))
+        _conf = conf
+    return _conf
+
+
+def project_suffix():
+    # 同じホストのほかのプロジェクトやsettingsとファイルを共有しないように、名前に付ける
+    key = '{0}:{1}'.format(settings.BASE_DIR, settings.SETTINGS_MODULE)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+
+def _reset_settings(setting, **kwargs):
+    # テストでoverride_settingsしたときに読み直す
+    global _conf
+    if setting == 'API_THROTTLE':
+        _conf = None
+
+
+setting_changed.connect(_reset_settings, dispatch_uid='api.throttling.reset_settings')
+
+
+def parse_rate(rate):
+    # '100/min'のような指定を(リクエスト数, 秒数)にする(DRFと同じ書式)
+    num, period = rate.split('/')
+    return int(num), {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[period[0]]
+
+
+class SharedBuckets:
+    # mmapしたファイル上のトークンバケットのテーブル
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.groups = max(slots // GROUP_SIZE, 1)
+        size = self.groups * GROUP_SIZE * SLOT.size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # ほかのプロセスが先に作っていれば、そのまま使う
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        # fcntlのロックはプロセス単位なので、同じプロセスのスレッド間はこちらで排他する
+        self.thread_lock = threading.Lock()
+
+    def consume(self, key, capacity, refill_per_second, now=None):
+        # トークンを1つ使う。使えたら0、足りなければ次に使えるまでの秒数を返す
+        digest = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+        group = digest % self.groups
+        start = group * GROUP_SIZE * SLOT.size
+        length = GROUP_SIZE * SLOT.size
+        now = time.time() if now is None else now
+
+        with self.thread_lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, length, start)
+            try:
+                offset, tokens, updated = self.find_slot(digest, start, now)
+                tokens = min(capacity, tokens + (now - updated) * refill_per_second)
+                if tokens >= 1:
+                    wait = 0.0
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / refill_per_second
+                SLOT.pack_into(self.map, offset, digest, tokens, now)
+                return wait
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, length, start)
+
+    def find_slot(self, digest, start, now):
+        # グループ内から同じキーのスロットを探す。なければ空きか一番古いスロットを使う
+        oldest = None
+        for i in range(GROUP_SIZE):
+            offset = start + i * SLOT.size
+            slot_digest, tokens, updated = SLOT.unpack_from(self.map, offset)
+            if slot_digest == digest:
+                return offset, tokens, updated
+            if oldest is None or updated < oldest[1]:
+                oldest = (offset, updated)
+        # 新しいバケットは満タンから始める
+        return oldest[0], float('inf'), now
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+_buckets = None
+_buckets_lock = threading.Lock()
+
+
+def get_buckets():
+    global _buckets
+    conf = throttle_settings()
+    if _buckets is None or _buckets.path != conf['PATH']:
+        with _buckets_lock:
+            if _buckets is None or _buckets.path != conf['PATH']:
+                _buckets = SharedBuckets(conf['PATH'], conf['SLOTS'])
+    return _buckets
+
+
+# 共有メモリのバケットを使うスロットルのベースクラス
+# サブクラスでget_rate(Noneなら制限しない)とget_cache_key(バケットのキー)を決める
+class SharedMemoryThrottle(BaseThrottle, metaclass=abc.ABCMeta):
+
+    @abc.abstractmethod
+    def get_rate(self, request, view):
+        pass
+
+    @abc.abstractmethod
+    def get_cache_key(self, request, view):
+        pass
+
+    def client_ident(self, request):
+        if request.user and request.user.is_authenticated:
+            return 'user:{0}'.format(request.user.pk)
+        return 'ip:{0}'.format(self.get_ident(request))
+
+    def allow_request(self, request, view):
+        self.wait_seconds = None
+        rate = self.get_rate(request, view) if throttle_settings()['ENABLED'] else None
+        if rate is None:
+            return True
+        num_requests, duration = parse_rate(rate)
+        wait = get_buckets().consume(self.get_cache_key(request, view), num_requests, num_requests / duration)
+        if wait > 0:
+            self.wait_seconds = wait
+            return False
+        return True
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class SharedMemoryUserThrottle(SharedMemoryThrottle):
+
+    def get_rate(self, request, view):
+        return throttle_settings()['USER_RATE']
+
+    def get_cache_key(self, request, view):
+        return self.client_ident(request)
+
+
+class SharedMemoryRouteThrottle(SharedMemoryThrottle):
+
+    def route_name(self, request):
+        match = request.resolver_match
+        return match.view_name if match is not None else None
+
+    def get_rate(self, request, view):
+        return throttle_settings()['ROUTE_RATES'].get(self.route_name(request))
+
+    def get_cache_key(self, request, view):
+        return 'route:{0}:{1}'.format(self.route_name(request), self.client_ident(request))
@@ -1,14 +1,18 @@
+from django.conf import settings
 from django.urls import path, include
-# DRFのtoken認証するため
-from rest_framework.authtoken.views import obtain_auth_token
 # DRFのrouterを使う
-from rest_framework.routers import DefaultRouter
+from rest_framework.routers import DefaultRouter, SimpleRouter
 # Viewのインポート
 from . import views
 
 
 # viewでviewsets配下を継承してきたものは、DRFのrouterを使ってエンドポイントを決める
-router = DefaultRouter()
+# API_ROOT_VIEWがFalseのときは、APIルートのViewとフォーマット拡張子(.json等)のURLを作らない
+# URLパターンの数が半分以下になり、URLの解決が軽くなる
+if getattr(settings, 'API_ROOT_VIEW', True):
+    router = DefaultRouter()
+else:
+    router = SimpleRouter()
 router.register('segments', views.SegmentViewSet)
 router.register('brands', views.BrandViewSet)
 router.register('vehicles', views.VehicleViewSet)
@@ -21,8 +25,14 @@ urlpatterns = [
     path('profile/', views.ProfileUserView.as_view(), name='profile'),
     # tokenを返してくれるエンドポイント
     # usernameとpasswordでアクセスしたときに、そのユーザのtokenを取得する
-    # DRFで標準で備わっているobtain_auth_tokenというviewを紐付けることで実現可能
-    path('auth/', obtain_auth_token, name='auth'),
+    # DRFで標準で備わっているObtainAuthTokenにスロットルを付けたviewを紐付けている
+    path('auth/', views.ObtainAuthTokenView.as_view(), name='auth'),
+    # 複数のリクエストをまとめて実行するエンドポイント
+    path('batch/', views.BatchView.as_view(), name='batch'),
+    # 遅いSQLの集計(管理者のみ)
+    path('slow-queries/', views.SlowQueryView.as_view(), name='slow-queries'),
+    # ワーカーのウォームアップが終わっているか(readinessチェック用)
+    path('ready/', views.ReadinessView.as_view(), name='ready'),
     # routerのパスへアクセスがあった場合、routerに飛ばす
     path('', include(router.urls)),
 ]
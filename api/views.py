@@ -1,12 +1,40 @@
 from django.shortcuts import render
-from rest_framework import generics, permissions, viewsets, status
+from django.conf import settings
+from django.db import transaction
+from django.http import FileResponse, Http404, HttpResponse
+from django.urls import reverse
+from rest_framework import exceptions, generics, permissions, viewsets, status
+from rest_framework.decorators import action
 # 作成したserializerをインポート
-from .serializers import UserSerializer, SegmentSerializer, BrandSerializer, VehicleSerializer
+from .serializers import (UserSerializer, SegmentSerializer, BrandSerializer, VehicleSerializer,
+                          VehicleListingSerializer, BatchRequestSerializer)
 # 作成したモデルもインポート
-from .models import User, Segment, Brand, Vehicle
+from .models import Segment, Brand, Vehicle, VehicleListing, ArchivedVehicle
 # DRFのresponseをインポート
 from rest_framework.response import Response
-
+from rest_framework.views import APIView
+from rest_framework.authtoken.views import ObtainAuthToken
+from rest_framework.settings import api_settings
+# 読み取りレプリカへのルーティング
+from . import db_routers
+# Vehicleのまとめて書き込み(write-behind)
+from . import ingest
+# 複数のサブリクエストをまとめて実行する
+from . import batch
+# vehicleのレスポンスキャッシュ
+from .response_cache import CachedResponse, response_cache, cache_settings
+# 同時に来た同じGETリクエストをまとめる
+from . import coalesce
+# ほかのワーカーからのキャッシュの無効化
+from . import invalidation
+# 遅いSQLの集計
+from .slow_queries import slow_query_log
+# 分析用の列指向スナップショット
+from . import snapshot
+# ワーカーのウォームアップ
+from . import warmup
+# 古いvehicleのコールドテーブル
+from . import archive
 
 # Create your views here.
 
@@ -43,26 +71,293 @@ class ProfileUserView(generics.RetrieveUpdateAPIView):
         return Response(response, status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
 
+# tokenを返すView
+# DRFのObtainAuthTokenはスロットルを使わない設定になっているので、
+# パスワードの総当たりを防ぐためにデフォルトのスロットルを付け直している
+class ObtainAuthTokenView(ObtainAuthToken):
+    throttle_classes = api_settings.DEFAULT_THROTTLE_CLASSES
+
+
+# 複数のAPIリクエストを1回のHTTPリクエストでまとめて実行するView
+# {"requests": [{"method": "GET", "path": "/api/brands/"}, ...]} を受け取り、
+# {"responses": [{"status": 200, "body": ...}, ...]} を同じ順番で返す
+class BatchView(APIView):
+
+    def post(self, request, *args, **kwargs):
+        serializer = BatchRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        subs = serializer.validated_data['requests']
+        conf = batch.batch_settings()
+        if len(subs) > conf['MAX_REQUESTS']:
+            response = {'message': 'Too many requests in a batch (max {0})'.format(conf['MAX_REQUESTS'])}
+            return Response(response, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'responses': batch.run(request, subs, conf['MAX_WORKERS'])})
+
+
+# ワーカーのウォームアップ(api.warmup)が終わっているかを返すView
+# ロードバランサから呼ばれるので、認証とスロットルはかけない
+class ReadinessView(APIView):
+    authentication_classes = []
+    permission_classes = [permissions.AllowAny]
+    throttle_classes = []
+
+    def get(self, request, *args, **kwargs):
+        result = warmup.state.as_dict()
+        code = status.HTTP_200_OK if result['ready'] else status.HTTP_503_SERVICE_UNAVAILABLE
+        return Response(result, status=code)
+
+
+# APIから実行された遅いSQLの集計を、合計時間の大きい順に返すView(管理者のみ)
+class SlowQueryView(APIView):
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        limit = request.query_params.get('limit')
+        limit = int(limit) if limit and limit.isdigit() else None
+        return Response(slow_query_log.top(limit))
+
+
+# routerに登録するViewSetで使うMixin
+# GETなど安全なメソッドのリクエストはレプリカから読み取り、書き込みはprimaryへ送る
+class ReplicaRoutingMixin:
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            # スレッドは次のリクエストでも使い回されるので、必ず状態を戻しておく
+            db_routers.reset()
+
+    # initial()は認証が終わったあとに呼ばれるので、ここでrequest.userを参照できる
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in permissions.SAFE_METHODS:
+            # 直前に書き込みをしたユーザは、自分の書き込みが見えるようにprimaryから読む
+            if not db_routers.is_pinned(request.user):
+                db_routers.use_replica()
+
+    # 書き込みが成功したときだけ固定する(400/403/405などで弾かれたリクエストでは固定しない)
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if request.method not in permissions.SAFE_METHODS and status.is_success(response.status_code):
+            db_routers.pin(request.user)
+        return response
+
+
+# list/retrieveのレスポンスを、レンダリング済みのバイト列でキャッシュするMixin
+# キーは 世代番号 + 読み取り先(レプリカ/primary) + View + 権限のスコープ + レスポンスの形式 + 正規化したクエリパラメータ
+# 読み取り先をキーに入れるのは、書き込んだあとでprimaryに固定されたユーザに、
+# ほかのユーザがレプリカから読んだ結果(自分の書き込みが見えていないかもしれない)を返さないようにするため
+# settings.pyのAPI_RESPONSE_CACHE['ENABLED']がTrueのときだけキャッシュする
+# API_COALESCE['ENABLED']がTrueのときは、同じキーで同時に来たWSGIのリクエストを1回の計算にまとめる(api.coalesce)
+class ResponseCacheMixin:
+
+    # どのユーザに見せてよいデータかを表す文字列
+    # 今はログインしていれば全員が同じvehicleを見られるので、ユーザごとに分けていない
+    def response_cache_scope(self, request):
+        return 'authenticated'
+
+    def response_cache_key(self, request, generation):
+        query = tuple(sorted((key, tuple(values)) for key, values in request.query_params.lists()))
+        source = 'replica' if db_routers.reads_from_replica() else 'primary'
+        return (generation, source, self.basename, self.action, tuple(sorted(self.kwargs.items())),
+                self.response_cache_scope(request), request.accepted_media_type, query)
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        use_cache = cache_settings()['ENABLED']
+        coalesce_conf = coalesce.coalesce_settings()
+        use_coalesce = coalesce_conf['ENABLED'] and coalesce.supported(request._request)
+        if not use_cache and not use_coalesce:
+            return handler(request, *args, **kwargs)
+
+        # ほかのワーカーでの書き込みを反映してから、世代番号を読む
+        invalidation.poll()
+        key = self.response_cache_key(request, response_cache.generation)
+        if use_cache:
+            entry = response_cache.get(key)
+            if entry is not None:
+                return self.entry_response(entry)
+
+        if not use_coalesce:
+            response = handler(request, *args, **kwargs)
+            self.render_entry(request, response, key if use_cache else None)
+            return response
+
+        # 自分が計算した場合は、そのレスポンスをそのまま返す
+        own = []
+
+        def compute():
+            response = handler(request, *args, **kwargs)
+            own.append(response)
+            return self.render_entry(request, response, key if use_cache else None)
+
+        entry = coalesce.flights.do(key, compute, coalesce_conf['TIMEOUT'])
+        if own:
+            return own[0]
+        if entry is None:
+            # 待っていたリクエストが200以外・例外・タイムアウトだったときは自分で処理する
+            return handler(request, *args, **kwargs)
+        return self.entry_response(entry)
+
+    def render_entry(self, request, response, cache_key=None):
+        # 200のレスポンスをレンダリングしてCachedResponseを返す(cache_keyがあればキャッシュもする)
+        if response.status_code != status.HTTP_200_OK:
+            return None
+        # finalize_response()より前にレンダリングして、バイト列を取り出す
+        response.accepted_renderer = request.accepted_renderer
+        response.accepted_media_type = request.accepted_media_type
+        response.renderer_context = self.get_renderer_context()
+        response.render()
+        entry = CachedResponse(response.content, response['Content-Type'])
+        if cache_key is not None:
+            response_cache.set(cache_key, entry)
+        response.precompressed = entry
+        return entry
+
+    def entry_response(self, entry):
+        response = HttpResponse(entry.content, content_type=entry.content_type)
+        # 圧縮のミドルウェアが、圧縮済みのバイト列を使えるようにする
+        response.precompressed = entry
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
+
+
+# 作成・更新・削除をトランザクションの中で行うMixin
+# シグナルで更新する非正規化テーブル(VehicleListing)が、書き込みと一緒にコミットされるようにする
+class AtomicWriteMixin:
+
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            super().perform_create(serializer)
+
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            super().perform_update(serializer)
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            super().perform_destroy(instance)
+
+
 # SegmentのViewにはCRUDすべて使用できるようにしたいので、viewsetsから継承する
-class SegmentViewSet(viewsets.ModelViewSet):
+class SegmentViewSet(AtomicWriteMixin, ResponseCacheMixin, ReplicaRoutingMixin, viewsets.ModelViewSet):
     # querysetにオブジェクト一覧を割り当てる
     queryset = Segment.objects.all()
     serializer_class = SegmentSerializer
 
 # BrandのViewも同様にCRUDすべて使用
-class BrandViewSet(viewsets.ModelViewSet):
+class BrandViewSet(AtomicWriteMixin, ResponseCacheMixin, ReplicaRoutingMixin, viewsets.ModelViewSet):
     queryset = Brand.objects.all()
     serializer_class = BrandSerializer
 
 # VehicleのView
-class VehicleViewSet(viewsets.ModelViewSet):
+class VehicleViewSet(AtomicWriteMixin, ResponseCacheMixin, ReplicaRoutingMixin, viewsets.ModelViewSet):
     queryset = Vehicle.objects.all()
     serializer_class = VehicleSerializer
 
-    # Vehicleを新規作成するとき、Vehicleのuser属性にDjango側でログイン中のユーザを自動的に設定して作成するには
-    # perform_create()メソッドをオーバライトする
-    def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+    # 詳細をコールドテーブル(ArchivedVehicle)から読んだときにTrueにする
+    from_archive = False
+
+    # 一覧で?archived=include(ホット+コールド)か?archived=only(コールドだけ)が指定されていれば、その値を返す
+    def archived_scope(self):
+        if self.action != 'list':
+            return None
+        value = self.request.query_params.get('archived')
+        if value is None:
+            return None
+        if value not in (archive.ARCHIVED_INCLUDE, archive.ARCHIVED_ONLY):
+            raise exceptions.ValidationError({'archived': ['Must be one of: include, only.']})
+        return value
+
+    # settings.pyのVEHICLE_LISTING_READ_MODELがTrueのとき、一覧・詳細は非正規化したテーブルから読む
+    # (一覧用のテーブルはホットテーブルの分しかないので、コールドテーブルを読むときは使わない)
+    def uses_listing(self):
+        return (self.action in ('list', 'retrieve') and getattr(settings, 'VEHICLE_LISTING_READ_MODEL', False)
+                and not self.from_archive and self.archived_scope() is None)
+
+    def get_queryset(self):
+        scope = self.archived_scope()
+        if scope is not None:
+            return archive.vehicles_queryset(scope)
+        if self.uses_listing():
+            return VehicleListing.objects.all()
+        return super().get_queryset()
+
+    # コールドテーブルへ移動したvehicleも、同じURLで詳細を読めるようにする
+    def get_object(self):
+        try:
+            return super().get_object()
+        except Http404:
+            if self.action != 'retrieve':
+                raise
+        self.from_archive = True
+        instance = generics.get_object_or_404(ArchivedVehicle.objects.all(), pk=self.kwargs[self.lookup_field])
+        self.check_object_permissions(self.request, instance)
+        return instance
+
+    def get_serializer_class(self):
+        if self.uses_listing():
+            return VehicleListingSerializer
+        return super().get_serializer_class()
+
+    # 「Prefer: respond-async」ヘッダが付いたPOSTは、検証だけしてキューに積み、202を返す
+    # settings.pyのVEHICLE_INGEST['ENABLED']がTrueのときだけ有効
+    def create(self, request, *args, **kwargs):
+        prefer = request.headers.get('Prefer', '')
+        if not ingest.ingest_settings()['ENABLED'] or 'respond-async' not in prefer:
+            return super().create(request, *args, **kwargs)
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        tracking_id = ingest.get_queue().submit(serializer.validated_data, request.user)
+        location = reverse('api:vehicle-ingest-status', args=[tracking_id])
+        response = {'tracking_id': tracking_id, 'status': ingest.STATUS_QUEUED}
+        return Response(response, status=status.HTTP_202_ACCEPTED, headers={'Location': location})
+
+    # キューに積んだVehicleの書き込み状況を返す
+    @action(detail=False, url_path=r'ingest/(?P<tracking_id>[0-9a-f]+)', url_name='ingest-status')
+    def ingest_status(self, request, tracking_id=None):
+        result = ingest.get_status(tracking_id)
+        if result is None:
+            return Response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(result)
+
+    # レスポンスキャッシュのヒット率などを返す(管理者のみ)
+    @action(detail=False, url_path='cache-stats', permission_classes=[permissions.IsAdminUser])
+    def cache_stats(self, request):
+        return Response(dict(response_cache.stats(), coalescing=coalesce.flights.stats()))
+
+    # Vehicle(+Brand/Segmentの名前)をParquetかArrow IPCのファイルで返す
+    # ?type=parquet(デフォルト)か?type=arrowで形式を選ぶ(formatはDRFが使うので別の名前にしている)
+    @action(detail=False)
+    def snapshot(self, request):
+        fmt = request.query_params.get('type', 'parquet')
+        if fmt not in snapshot.FORMATS:
+            return Response({'detail': 'type must be one of: {0}.'.format(', '.join(snapshot.FORMATS))},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            path, version, cached = snapshot.get_snapshot(fmt)
+        except snapshot.SnapshotUnavailable as exc:
+            return Response({'detail': str(exc)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        etag = '"catalog-v{0}-{1}"'.format(version, fmt)
+        if cached and request.headers.get('If-None-Match') == etag:
+            return HttpResponse(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        # FileResponseはwsgi.file_wrapperがあればsendfileでそのまま送る
+        f = open(path, 'rb')
+        if not cached:
+            # キャッシュしなかったファイルは、開いたあとに消しておく
+            path.unlink()
+        response = FileResponse(f, content_type=snapshot.FORMATS[fmt][1], as_attachment=True,
+                                filename='catalog-v{0}{1}'.format(version, snapshot.FORMATS[fmt][0]))
+        if cached:
+            response['ETag'] = etag
+        return response
 
 
 
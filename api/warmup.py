@@ -0,0 +1,155 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.urls import get_resolver, resolve, reverse
+
+logger = logging.getLogger(__name__)
+
+# ワーカーの起動時に、最初のリクエストで遅くなる処理を先に済ませておく(rest_api/wsgi.pyとasgi.pyから呼ぶ)
+#
+#  ・serializers … Vehicle/Brand/Segmentのserializerのフィールドを組み立てる(モデルの_metaのキャッシュも温まる)
+#  ・routes      … URLconfを読み込み、api:のURLをreverse/resolveしておく
+#  ・databases   … DATABASESの各DBに接続し、テーブルを軽く読んでおく
+#                  (接続はスレッドごとなので、リクエストを処理するスレッドで実行したときだけ使い回される。
+#                   CONN_MAX_AGEが0のときは最初のリクエストで閉じられるが、ドライバの読み込みとDBのキャッシュは温まる)
+#  ・lookups     … brand_name/segment_nameのキャッシュ(api.lookups)を読み込む
+#
+# 終わるまでは /api/ready/ が503を返すので、ロードバランサのreadinessチェックに使える
+# settings.pyのAPI_WARMUP['ENABLED']がTrueのときだけ実行する
+# サーバのプロセス(WSGI/ASGIのアプリケーションを読み込むプロセス)だけで実行され、
+# migrateなどmanage.pyのコマンドでは実行されない
+
+DEFAULTS = {
+    'ENABLED': False,
+    # Trueのときは別スレッドで実行し、ready()をすぐに返す
+    'BACKGROUND': False,
+    'STEPS': ['serializers', 'routes', 'databases', 'lookups'],
+    'ROUTES': ['api:segment-list', 'api:brand-list', 'api:vehicle-list', 'api:auth'],
+}
+
+STATUS_DISABLED = 'disabled'
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_READY = 'ready'
+
+
+def warmup_settings():
+    conf = dict(DEFAULTS)
+    conf.update(getattr(settings, 'API_WARMUP', {}))
+    return conf
+
+
+def warm_serializers(conf):
+    from .serializers import SegmentSerializer, BrandSerializer, VehicleSerializer, VehicleListingSerializer
+    count = 0
+    for serializer_class in (SegmentSerializer, BrandSerializer, VehicleSerializer, VehicleListingSerializer):
+        # fieldsはインスタンスごとに組み立てられるが、モデルの情報の読み込みやimportはここで済む
+        count += len(serializer_class().fields)
+        count += len(serializer_class(many=True).child.fields)
+    return count
+
+
+def warm_routes(conf):
+    resolver = get_resolver()
+    # reverse用の辞書を作らせる(URLconfのimportとパターンのコンパイルが行われる)
+    resolver.reverse_dict
+    for name in conf['ROUTES']:
+        resolve(reverse(name))
+    return len(conf['ROUTES'])
+
+
+def warm_databases(conf):
+    from .models import Segment, Brand, Vehicle
+    for alias in connections:
+        connections[alias].ensure_connection()
+        for model in (Segment, Brand, Vehicle):
+            model.objects.using(alias).exists()
+    return len(connections.all())
+
+
+def warm_lookups(conf):
+    from . import lookups
+    return lookups.preload()
+
+
+STEPS = {
+    'serializers': warm_serializers,
+    'routes': warm_routes,
+    'databases': warm_databases,
+    'lookups': warm_lookups,
+}
+
+
+class WarmupState:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, status=STATUS_DISABLED):
+        with self._lock:
+            self.status = status
+            self.steps = {}
+            self.errors = {}
+            self.started_at = None
+            self.finished_at = None
+
+    def run(self, conf):
+        with self._lock:
+            self.status = STATUS_RUNNING
+            self.started_at = time.time()
+        for name in conf['STEPS']:
+            start = time.perf_counter()
+            try:
+                result = STEPS[name](conf)
+            except Exception as exc:
+                # 失敗しても残りのステップは続ける(リクエストの処理で同じ処理がやり直される)
+                logger.warning('Warm-up step %s failed: %s', name, exc)
+                with self._lock:
+                    self.errors[name] = str(exc)
+                continue
+            with self._lock:
+                self.steps[name] = {'ms': round((time.perf_counter() - start) * 1000, 3), 'result': result}
+        with self._lock:
+            self.status = STATUS_READY
+            self.finished_at = time.time()
+        logger.info('Warm-up finished in %.1f ms', (self.finished_at - self.started_at) * 1000)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'status': self.status,
+                'ready': self.status in (STATUS_READY, STATUS_DISABLED),
+                'steps': dict(self.steps),
+                'errors': dict(self.errors),
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+            }
+
+
+state = WarmupState()
+
+
+def start():
+    # rest_api/wsgi.pyとasgi.pyで、アプリケーションを作ったあとに呼ばれる
+    conf = warmup_settings()
+    if not conf['ENABLED']:
+        return None
+    state.reset(STATUS_PENDING)
+    if not conf['BACKGROUND']:
+        state.run(conf)
+        return None
+    thread = threading.Thread(target=run_in_thread, args=(conf,), name='api-warmup', daemon=True)
+    thread.start()
+    return thread
+
+
+def run_in_thread(conf):
+    try:
+        state.run(conf)
+    finally:
+        # このスレッドで開いた接続は、ほかのスレッドからは使えないので閉じておく
+        connections.close_all()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 try:
@@ -50,14 +51,33 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'api.middleware.CompressionMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # /api/ 以外のリクエストだけ、SCOPED_MIDDLEWARE['FULL_ONLY']のミドルウェアを通す
+    'api.middleware.PathScopedMiddleware',
+    'api.middleware.ProfilerMiddleware',
+    'api.middleware.SlowQueryMiddleware',
 ]
 
+# PathScopedMiddlewareの設定
+# LEAN_PATH_PREFIXES: FULL_ONLYのミドルウェアを通さないパス(token認証のAPI)
+# FULL_ONLY: admin/などのそれ以外のパスだけで使うミドルウェア(この順番で通す)
+# 「python manage.py middleware_benchmark」で、1リクエストあたりの差を計測できる
+SCOPED_MIDDLEWARE = {
+    'LEAN_PATH_PREFIXES': ['/api/'],
+    'FULL_ONLY': [
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'django.middleware.csrf.CsrfViewMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+        'django.contrib.messages.middleware.MessageMiddleware',
+        'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    ],
+}
+
+# adminのチェックはMIDDLEWAREに直接並んでいるかしか見ないので、
+# SCOPED_MIDDLEWARE['FULL_ONLY']に移したauth/messages/sessionsのミドルウェアのチェックは外す
+SILENCED_SYSTEM_CHECKS = ['admin.E408', 'admin.E409', 'admin.E410']
+
 CORS_ORIGIN_WHITELIST = [
     "http://127.0.0.1:3000"
 ]
@@ -65,6 +85,9 @@ CORS_ORIGIN_WHITELIST = [
 
 ROOT_URLCONF = 'rest_api.urls'
 
+# routerにAPIルートのView(/api/)とフォーマット拡張子のURLを作るかどうか
+API_ROOT_VIEW = True
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -91,11 +114,198 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
     # 認証方法としてtoken認証を使用する
+    # /api/batch/のサブリクエストは、バッチのリクエストで認証したユーザを使う(api.batch)
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.TokenAuthentication',
+        'api.batch.BatchAuthentication',
+    ],
+    # 同じホストのワーカー間で共有メモリを使うスロットル(設定はAPI_THROTTLE)
+    'DEFAULT_THROTTLE_CLASSES': [
+        'api.throttling.SharedMemoryUserThrottle',
+        'api.throttling.SharedMemoryRouteThrottle',
     ],
 }
 
+# スロットルの設定(api.throttling)
+# USER_RATE: ユーザごと(未ログインはIPごと)の制限
+# ROUTE_RATES: URL名ごと・ユーザごとの制限
+# 書式はDRFと同じ「回数/期間(s, min, hour, day)」
+# 状態は同じファイル(PATH)を使うプロセスすべてで共有され、プロセスが終わっても残るので、本番のワーカーでだけ有効にする
+# 例: 環境変数API_THROTTLE=1で起動する
+# PATH: Noneのときは/dev/shm/rest_api-throttle-<プロジェクトの場所とsettingsのハッシュ>
+API_THROTTLE = {
+    'ENABLED': os.environ.get('API_THROTTLE') == '1',
+    'PATH': None,
+    'SLOTS': 65536,
+    'USER_RATE': '600/min',
+    'ROUTE_RATES': {
+        'api:auth': '30/min',
+        'api:vehicle-list': '120/min',
+    },
+}
+
+
+# Vehicleのまとめて書き込み(write-behind)の設定
+# ENABLEDをTrueにすると、「Prefer: respond-async」ヘッダ付きのPOST /api/vehicles/が202を返し、
+# バックグラウンドでBATCH_SIZE件ごと、またはFLUSH_INTERVAL秒ごとにまとめてコミットする
+# 受け付けた行はコミットするまでワーカーのメモリにしかないので、ワーカーが強制終了されると失われる(ステータスはlost)
+# STATUS_CACHE: ステータスを保存するキャッシュ(どのワーカーからでも読めるように、CACHESのingest_statusを使う)
+# STATUS_TIMEOUT: ステータスを残しておく秒数(CACHESのingest_statusのMAX_ENTRIESは、これに合わせて決める)
+VEHICLE_INGEST = {
+    'ENABLED': False,
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 0.5,
+    'MAX_PENDING': 5000,
+    'STATUS_TIMEOUT': 60 * 60,
+    'STATUS_CACHE': 'ingest_status',
+}
+
+
+# segment/brand/vehicleの一覧・詳細のレスポンスキャッシュの設定
+# ENABLEDをTrueにすると、GET /api/vehicles/ や /api/brands/<id>/ などのレスポンスをプロセス内にキャッシュする
+# Vehicle/Brand/Segmentに書き込みがあるとキャッシュは無効になる
+# ヒット率などは /api/vehicles/cache-stats/ で確認できる(管理者のみ)
+API_RESPONSE_CACHE = {
+    'ENABLED': False,
+    'MAX_ENTRIES': 512,
+}
+
+# ワーカー間のキャッシュの無効化(api.invalidation)の設定
+# Vehicle/Brand/Segmentに書き込みがあると、同じホストのほかのワーカーのレスポンスキャッシュと
+# brand/segmentの名前のキャッシュも、次にキャッシュを読むときに無効になる
+# PATH: 更新回数を置く共有メモリのファイル(Noneのときは/dev/shm/rest_api-invalidation-<プロジェクトとsettingsのハッシュ>)
+API_INVALIDATION_BUS = {
+    'ENABLED': True,
+    'PATH': None,
+}
+
+# 同時に来た同じGETリクエスト(segment/brand/vehicleの一覧・詳細)を1回の計算にまとめる設定
+# あとから来たリクエストは処理中のリクエストを待ち、レンダリング済みのバイト列を共有する
+# TIMEOUT: 待つ最大の秒数(超えたら自分で処理する)
+# まとめるのはWSGI(rest_api/wsgi.py)で受けたリクエストだけで、スレッドで並列にリクエストを処理するワーカー
+# (gunicornのgthread、runserverなど)で効果がある
+# Django 3.2のASGIでは同期のViewは1つのスレッドで順番に実行され、同時に処理中になるリクエストがないので、
+# ASGI(rest_api/asgi.py)で受けたリクエストはまとめない
+API_COALESCE = {
+    'ENABLED': True,
+    'TIMEOUT': 5.0,
+}
+
+
+# APIのレスポンスの圧縮の設定(api.middleware.CompressionMiddleware)
+# Accept-Encodingに応じてbrotli(brotliがインストールされているとき)かgzipで圧縮する
+# MIN_SIZEバイトより小さいレスポンスは圧縮しない
+API_COMPRESSION = {
+    'ENABLED': True,
+    'MIN_SIZE': 1024,
+    'GZIP_LEVEL': 6,
+    'BROTLI_QUALITY': 5,
+    'PATH_PREFIXES': ['/api/'],
+    'CONTENT_TYPES': ['application/json', 'text/'],
+}
+
+
+# リクエスト単位のプロファイラの設定(api.middleware.ProfilerMiddleware)
+# ENABLEDをTrueにすると、次のリクエストをcProfileで計測してDIRECTORYに保存する
+# ・スタッフユーザがHEADERのヘッダ(X-Profile)を付けたリクエスト
+# ・ROUTESのURL名(例: 'api:vehicle-list')へのリクエストのうち、SAMPLE_RATEの割合
+API_PROFILER = {
+    'ENABLED': False,
+    'HEADER': 'X-Profile',
+    'SAMPLE_RATE': 0.0,
+    'ROUTES': [],
+    'DIRECTORY': BASE_DIR / 'profiles',
+    'MAX_FILES': 50,
+}
+
+
+# 遅いSQLのログの設定(api.middleware.SlowQueryMiddleware)
+# ENABLEDをTrueにすると、APIから実行されたTHRESHOLD_MS以上のSQLを実行計画と一緒に集計する
+# 集計は/api/slow-queries/(管理者のみ)と「python manage.py slow_queries」で確認できる
+SLOW_QUERY_LOG = {
+    'ENABLED': False,
+    'THRESHOLD_MS': 100,
+    'TOP_N': 50,
+    'DIRECTORY': BASE_DIR / 'slow_queries',
+    'DUMP_INTERVAL': 5,
+}
+
+
+# Trueにすると、GET /api/vehicles/ と /api/vehicles/<id>/ はJOINせずに
+# 非正規化したvehicle一覧のテーブル(VehicleListing)から読み取る
+VEHICLE_LISTING_READ_MODEL = False
+
+
+# 古いvehicleをコールドテーブルへ移す設定(api.archive、「python manage.py archive_vehicles」)
+# CUTOFF_YEAR: このrelease_yearより前のvehicleを移す(Noneのときはコマンドの--beforeで指定する)
+# BATCH_SIZE: 1トランザクションで移す件数
+# /api/vehicles/ はホットテーブルだけを読み、?archived=includeで両方、?archived=onlyでコールドテーブルだけを読む
+VEHICLE_ARCHIVE = {
+    'CUTOFF_YEAR': None,
+    'BATCH_SIZE': 500,
+}
+
+
+# GET /api/vehicles/snapshot/ と「python manage.py export_catalog_snapshot」の設定(pyarrowが必要)
+# DIRECTORY: データのバージョンごとのファイルを置く場所
+# BATCH_SIZE: 1つのRecordBatchに入れる行数
+CATALOG_SNAPSHOT = {
+    'DIRECTORY': BASE_DIR / 'snapshots',
+    'BATCH_SIZE': 10000,
+}
+
+
+# ワーカーの起動時のウォームアップ(api.warmup)の設定
+# serializerのフィールド、URLの解決、DBの接続、brand/segmentの名前のキャッシュを先に準備しておく
+# 終わるまで /api/ready/ は503を返す
+# rest_api/wsgi.pyとasgi.pyを読み込むサーバのプロセスでだけ実行される(migrateなどのコマンドでは実行されない)
+# 環境変数API_WARMUP=1で有効にする
+# 例: API_WARMUP=1 gunicorn rest_api.wsgi
+API_WARMUP = {
+    'ENABLED': os.environ.get('API_WARMUP') == '1',
+    'BACKGROUND': False,
+    'STEPS': ['serializers', 'routes', 'databases', 'lookups'],
+}
+
+
+# /api/batch/ の設定
+# MAX_REQUESTS: 1回のバッチに入れられるサブリクエストの数
+# MAX_WORKERS: 読み取りだけのサブリクエストを並列に実行するスレッド数
+API_BATCH = {
+    'MAX_REQUESTS': 20,
+    'MAX_WORKERS': 4,
+}
+
+
+# キャッシュの設定
+# default: プロセスごとのメモリ上のキャッシュ
+# shared: ワーカー間で共有するキャッシュ(書き込んだユーザのprimaryへの固定)
+#         ここでは同じホストのワーカー間で共有するファイルのキャッシュにしている
+#         複数のホストでワーカーを動かすときは、memcachedやRedisなどのバックエンドに変えること
+# ingest_status: 非同期登録のステータス(受け付けた1行ごとに1エントリ、VEHICLE_INGESTのSTATUS_TIMEOUTだけ残す)
+#         FileBasedCacheはエントリがMAX_ENTRIESを超えると、期限に関係なくランダムに1/CULL_FREQUENCYを消すので、
+#         MAX_ENTRIESは「受け付けるペースの上限(行/秒) × STATUS_TIMEOUT」より大きくしておく(ここでは10行/秒で1時間分)
+#         また、FileBasedCacheは書き込みのたびにディレクトリの一覧を取るので、エントリが多いほど遅くなる
+#         これより速いペースで受け付けるときや、複数のホストで動かすときは、memcachedやRedisに変えること
+#         (sharedとは分けているので、ステータスが増えても固定が消されることはない)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'shared_cache',
+    },
+    'ingest_status': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'ingest_status',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10 * 60 * 60,
+        },
+    },
+}
+
 
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
@@ -107,6 +317,46 @@ DATABASES = {
     }
 }
 
+# 読み取りレプリカの設定
+# DATABASESに追加したレプリカのエイリアスをREPLICA_DATABASESに並べると、
+# routerのViewSetへのGETリクエストがレプリカから読み取るようになる
+REPLICA_DATABASES = []
+
+# ローカルで動作確認するときは、環境変数API_REPLICA_SQLITEに2つ目のSQLiteファイルを指定する
+# 例: db.sqlite3をコピーしてreplica.sqlite3を作り、API_REPLICA_SQLITE=replica.sqlite3で起動する
+if os.environ.get('API_REPLICA_SQLITE'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / os.environ['API_REPLICA_SQLITE'],
+        # テスト時はレプリカ用のDBを作らず、defaultをそのまま使う
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    }
+    REPLICA_DATABASES.append('replica')
+
+DATABASE_ROUTERS = ['api.db_routers.PrimaryReplicaRouter']
+
+# 書き込みをしたユーザをprimaryに固定しておく秒数(レプリケーション遅延対策)
+REPLICA_STICKY_SECONDS = 5
+
+# 固定したユーザを覚えておくキャッシュ(CACHESのエイリアス)
+# どのワーカーにリクエストが来ても固定が効くように、ワーカー間で共有するキャッシュを指定する
+REPLICA_PIN_CACHE = 'shared'
+
+
+# テストの実行(api.testing.ApiTestRunner)
+# コアの数だけ並列に実行し、--tag perfのときは大きなデータセットを入れたテストDBで性能テストを実行する
+TEST_RUNNER = 'api.testing.ApiTestRunner'
+
+# 性能テスト用のデータセット(api.seed)の設定
+# SCALE: vehicleの件数
+# SNAPSHOT_DIRECTORY: データセットを入れたSQLiteのファイルを保存しておく場所(次の実行から使い回す)
+TEST_SEED = {
+    'SCALE': 5000,
+    'SNAPSHOT_DIRECTORY': BASE_DIR / '.test_snapshots',
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
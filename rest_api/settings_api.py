@@ -0,0 +1,58 @@
+"""
+Trimmed settings for rest_api workers that only serve /api/.
+
+These workers do not need the admin, sessions, messages, staticfiles or
+CORS apps, so they are left out of INSTALLED_APPS and MIDDLEWARE. Nothing
+is loaded lazily: the apps that remain are imported at startup as usual,
+and most of the startup time is Django's own imports, which this profile
+does not change. Expect a small gain, not a different cold start.
+
+    DJANGO_SETTINGS_MODULE=rest_api.settings_api gunicorn rest_api.wsgi
+
+Compare the startup time with:
+
+    python manage.py startup_profile rest_api.settings rest_api.settings_api
+"""
+
+from .settings import *
+
+# token認証に必要なアプリだけを読み込む
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+
+    'rest_framework',
+    'rest_framework.authtoken',
+    'api.apps.ApiConfig',
+]
+
+# token認証ではセッション、CSRF、messagesは使わないので外す
+# ブラウザのフロントエンドからこのワーカーを直接呼ぶ場合は、corsheadersを戻すこと
+MIDDLEWARE = [
+    'django.middleware.security.SecurityMiddleware',
+    'api.middleware.CompressionMiddleware',
+    'django.middleware.common.CommonMiddleware',
+    # 無効のときは読み込まれないので、残しておいても負荷はかからない
+    'api.middleware.ProfilerMiddleware',
+    'api.middleware.SlowQueryMiddleware',
+]
+
+# admin/を含まないURLconf
+ROOT_URLCONF = 'rest_api.urls_api'
+
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'DIRS': [],
+        'APP_DIRS': True,
+        'OPTIONS': {
+            'context_processors': [],
+        },
+    },
+]
+
+# ブラウザブルAPI(テンプレートの読み込み)とAPIルートのViewは使わない
+REST_FRAMEWORK = dict(REST_FRAMEWORK, DEFAULT_RENDERER_CLASSES=[
+    'rest_framework.renderers.JSONRenderer',
+])
+API_ROOT_VIEW = False
@@ -0,0 +1,7 @@
+from django.urls import path, include
+
+# API専用ワーカー(rest_api.settings_api)のURLconf
+# adminを読み込まないので、最初のリクエストでadminサイトのimportが走らない
+urlpatterns = [
+    path('api/', include('api.urls')),
+]
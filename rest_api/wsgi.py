@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rest_api.settings')
 
 application = get_wsgi_application()
+
+# サーバのプロセスでだけ、最初のリクエストの前にウォームアップする(settings.pyのAPI_WARMUP)
+from api import warmup  # noqa: E402
+
+warmup.start()